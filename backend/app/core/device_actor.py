@@ -0,0 +1,111 @@
+import asyncio
+import queue
+import threading
+from concurrent.futures import Future
+
+
+class DeviceActor:
+    """
+    Owns one instrument and runs every request to it on a dedicated I/O
+    thread, one at a time, so requests are serialized per device but
+    different devices work concurrently. Blocking code calls methods on
+    the actor as if it were the device; coroutines await actor.run(...)
+    so a slow VISA or Kinesis call never blocks the event loop.
+
+    Attributes that are not methods, and methods listed in direct (cheap
+    reads of cached values), are served without going through the queue.
+    Direct methods never wait for the connection: before it is made they
+    raise on any thread but the I/O thread, so the event loop never blocks.
+
+    Instead of a target the actor can be given connect, a callable that
+    creates it. The device is then connected on the I/O thread, so actors
+    of different devices connect in parallel: right away in the
+    background, or with lazy on first use. Calls queue behind the
+    connection.
+    """
+
+    def __init__(self, target, name, direct=(), connect=None, lazy=False):
+        self._target = target
+        self.connect = connect
+        self.name = name
+        self.direct = set(direct)
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.loop, name=f"{name}-io", daemon=True)
+        self.thread.start()
+        if target is None and not lazy:
+            self.submit(lambda: self.target)
+
+    @property
+    def target(self):
+        if self._target is None:
+            if threading.current_thread() is not self.thread:
+                return self.call(lambda: self.target)
+            print(f"---Connecting {self.name}")
+            self._target = self.connect()
+        return self._target
+
+    @property
+    def connected(self):
+        return self._target is not None
+
+    async def ready(self):
+        """
+        Wait, without blocking the event loop, until the device is connected.
+        """
+        if self._target is None:
+            await self.run(lambda: self.target)
+
+    def loop(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            future, fn, args, kwargs = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def submit(self, method, *args, **kwargs):
+        """
+        Queue a call and return a concurrent.futures.Future. method is the
+        name of a device method or any callable to run on the I/O thread.
+        """
+        if isinstance(method, str):
+            # Looked up on the I/O thread, where the device may still be connecting
+            name = method
+            fn = lambda *args, **kwargs: getattr(self.target, name)(*args, **kwargs)
+        else:
+            fn = method
+        future = Future()
+        if threading.current_thread() is self.thread:
+            # Already on the I/O thread (nested call), queueing would deadlock
+            future.set_running_or_notify_cancel()
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+            return future
+        self.queue.put((future, fn, args, kwargs))
+        return future
+
+    def call(self, method, *args, **kwargs):
+        return self.submit(method, *args, **kwargs).result()
+
+    async def run(self, method, *args, **kwargs):
+        return await asyncio.wrap_future(self.submit(method, *args, **kwargs))
+
+    def stop(self):
+        self.queue.put(None)
+
+    def __getattr__(self, name):
+        if name in self.direct:
+            if self._target is None and threading.current_thread() is not self.thread:
+                raise RuntimeError(f"{self.name} is not connected yet")
+            return getattr(self.target, name)
+        attribute = getattr(self.target, name)
+        if not callable(attribute):
+            return attribute
+        return lambda *args, **kwargs: self.call(name, *args, **kwargs)
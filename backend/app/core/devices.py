@@ -0,0 +1,120 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from app.core.lockin import SR865A
+from app.core.multimeter import BKPrecision5493C
+from app.core.simulated import (
+    LOCKIN_SIGNAL_MAPS,
+    MULTIMETER_SIGNAL_MAPS,
+    SimulatedBBD302,
+    SimulatedBK5493CResource,
+    SimulatedSR865AResource,
+)
+from app.models.simulation import SimulationSettings
+
+DEVICES = ["stage", "lockin", "multimeter"]
+
+
+def simulation_settings_from_env():
+    """
+    Read the simulation settings from the environment. SIMULATE lists the
+    devices to simulate ("stage,lockin", or "all"); the SIM_* variables
+    tune the simulators.
+    """
+    devices = os.environ.get("SIMULATE", "")
+    if devices.strip().lower() in ("1", "all", "true"):
+        devices = DEVICES
+    else:
+        devices = [device.strip() for device in devices.split(",") if device.strip()]
+    settings = {"devices": devices}
+    for field in (
+        "latency",
+        "jitter",
+        "max_velocity",
+        "acceleration",
+        "lockin_signal",
+        "multimeter_signal",
+    ):
+        value = os.environ.get(f"SIM_{field.upper()}")
+        if value is not None:
+            settings[field] = value
+    return SimulationSettings(**settings)
+
+
+def device_factories(settings=None, stage=None):
+    """
+    Callables connecting the stage, lock-in and multimeter, keyed by
+    device, with the ones listed in settings.devices replaced by
+    simulators. stage is a callable returning the stage, which simulated
+    signal maps read positions from.
+    """
+    settings = settings or SimulationSettings()
+    for device in settings.devices:
+        if device not in DEVICES:
+            raise ValueError(f"Unknown device to simulate: {device}")
+
+    def connect_stage():
+        if "stage" in settings.devices:
+            return SimulatedBBD302(
+                max_velocity=settings.max_velocity, acceleration=settings.acceleration
+            )
+        # Kinesis loads through pythonnet, only import it for the real stage
+        from app.core.stage import ThorlabsBBD302
+
+        return ThorlabsBBD302()
+
+    def connect_lockin():
+        if "lockin" not in settings.devices:
+            return SR865A()
+        signal_map = LOCKIN_SIGNAL_MAPS[settings.lockin_signal]
+        return SR865A(
+            inst=SimulatedSR865AResource(
+                settings.latency,
+                settings.jitter,
+                source=signal_map(stage) if signal_map else None,
+            )
+        )
+
+    def connect_multimeter():
+        if "multimeter" not in settings.devices:
+            return BKPrecision5493C()
+        signal_map = MULTIMETER_SIGNAL_MAPS[settings.multimeter_signal]
+        return BKPrecision5493C(
+            inst=SimulatedBK5493CResource(
+                settings.latency,
+                settings.jitter,
+                source=signal_map(stage) if signal_map else None,
+            )
+        )
+
+    if settings.devices:
+        print(f"---Simulating {', '.join(settings.devices)}")
+    return {
+        "stage": connect_stage,
+        "lockin": connect_lockin,
+        "multimeter": connect_multimeter,
+    }
+
+
+def create_devices(settings=None):
+    """
+    Connect the stage, lock-in and multimeter in parallel, replacing the
+    ones listed in settings.devices by simulators. Returns (stage, lockin,
+    multimeter).
+    """
+    with ThreadPoolExecutor(max_workers=len(DEVICES)) as executor:
+        futures = {}
+        factories = device_factories(settings, lambda: futures["stage"].result())
+        for device in DEVICES:
+            futures[device] = executor.submit(factories[device])
+        return tuple(futures[device].result() for device in DEVICES)
+
+
+def lazy_devices_from_env():
+    """
+    Devices listed in LAZY_DEVICES ("lockin,multimeter", or "all") connect
+    on first use instead of in the background at startup.
+    """
+    devices = os.environ.get("LAZY_DEVICES", "")
+    if devices.strip().lower() in ("1", "all", "true"):
+        return list(DEVICES)
+    return [device.strip() for device in devices.split(",") if device.strip()]
@@ -1,20 +1,75 @@
-import pyvisa
+import math
+import time
+from collections import deque
+import numpy as np
+from app.core.visa import open_resource, resource_manager
+from app.models.lockin import LockinState
+from app.services.autorange import next_range
+from app.services.lockin_stream import PACKET_SIZES, STREAM_CHANNELS, STREAM_FORMATS
+from app.services.metrics import TracedResource, registry as metrics
+from app.services.settling import full_settle_time
+
+# CDSP parameter codes for the four data channels read back by SNAPD?
+SNAPSHOT_PARAMS = {"X": 0, "Y": 1, "R": 2, "theta": 3}
+
+# CAPTURECFG codes and the float32 columns each one writes per sample
+CAPTURE_CONFIGS = {
+    "X": (0, ["X"]),
+    "XY": (1, ["X", "Y"]),
+    "RT": (2, ["R", "theta"]),
+    "XYRT": (3, ["X", "Y", "R", "theta"]),
+}
+CAPTURE_MAX_KB = 4096
+
+# OFLT index -> time constant in seconds
+TIME_CONSTANTS = [
+    1e-6,
+    3e-6,
+    1e-5,
+    3e-5,
+    1e-4,
+    3e-4,
+    1e-3,
+    3e-3,
+    1e-2,
+    3e-2,
+    0.1,
+    0.3,
+    1.0,
+    3.0,
+    10.0,
+    30.0,
+    100.0,
+    300.0,
+    1e3,
+    3e3,
+    1e4,
+    3e4,
+]
+
+# OFSL index -> filter slope in dB/oct
+FILTER_SLOPES = [6, 12, 18, 24]
+CAPTURE_CHUNK_KB = 64
 
 
 class SR865A:
-    def __init__(self, resource_name=None):
+    def __init__(self, resource_name=None, inst=None):
+        self.state = LockinState()
+        self.snapshot_enabled = False
+        self.capture_config = None
+        self.capture_rate = None
+        self.capture_start = None
+        self.stream_rate = None
+        self.auto_range = None
+        self.range_events = deque(maxlen=256)
         try:
-            self.rm = pyvisa.ResourceManager()
-            if resource_name is None:
-                resources = self.rm.list_resources()
-                for res in resources:
-                    if "3769" in res:
-                        resource_name = res
-                        break
-            if resource_name is None:
-                raise Exception("SR865A not found!")
-            print(f"---Connecting to lockin: {resource_name}")
-            self.inst = self.rm.open_resource(resource_name)
+            if inst is None:
+                if resource_name is None:
+                    inst = open_resource("3769", "lockin")
+                else:
+                    print(f"---Connecting to lockin: {resource_name}")
+                    inst = resource_manager().open_resource(resource_name)
+            self.inst = TracedResource(inst, "lockin")
             self.inst.timeout = 5000
             self.volatage_sensitivity_map = [
                 1.0,
@@ -76,11 +131,146 @@ class SR865A:
                 2e-15,
                 1e-15,
             ]
+            self.configure_snapshot()
+            self.refresh_state()
         except Exception as e:
             print(f"---Locking initialization error: {e}")
 
+    def configure_snapshot(self):
+        # Route X, Y, R and theta to data channels 0-3 so SNAPD? returns all four
+        try:
+            for channel, param in enumerate(SNAPSHOT_PARAMS.values()):
+                self.inst.write(f"CDSP {channel}, {param}")
+            self.snapshot_enabled = True
+        except Exception as e:
+            print(f"---Lockin snapshot configuration error: {e}")
+            self.snapshot_enabled = False
+
+    def refresh_state(self):
+        self.state.input_mode = int(self.inst.query("IVMD?"))
+        self.state.frequency = float(self.inst.query("FREQ?"))
+        self.state.phase = float(self.inst.query("PHAS?"))
+        self.state.time_constant = TIME_CONSTANTS[int(self.inst.query("OFLT?"))]
+        self.state.filter_slope = FILTER_SLOPES[int(self.inst.query("OFSL?"))]
+        self.state.sensitivity_index = int(self.inst.query("SCAL?"))
+        self.state.sensitivity = self.sensitivities()[self.state.sensitivity_index]
+        self.state.amplitude = float(self.inst.query("SLVL?"))
+        return self.state
+
+    def sensitivities(self):
+        # Same SCAL indices in both input modes, volts or amps full scale
+        if self.state.input_mode == 0:
+            return self.volatage_sensitivity_map
+        return self.current_sensitivity_map
+
+    def set_frequency(self, frequency):
+        self.inst.write(f"FREQ {frequency}")
+        self.state.frequency = float(self.inst.query("FREQ?"))
+
+    def set_amplitude(self, amplitude):
+        self.inst.write(f"SLVL {amplitude}")
+        self.state.amplitude = float(self.inst.query("SLVL?"))
+
+    def set_reference(self, frequency, amplitude=None):
+        """
+        Set the reference frequency and sine amplitude in one write, for
+        frequency sweeps. Cached instead of read back, which would double
+        the bus round trips of every step.
+        """
+        commands = [f"FREQ {frequency}"]
+        if amplitude is not None:
+            commands.append(f"SLVL {amplitude}")
+        self.inst.write(";".join(commands))
+        self.state.frequency = float(frequency)
+        if amplitude is not None:
+            self.state.amplitude = float(amplitude)
+
+    def set_phase(self, phase):
+        self.inst.write(f"PHAS {phase}")
+        self.state.phase = float(self.inst.query("PHAS?"))
+
+    def set_input_mode(self, input_mode):
+        self.inst.write(f"IVMD {input_mode}")
+        self.state.input_mode = int(self.inst.query("IVMD?"))
+        if self.state.sensitivity_index is not None:
+            self.state.sensitivity = self.sensitivities()[self.state.sensitivity_index]
+
+    def set_time_constant(self, time_constant):
+        # Pick the closest available time constant
+        index = min(
+            range(len(TIME_CONSTANTS)),
+            key=lambda i: abs(math.log10(TIME_CONSTANTS[i] / time_constant)),
+        )
+        self.inst.write(f"OFLT {index}")
+        self.state.time_constant = TIME_CONSTANTS[int(self.inst.query("OFLT?"))]
+
+    def set_sensitivity(self, full_scale):
+        # Pick the most sensitive range that still covers full_scale
+        sensitivities = self.sensitivities()
+        index = max(
+            [i for i, value in enumerate(sensitivities) if value >= full_scale * 0.999]
+            or [0]
+        )
+        self.set_sensitivity_index(index)
+
+    def set_sensitivity_index(self, index):
+        # Cached instead of read back with SCAL?, auto-ranging changes it mid-scan
+        self.inst.write(f"SCAL {index}")
+        self.state.sensitivity_index = index
+        self.state.sensitivity = self.sensitivities()[index]
+
+    def configure_auto_range(self, params):
+        self.auto_range = params if params is not None and params.enabled else None
+        self.state.auto_range = self.auto_range is not None
+        if self.auto_range is not None and self.state.sensitivity_index is None:
+            self.refresh_state()
+        return self.state
+
+    def track_range(self, r):
+        """
+        Check a reading against the full scale and change range when it is
+        outside the hysteresis band or overloads, then wait for the output
+        to settle. Returns True if the range changed, so the reading should
+        be taken again.
+        """
+        params = self.auto_range
+        index = self.state.sensitivity_index
+        new_index, overload = next_range(r, index, self.sensitivities(), params)
+        if overload:
+            self.state.overloads += 1
+            metrics.increment("tops_lockin_overloads_total")
+            self.range_events.append(
+                {
+                    "time": time.time(),
+                    "event": "overload",
+                    "R": r,
+                    "sensitivity": self.state.sensitivity,
+                }
+            )
+            print(f"---Lockin overload: R = {r} at full scale {self.state.sensitivity}")
+        if new_index is None:
+            return False
+        previous = self.state.sensitivity
+        self.set_sensitivity_index(new_index)
+        metrics.increment("tops_lockin_range_changes_total")
+        self.range_events.append(
+            {
+                "time": time.time(),
+                "event": "range",
+                "R": r,
+                "from": previous,
+                "to": self.state.sensitivity,
+            }
+        )
+        if params.settle_time_constants is None:
+            time.sleep(full_settle_time(self.state))
+        else:
+            time.sleep(params.settle_time_constants * (self.state.time_constant or 0))
+        return True
+
     def get_dynamic_units_and_scale(self, value):
-        input_mode = int(self.inst.query("IVMD?"))
+        # Cached state only, this runs off the I/O thread; volts until the input mode is read
+        input_mode = self.state.input_mode or 0
         abs_value = abs(value)
 
         if input_mode == 0:
@@ -111,13 +301,56 @@ class SR865A:
                 scale_factor = 1e15
         return unit, scale_factor
 
+    def read_snapshot(self):
+        """
+        Read X, Y, R and theta in a single round trip. Falls back to
+        SNAP? X, Y, theta with R computed locally if the data channels
+        could not be configured for SNAPD?.
+        """
+        if self.snapshot_enabled:
+            x, y, r, theta = (
+                float(value) for value in self.inst.query("SNAPD?").split(",")
+            )
+        else:
+            x, y, theta = (
+                float(value) for value in self.inst.query("SNAP? 0, 1, 3").split(",")
+            )
+            r = math.hypot(x, y)
+        return x, y, r, theta
+
     def read_values(self, scaled=False):
+        if self.state.frequency is None:
+            self.refresh_state()
+        x, y, r, theta = self.read_snapshot()
+        if self.auto_range is not None:
+            for _ in range(self.auto_range.max_steps):
+                if not self.track_range(r):
+                    break
+                x, y, r, theta = self.read_snapshot()
+        return self.format_values(x, y, r, theta, scaled)
+
+    def read_values_polled(self, scaled=False):
         x = float(self.inst.query("OUTP? 0"))
         y = float(self.inst.query("OUTP? 1"))
         r = float(self.inst.query("OUTP? 2"))
         theta = float(self.inst.query("OUTP? 3"))
-        freq = float(self.inst.query("FREQ?"))
-        phase = float(self.inst.query("PHAS?"))
+        self.state.frequency = float(self.inst.query("FREQ?"))
+        self.state.phase = float(self.inst.query("PHAS?"))
+        self.state.input_mode = int(self.inst.query("IVMD?"))
+        return self.format_values(x, y, r, theta, scaled)
+
+    def scale_values(self, values):
+        """
+        Copy of unscaled values (from read_values) with X, Y and R in the
+        display unit chosen for R.
+        """
+        unit, scale_factor = self.get_dynamic_units_and_scale(values["R"])
+        scaled = dict(values, unit=unit)
+        for name in ("X", "Y", "R"):
+            scaled[name] = values[name] * scale_factor
+        return scaled
+
+    def format_values(self, x, y, r, theta, scaled=False):
         unit, scale_factor = self.get_dynamic_units_and_scale(r)
         if scaled:
             x *= scale_factor
@@ -129,6 +362,141 @@ class SR865A:
             "R": r,
             "unit": unit,
             "theta": theta,
-            "frequency": freq,
-            "phase": phase,
+            "frequency": self.state.frequency,
+            "phase": self.state.phase,
+            "sensitivity": self.state.sensitivity,
+            "amplitude": self.state.amplitude,
         }
+
+    def start_stream(
+        self, port, channels="XYRT", rate=None, fmt="float32", packet_size=1024
+    ):
+        """
+        Start streaming samples over UDP to port of this host. As for the
+        capture, the rate is rounded down to max_rate / 2^n. Returns the
+        rate in Hz; the ingest must already be listening.
+        """
+        self.inst.write("STREAM OFF")
+        self.inst.write(f"STREAMPORT {int(port)}")
+        self.inst.write(f"STREAMCH {STREAM_CHANNELS[channels]}")
+        self.inst.write(f"STREAMFMT {STREAM_FORMATS[fmt]}")
+        self.inst.write(f"STREAMPCKT {PACKET_SIZES.index(packet_size)}")
+        # Little-endian samples with the packet counter checked
+        self.inst.write("STREAMOPTION 3")
+        max_rate = float(self.inst.query("STREAMRATEMAX?"))
+        divider = 0
+        if rate is not None and rate < max_rate:
+            divider = min(math.ceil(math.log2(max_rate / rate)), 20)
+        self.inst.write(f"STREAMRATE {divider}")
+        self.stream_rate = max_rate / 2 ** int(self.inst.query("STREAMRATE?"))
+        self.inst.write("STREAM ON")
+        print(
+            f"---Lockin streaming {channels} {fmt} at {self.stream_rate} Hz to port {port}"
+        )
+        return self.stream_rate
+
+    def stop_stream(self):
+        self.inst.write("STREAM OFF")
+
+    def arm_capture(self, rate=None, config="XYRT", length_kb=CAPTURE_MAX_KB):
+        """
+        Configure the internal capture buffer and start a one-shot capture.
+        The rate is rounded down to the nearest max_rate / 2^n the
+        instrument supports; None captures at the maximum rate.
+        """
+        code, _ = CAPTURE_CONFIGS[config]
+        self.inst.write("CAPTURESTOP")
+        self.inst.write(f"CAPTURELEN {min(max(int(length_kb), 1), CAPTURE_MAX_KB)}")
+        self.inst.write(f"CAPTURECFG {code}")
+        max_rate = float(self.inst.query("CAPTURERATEMAX?"))
+        divider = 0
+        if rate is not None and rate < max_rate:
+            divider = min(math.ceil(math.log2(max_rate / rate)), 20)
+        self.inst.write(f"CAPTURERATE {divider}")
+        self.capture_rate = float(self.inst.query("CAPTURERATE?"))
+        self.capture_config = config
+        self.inst.write("CAPTURESTART 0, 0")
+        self.capture_start = time.monotonic()
+        print(f"---Lockin capture armed: {config} at {self.capture_rate} Hz")
+        return self.capture_rate
+
+    def capture_rate_for(self, duration, config="XYRT", length_kb=CAPTURE_MAX_KB):
+        """
+        Highest capture rate at which length_kb of buffer lasts duration
+        seconds, for arm_capture.
+        """
+        _, columns = CAPTURE_CONFIGS[config]
+        samples = (
+            min(max(int(length_kb), 1), CAPTURE_MAX_KB) * 1024 // (4 * len(columns))
+        )
+        return samples / max(duration, 1e-3)
+
+    def stop_capture(self):
+        self.inst.write("CAPTURESTOP")
+
+    def read_capture(self):
+        """
+        Read the capture buffer back in binary blocks and decode it into
+        NumPy arrays keyed by column, plus monotonic timestamps derived
+        from the capture rate.
+        """
+        _, columns = CAPTURE_CONFIGS[self.capture_config]
+        n_bytes = int(self.inst.query("CAPTUREBYTES?"))
+        n_kb = math.ceil(n_bytes / 1024)
+        blocks = []
+        for offset in range(0, n_kb, CAPTURE_CHUNK_KB):
+            size = min(CAPTURE_CHUNK_KB, n_kb - offset)
+            blocks.append(
+                self.inst.query_binary_values(
+                    f"CAPTUREGET? {offset}, {size}",
+                    datatype="f",
+                    is_big_endian=False,
+                    container=np.array,
+                )
+            )
+        raw = np.concatenate(blocks) if blocks else np.empty(0, dtype=np.float32)
+        n_samples = min(raw.size, n_bytes // 4) // len(columns)
+        samples = raw[: n_samples * len(columns)].reshape(n_samples, len(columns))
+        capture = {
+            "timestamp": self.capture_start
+            + np.arange(n_samples, dtype=np.float64) / self.capture_rate
+        }
+        for index, column in enumerate(columns):
+            capture[column] = samples[:, index]
+        return capture
+
+    def average_capture(self, capture, windows):
+        """
+        Average the captured samples inside each (start, end) monotonic
+        time window, returning one read_values-style dict per window.
+        Windows the capture did not cover (the buffer filled up before
+        them) get NaN values and samples = 0.
+        """
+        timestamps = capture["timestamp"]
+        period = 1 / self.capture_rate
+        results = []
+        for start, end in windows:
+            lo, hi = np.searchsorted(timestamps, [start, end])
+            if hi <= lo:
+                # Window shorter than one sample period, use the nearest one
+                lo = min(max(lo - 1, 0), max(timestamps.size - 1, 0))
+                hi = lo + 1
+                if not timestamps.size or abs(timestamps[lo] - start) > period:
+                    metrics.increment("tops_capture_missed_windows_total")
+                    values = self.format_values(math.nan, math.nan, math.nan, math.nan)
+                    values["samples"] = 0
+                    results.append(values)
+                    continue
+            means = {
+                column: float(np.mean(values[lo:hi]))
+                for column, values in capture.items()
+                if column != "timestamp" and values[lo:hi].size
+            }
+            x = means.get("X", math.nan)
+            y = means.get("Y", math.nan)
+            r = means.get("R", math.hypot(x, y))
+            theta = means.get("theta", math.degrees(math.atan2(y, x)))
+            values = self.format_values(x, y, r, theta)
+            values["samples"] = int(hi - lo)
+            results.append(values)
+        return results
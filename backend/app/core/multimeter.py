@@ -1,43 +1,152 @@
-import pyvisa
-import time
+import numpy as np
+from app.core.visa import open_resource, resource_manager
+from app.models.multimeter import MultimeterState
+from app.services.metrics import TracedResource
+
+MEASUREMENT_MODES = [
+    "VOLT:DC",
+    "VOLT:AC",
+    "CURR:DC",
+    "CURR:AC",
+    "RES",
+    "FRES",
+    "FREQ",
+    "PER",
+]
+
+# Modes whose integration time is set in power line cycles
+NPLC_MODES = ["VOLT:DC", "CURR:DC", "RES", "FRES"]
+
+TRIGGER_SOURCES = ["IMM", "BUS", "EXT"]
 
 
 class BKPrecision5493C:
-    def __init__(self, resource_name=None):
+    def __init__(self, resource_name=None, inst=None):
+        self.state = MultimeterState()
+        # While a scan holds its burst setup, read_value answers from the last burst
+        self.burst_held = False
+        self.last_reading = None
         try:
-            self.rm = pyvisa.ResourceManager()
-            if resource_name is None:
-                resources = self.rm.list_resources()
-                for res in resources:
-                    if "W114239033" in res:
-                        resource_name = res
-                        break
-            if resource_name is None:
-                raise Exception("BK Precision 5493C not found!")
-            print(f"---Connecting to multimeter: {resource_name}")
-            self.inst = self.rm.open_resource(resource_name)
+            if inst is None:
+                if resource_name is None:
+                    inst = open_resource("W114239033", "multimeter")
+                else:
+                    print(f"---Connecting to multimeter: {resource_name}")
+                    inst = resource_manager().open_resource(resource_name)
+            self.inst = TracedResource(inst, "multimeter")
             self.inst.timeout = 5000
             self.inst.write("*RST")
-            self.inst.write("CONF:VOLT:DC")
-            time.sleep(1)
+            self.configure_measurement("VOLT:DC")
         except Exception as e:
             print(f"---Multimeter initialization error: {e}")
 
     def read_value(self):
+        if self.burst_held:
+            return self.last_reading
         try:
+            # Undo a burst setup, READ? would return or wait for a whole burst
+            if self.state.trigger_source != "IMM":
+                self.set_trigger_source("IMM")
+            if self.state.sample_count != 1:
+                self.set_sample_count(1)
             reading = float(self.inst.query("READ?"))
             return reading
         except Exception as e:
             print(f"Error reading from multimeter: {e}")
             return None
 
-    def configure_measurement(self, mode="VOLT:DC"):
+    def configure_measurement(self, mode="VOLT:DC", nplc=None):
         """
-        Modes: VOLT:DC, VOLT:AC, CURR:DC, CURR:AC, RES, FREQ, etc.
+        Modes: VOLT:DC, VOLT:AC, CURR:DC, CURR:AC, RES, FRES, FREQ, PER.
+        CONF also returns sample count and trigger source to their
+        defaults. *OPC? waits for the switch instead of a fixed sleep.
         """
         try:
-            self.inst.write(f"CONF: {mode}")
+            mode = mode.upper()
+            if mode not in MEASUREMENT_MODES:
+                raise ValueError(f"Unknown measurement mode {mode}")
+            self.inst.write(f"CONF:{mode}")
+            self.state = MultimeterState(mode=mode)
+            if nplc is not None:
+                self.set_nplc(nplc)
+            self.inst.query("*OPC?")
             return True
         except Exception as e:
             print(f"Error configuring multimeter: {e}")
             return False
+
+    def set_nplc(self, nplc):
+        if self.state.mode not in NPLC_MODES:
+            raise ValueError(
+                f"Integration time cannot be set in {self.state.mode} mode"
+            )
+        self.inst.write(f"{self.state.mode}:NPLC {nplc}")
+        self.state.nplc = nplc
+
+    def set_sample_count(self, count):
+        self.inst.write(f"SAMP:COUN {int(count)}")
+        self.state.sample_count = int(count)
+
+    def set_trigger_source(self, source):
+        source = source.upper()
+        if source not in TRIGGER_SOURCES:
+            raise ValueError(f"Unknown trigger source {source}")
+        self.inst.write(f"TRIG:SOUR {source}")
+        self.state.trigger_source = source
+
+    def configure_burst(self, samples, trigger_source="IMM", nplc=None):
+        """
+        Set up the meter to take samples readings per INIT. Only settings
+        that differ from the current ones are sent.
+        """
+        if nplc is not None and nplc != self.state.nplc:
+            self.set_nplc(nplc)
+        if trigger_source.upper() != self.state.trigger_source:
+            self.set_trigger_source(trigger_source)
+        if samples != self.state.sample_count:
+            self.set_sample_count(samples)
+
+    def hold_burst(self, held=True):
+        """
+        Keep the burst setup between bursts: read_value (e.g. telemetry
+        polled between scan points) then returns the mean of the last
+        burst instead of resetting the trigger and sample count, which
+        the next burst would have to send again.
+        """
+        self.burst_held = held
+
+    def read_burst(self, samples=None, trigger_source=None, remove=False):
+        """
+        Take a burst of readings and transfer them in one reply, with
+        FETC? or, with remove, DATA:REM? which also frees the reading
+        memory. A BUS trigger is sent by *TRG, an EXT trigger is waited
+        for until the VISA timeout.
+        """
+        try:
+            self.configure_burst(
+                samples or self.state.sample_count,
+                trigger_source or self.state.trigger_source,
+            )
+            self.inst.write("INIT")
+            if self.state.trigger_source == "BUS":
+                self.inst.write("*TRG")
+            if remove:
+                self.inst.query("*OPC?")
+                command = f"DATA:REM? {self.state.sample_count}"
+            else:
+                command = "FETC?"
+            return self.inst.query_ascii_values(command, container=np.array)
+        except Exception as e:
+            print(f"Error reading burst from multimeter: {e}")
+            return None
+
+    def measure_burst(self, samples=None, trigger_source=None, remove=False):
+        readings = self.read_burst(samples, trigger_source, remove)
+        if readings is None or not len(readings):
+            return None
+        self.last_reading = float(readings.mean())
+        return {
+            "mean": float(readings.mean()),
+            "std": float(readings.std(ddof=1)) if len(readings) > 1 else 0.0,
+            "count": len(readings),
+        }
@@ -0,0 +1,548 @@
+import math
+import random
+import socket
+import threading
+import time
+import numpy as np
+from app.core.stage_base import StageBase
+from app.services.lockin_stream import (
+    INT16_FULL_SCALE,
+    OVERLOAD_BIT,
+    PACKET_SIZES,
+    STREAM_COLUMNS,
+    encode_packet,
+)
+
+# SCAL index -> full scale in volts (1 V to 1 nV in 1-2-5 steps), in
+# current mode the same numbers in microamps
+SENSITIVITIES = [
+    scale * 10.0**-decade for decade in range(10) for scale in (1.0, 0.5, 0.2)
+][:28]
+
+
+class SimulatedSR865AResource:
+    """
+    Stand-in for the pyvisa resource of an SR865A. Answers the commands
+    used by SR865A and sleeps for a per-query latency to mimic the bus.
+    source, if given, is called for the (X, Y) signal in volts, e.g. to
+    make it depend on the position of a simulated stage.
+    """
+
+    def __init__(self, latency=0.005, jitter=0.0, source=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.source = source
+        self.timeout = 5000
+        self.query_count = 0
+        self.write_count = 0
+        self.settings = {
+            "IVMD": 0,
+            "FREQ": 1000.0,
+            "PHAS": 0.0,
+            "OFLT": 6,
+            "OFSL": 1,
+            "SCAL": 0,
+            "SLVL": 1.0,
+        }
+        self.data_channels = {0: 0, 1: 1, 2: 2, 3: 3}
+        self.capture_rate_max = 156250.0
+        self.capture = {"CAPTURELEN": 256, "CAPTURECFG": 3, "CAPTURERATE": 0}
+        self.capture_start = None
+        self.capture_stop = None
+        self.stream_rate_max = 20000.0
+        self.stream = {
+            "STREAMCH": 3,
+            "STREAMFMT": 0,
+            "STREAMPCKT": 0,
+            "STREAMRATE": 0,
+            "STREAMPORT": 1865,
+            "STREAMOPTION": 3,
+        }
+        self.replayer = None
+
+    def _wait(self):
+        time.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+    def signal(self):
+        if self.source is not None:
+            x, y = self.source()
+        else:
+            t = time.monotonic()
+            x = 1e-6 * math.cos(t)
+            y = 1e-6 * math.sin(t)
+        # The outputs clip a little above the full scale of the sensitivity
+        limit = 1.1 * SENSITIVITIES[self.settings["SCAL"]]
+        if self.settings["IVMD"]:
+            limit *= 1e-6
+        r = math.hypot(x, y)
+        theta = math.degrees(math.atan2(y, x))
+        x = min(max(x, -limit), limit)
+        y = min(max(y, -limit), limit)
+        return [x, y, min(r, limit), theta]
+
+    def write(self, command):
+        self._wait()
+        self.write_count += 1
+        # Commands chained with ";" arrive in one message
+        for part in command.split(";"):
+            self.execute(part)
+
+    def execute(self, command):
+        name, _, args = command.strip().partition(" ")
+        name = name.upper()
+        if name == "CDSP":
+            channel, param = (int(arg) for arg in args.split(","))
+            self.data_channels[channel] = param
+        elif name in self.settings:
+            self.settings[name] = type(self.settings[name])(float(args))
+        elif name in self.capture:
+            self.capture[name] = int(args)
+        elif name == "CAPTURESTART":
+            self.capture_start = time.monotonic()
+            self.capture_stop = None
+        elif name == "CAPTURESTOP" and self.capture_start is not None:
+            self.capture_stop = time.monotonic()
+        elif name in self.stream:
+            self.stream[name] = int(args)
+        elif name == "STREAM":
+            if self.replayer is not None:
+                self.replayer.stop()
+                self.replayer = None
+            if args.strip().upper() in ("1", "ON"):
+                self.replayer = UdpReplayer(
+                    self.stream["STREAMPORT"],
+                    self.stream_rate_max / 2 ** self.stream["STREAMRATE"],
+                    self.stream_samples,
+                    self.stream["STREAMCH"],
+                    self.stream["STREAMFMT"],
+                    PACKET_SIZES[self.stream["STREAMPCKT"]],
+                    rate_code=self.stream["STREAMRATE"],
+                )
+                self.replayer.start()
+
+    def stream_samples(self, count):
+        # The signal changes slowly next to a packet, every sample of one gets the same value
+        x, y, r, theta = self.signal()
+        columns = {"X": x, "Y": y, "R": r, "theta": theta}
+        row = [columns[name] for name in STREAM_COLUMNS[self.stream["STREAMCH"]]]
+        full_scale = SENSITIVITIES[self.settings["SCAL"]]
+        if self.settings["IVMD"]:
+            full_scale *= 1e-6
+        return np.tile(row, (count, 1)), full_scale
+
+    def capture_columns(self):
+        return {0: 1, 1: 2, 2: 2, 3: 4}[self.capture["CAPTURECFG"]]
+
+    def capture_data(self):
+        if self.capture_start is None:
+            return np.empty(0, dtype=np.float32)
+        rate = self.capture_rate_max / 2 ** self.capture["CAPTURERATE"]
+        end = self.capture_stop or time.monotonic()
+        columns = self.capture_columns()
+        limit = self.capture["CAPTURELEN"] * 1024 // (4 * columns)
+        n = min(int((end - self.capture_start) * rate), limit)
+        t = self.capture_start + np.arange(n) / rate
+        x = 1e-6 * np.cos(t)
+        y = 1e-6 * np.sin(t)
+        signal = {
+            0: [x],
+            1: [x, y],
+            2: [np.hypot(x, y), np.degrees(np.arctan2(y, x))],
+            3: [x, y, np.hypot(x, y), np.degrees(np.arctan2(y, x))],
+        }[self.capture["CAPTURECFG"]]
+        return np.column_stack(signal).astype(np.float32).ravel()
+
+    def query_binary_values(
+        self, command, datatype="f", is_big_endian=False, container=list
+    ):
+        self._wait()
+        self.query_count += 1
+        offset, size = (int(arg) for arg in command.split("?")[1].split(","))
+        data = self.capture_data()[offset * 256 : (offset + size) * 256]
+        return container(data)
+
+    def query(self, command):
+        self._wait()
+        self.query_count += 1
+        name, _, args = command.strip().partition(" ")
+        name = name.upper().rstrip("?")
+        signal = self.signal()
+        if name == "OUTP":
+            return f"{signal[int(args)]:.10e}"
+        if name == "SNAP":
+            return ",".join(f"{signal[int(arg)]:.10e}" for arg in args.split(","))
+        if name == "SNAPD":
+            return ",".join(
+                f"{signal[self.data_channels[channel]]:.10e}" for channel in range(4)
+            )
+        if name in self.settings:
+            return f"{self.settings[name]}"
+        if name == "CAPTURERATEMAX":
+            return f"{self.capture_rate_max}"
+        if name == "CAPTURERATE":
+            return f"{self.capture_rate_max / 2 ** self.capture['CAPTURERATE']}"
+        if name == "CAPTUREBYTES":
+            return f"{self.capture_data().size * 4}"
+        if name == "STREAMRATEMAX":
+            return f"{self.stream_rate_max}"
+        if name in self.stream:
+            return f"{self.stream[name]}"
+        raise Exception(f"Simulated SR865A: unsupported query {command}")
+
+    def close(self):
+        if self.replayer is not None:
+            self.replayer.stop()
+
+
+class UdpReplayer:
+    """
+    Sends an SR865A style UDP data stream to a local port from a thread,
+    for testing the ingest without the instrument. samples(count) returns
+    count rows in volts (or amps) and degrees plus the full scale used for
+    int16 packets. A fraction drop of the packets is skipped, to exercise
+    the dropped packet detection.
+    """
+
+    def __init__(
+        self,
+        port,
+        rate,
+        samples,
+        channels=3,
+        fmt=0,
+        packet_size=1024,
+        drop=0.0,
+        host="127.0.0.1",
+        rate_code=0,
+    ):
+        self.address = (host, port)
+        self.rate = rate
+        self.samples = samples
+        self.channels = channels
+        self.fmt = fmt
+        self.rate_code = rate_code
+        self.drop = drop
+        columns = len(STREAM_COLUMNS[channels])
+        self.per_packet = packet_size // ((2 if fmt else 4) * columns)
+        self.sent = 0
+        self.skipped = 0
+        self.running = False
+        self.thread = None
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def packet(self, counter):
+        values, full_scale = self.samples(self.per_packet)
+        status = 0
+        if self.fmt:
+            names = STREAM_COLUMNS[self.channels]
+            scale = np.array(
+                [180.0 if name == "theta" else full_scale for name in names]
+            )
+            values = np.clip(
+                np.round(values / scale * INT16_FULL_SCALE),
+                -INT16_FULL_SCALE,
+                INT16_FULL_SCALE - 1,
+            ).astype(np.int16)
+            if np.any(np.abs(values[:, [n != "theta" for n in names]]) >= 32767):
+                status = OVERLOAD_BIT
+        else:
+            values = values.astype(np.float32)
+        return encode_packet(
+            counter, self.channels + 4 * self.fmt, self.rate_code, values, status=status
+        )
+
+    def run(self):
+        interval = self.per_packet / self.rate
+        next_send = time.monotonic()
+        counter = 0
+        while self.running:
+            next_send += interval
+            time.sleep(max(next_send - time.monotonic(), 0))
+            data = self.packet(counter)
+            counter = (counter + 1) & 0xFF
+            if self.drop and random.random() < self.drop:
+                self.skipped += 1
+                continue
+            self.socket.sendto(data, self.address)
+            self.sent += 1
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+
+
+class SimulatedBK5493CResource:
+    """
+    Stand-in for the pyvisa resource of a BK Precision 5493C returning a
+    slowly drifting DC voltage, or the voltage returned by source. Every
+    reading takes its integration time of nplc power line cycles on top
+    of the bus latency.
+    """
+
+    def __init__(self, latency=0.01, jitter=0.0, line_frequency=60.0, source=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.source = source
+        self.line_frequency = line_frequency
+        self.timeout = 5000
+        self.query_count = 0
+        self.nplc = 1.0
+        self.sample_count = 1
+        self.readings = []
+
+    def _wait(self):
+        time.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+    def measure(self):
+        time.sleep(self.sample_count * self.nplc / self.line_frequency)
+        if self.source is not None:
+            level = self.source()
+        else:
+            level = 0.1 + 0.01 * math.sin(time.monotonic())
+        return [level + random.gauss(0, 1e-4) for _ in range(self.sample_count)]
+
+    def write(self, command):
+        self._wait()
+        name, _, args = command.strip().upper().partition(" ")
+        if name == "*RST" or name.startswith("CONF"):
+            self.nplc = 1.0
+            self.sample_count = 1
+        elif name.endswith(":NPLC"):
+            self.nplc = float(args)
+        elif name == "SAMP:COUN":
+            self.sample_count = int(args)
+        elif name == "INIT":
+            self.readings = self.measure()
+
+    def query(self, command):
+        self._wait()
+        self.query_count += 1
+        name, _, args = command.strip().upper().partition(" ")
+        if name == "READ?":
+            readings = self.measure()
+        elif name == "FETC?":
+            readings = self.readings
+        elif name == "DATA:REM?":
+            readings = self.readings[: int(args)]
+            self.readings = self.readings[int(args) :]
+        elif name == "*OPC?":
+            return "1"
+        else:
+            raise Exception(f"Simulated 5493C: unsupported query {command}")
+        return ",".join(f"{reading:.9f}" for reading in readings)
+
+    def query_ascii_values(self, command, container=list):
+        return container([float(value) for value in self.query(command).split(",")])
+
+    def close(self):
+        pass
+
+
+class SimulatedVelocityParams:
+    def __init__(self, max_velocity, acceleration):
+        self.MaxVelocity = max_velocity
+        self.Acceleration = acceleration
+
+
+class SimulatedHomingParams:
+    def __init__(self, velocity):
+        self.Velocity = velocity
+
+
+class SimulatedMotorLimits:
+    def __init__(self, minimum, maximum):
+        self.LengthMinimum = minimum
+        self.LengthMaximum = maximum
+
+
+class SimulatedStatus:
+    def __init__(self, homed):
+        self.IsHomed = homed
+
+
+class SimulatedChannel:
+    """
+    Kinesis-style brushless motor channel with a trapezoidal velocity
+    profile. MoveTo with a timeout blocks until the move ends, MoveTo
+    with timeout 0 returns immediately and IsDeviceBusy reports whether
+    the move is still running.
+    """
+
+    def __init__(
+        self, max_velocity=10.0, acceleration=10.0, position=0.0, travel=110.0
+    ):
+        self.velocity_params = SimulatedVelocityParams(max_velocity, acceleration)
+        self.homing_params = SimulatedHomingParams(max_velocity / 4)
+        self.AdvancedMotorLimits = SimulatedMotorLimits(0.0, travel)
+        self.DeviceID = "simulated"
+        self.start_position = position
+        self.target = position
+        self.move_start = time.monotonic()
+        self.move_duration = 0.0
+        self.accel_time = 0.0
+        self.peak_velocity = 0.0
+        self.homed = False
+
+    def plan_move(self, target):
+        start = self.DevicePosition
+        distance = abs(target - start)
+        velocity = float(self.velocity_params.MaxVelocity)
+        acceleration = float(self.velocity_params.Acceleration)
+        if distance < velocity**2 / acceleration:
+            self.accel_time = math.sqrt(distance / acceleration)
+            self.peak_velocity = acceleration * self.accel_time
+            self.move_duration = 2 * self.accel_time
+        else:
+            self.accel_time = velocity / acceleration
+            self.peak_velocity = velocity
+            self.move_duration = (
+                2 * self.accel_time + (distance - velocity**2 / acceleration) / velocity
+            )
+        self.start_position = start
+        self.target = target
+        self.move_start = time.monotonic()
+
+    @property
+    def DevicePosition(self):
+        t = min(time.monotonic() - self.move_start, self.move_duration)
+        acceleration = self.peak_velocity / self.accel_time if self.accel_time else 0.0
+        cruise = self.move_duration - 2 * self.accel_time
+        if t < self.accel_time:
+            travelled = acceleration * t**2 / 2
+        elif t < self.accel_time + cruise:
+            travelled = acceleration * self.accel_time**2 / 2 + self.peak_velocity * (
+                t - self.accel_time
+            )
+        else:
+            remaining = self.move_duration - t
+            total = abs(self.target - self.start_position)
+            travelled = total - acceleration * remaining**2 / 2
+        direction = 1.0 if self.target >= self.start_position else -1.0
+        return self.start_position + direction * travelled
+
+    @property
+    def IsDeviceBusy(self):
+        return time.monotonic() - self.move_start < self.move_duration
+
+    def MoveTo(self, position, timeout):
+        self.plan_move(float(position))
+        if timeout:
+            if self.move_duration * 1000 > timeout:
+                raise Exception("Simulated move timed out")
+            time.sleep(self.move_duration)
+
+    def Home(self, timeout):
+        self.homed = True
+        self.MoveTo(0.0, timeout)
+
+    @property
+    def Status(self):
+        return SimulatedStatus(self.homed and not self.IsDeviceBusy)
+
+    def GetVelocityParams(self):
+        return self.velocity_params
+
+    def SetVelocityParams(self, max_velocity, acceleration):
+        self.velocity_params = SimulatedVelocityParams(
+            float(max_velocity), float(acceleration)
+        )
+
+    def GetHomingParams(self):
+        return self.homing_params
+
+    def SetHomingVelocity(self, velocity):
+        self.homing_params = SimulatedHomingParams(float(velocity))
+
+    def StartPolling(self, interval):
+        pass
+
+    def StopPolling(self):
+        pass
+
+    def EnableDevice(self):
+        pass
+
+
+class SimulatedKinesisDevice:
+    IsConnected = True
+
+    def Disconnect(self):
+        pass
+
+
+class SimulatedBBD302(StageBase):
+    """
+    Two-axis stage with the ThorlabsBBD302 interface, backed by
+    SimulatedChannel kinematics instead of the Kinesis DLLs.
+    """
+
+    def __init__(self, channel_count=2, max_velocity=10.0, acceleration=10.0):
+        self.channel_count = channel_count
+        self.device = SimulatedKinesisDevice()
+        self.channel = {
+            channel_number: SimulatedChannel(max_velocity, acceleration)
+            for channel_number in range(1, channel_count + 1)
+        }
+        self.trace_channels()
+        print("---Connected to simulated stage")
+
+
+def stage_position(stage):
+    if callable(stage):
+        stage = stage()
+    return float(stage.channel[1].DevicePosition), float(
+        stage.channel[2].DevicePosition
+    )
+
+
+def feature_map(stage, centre=(0.7, 0.3), width=0.05, amplitude=1e-3):
+    """
+    Lock-in signal of a flat sample with one Gaussian feature, read at
+    the current position of a simulated stage.
+    """
+
+    def source():
+        x, y = stage_position(stage)
+        r = amplitude * math.exp(
+            -((x - centre[0]) ** 2 + (y - centre[1]) ** 2) / (2 * width**2)
+        )
+        return 1e-6 + r, 0.0
+
+    return source
+
+
+def stripes_map(stage, period=0.2, amplitude=1e-4):
+    """
+    Lock-in signal of a grating along X whose phase turns along Y.
+    """
+
+    def source():
+        x, y = stage_position(stage)
+        r = amplitude * (1 + math.cos(2 * math.pi * x / period)) / 2
+        phase = 2 * math.pi * y / (10 * period)
+        return r * math.cos(phase), r * math.sin(phase)
+
+    return source
+
+
+def tilt_map(stage, offset=0.1, slope=0.01):
+    """
+    Multimeter voltage rising linearly across the stage.
+    """
+
+    def source():
+        x, y = stage_position(stage)
+        return offset + slope * (x + y)
+
+    return source
+
+
+# Signal maps selectable by name, None keeps the time-drifting default
+LOCKIN_SIGNAL_MAPS = {"drift": None, "feature": feature_map, "stripes": stripes_map}
+MULTIMETER_SIGNAL_MAPS = {"drift": None, "tilt": tilt_map}
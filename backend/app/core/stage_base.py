@@ -0,0 +1,998 @@
+import time
+import numpy as np
+from app.models.state import global_state
+from app.models.stage import SettleParams, RetryParams, SweepParams
+from app.models.multimeter import BurstParams
+from app.models.lockin import AutoRangeParams
+from app.utils.file_utils import (
+    ScanWriter,
+    read_scan,
+    read_checkpoint,
+    write_checkpoint,
+    save_grid,
+    save_spectra,
+)
+from app.services.scan_buffer import ScanBuffer
+from app.services.scan_map import ScanMap
+from app.services.fly_scan import (
+    TimedSampler,
+    choose_sweep_velocity,
+    interpolate_positions,
+    sweep_range,
+    bin_samples,
+)
+from app.services.adaptive import QuadtreeRefiner
+from app.services.metrics import registry as metrics, TracedChannel
+from app.services.acquisition import acquire, AcquisitionStats
+from app.services.sweep import (
+    point_order,
+    spectrum_cube,
+    sweep_settle,
+    sweep_steps,
+)
+from app.services.settling import (
+    full_settle_time,
+    wait_for_settle,
+    summarize_settle_times,
+)
+from app.services.path_planner import (
+    POINT_STRATEGIES,
+    axis_points,
+    plan_grid,
+    order_points,
+)
+from app.services.scan_plan import build_plan, grid_axis
+
+# Seconds the busy and homed flags can lag behind a MoveTo or Home command
+BUSY_GRACE = 0.3
+
+
+def to_float(value):
+    return float(str(value))
+
+
+class StageBase:
+    """
+    Motion and scan logic shared by the Kinesis stage and its simulator.
+    Subclasses set up self.channel (channel number -> Kinesis-style
+    channel object) and convert positions with to_device.
+    """
+
+    def to_device(self, value):
+        return float(value)
+
+    def home_channel(self, channel_number):
+        try:
+            print(f"---Homing channel {channel_number}")
+            self.channel[channel_number].Home(60000)
+            time.sleep(1)
+        except Exception as e:
+            print(f"---Homing error: {e}")
+
+    def is_homed(self, channel_number):
+        try:
+            return bool(self.channel[channel_number].Status.IsHomed)
+        except Exception:
+            return False
+
+    def home_channels(
+        self, channel_numbers=None, force=False, timeout=60.0, poll_interval=0.05
+    ):
+        """
+        Home several channels at once, skipping the ones the controller
+        reports as homed already unless force. As in move_axes every Home
+        is started without blocking and the channels are polled; the homed
+        flag is only trusted after grace seconds, the time it takes to
+        clear once homing starts.
+        """
+        channel_numbers = list(channel_numbers or self.channel)
+        pending = []
+        for channel_number in channel_numbers:
+            if not force and self.is_homed(channel_number):
+                print(f"---Channel {channel_number} already homed")
+                continue
+            print(f"---Homing channel {channel_number}")
+            self.channel[channel_number].Home(0)
+            pending.append(channel_number)
+        started = time.monotonic()
+        while pending:
+            time.sleep(poll_interval)
+            elapsed = time.monotonic() - started
+            if elapsed > BUSY_GRACE:
+                pending = [
+                    channel_number
+                    for channel_number in pending
+                    if self.channel[channel_number].IsDeviceBusy
+                    or not self.is_homed(channel_number)
+                ]
+            if pending and elapsed > timeout:
+                raise Exception(f"Homing channels {pending} timed out after {timeout}s")
+        return time.monotonic() - started
+
+    def get_movement_params(self, channel_number):
+        try:
+            print(f"---Get channel {channel_number} params")
+            home_params = self.channel[channel_number].GetHomingParams()
+            vel_params = self.channel[channel_number].GetVelocityParams()
+            return home_params, vel_params
+        except Exception as e:
+            print(f"---Error: {e}")
+
+    def set_movement_params(
+        self, channel_number, homing_velocity, max_velocity, acceleration
+    ):
+        self.channel[channel_number].SetHomingVelocity(self.to_device(homing_velocity))
+        self.channel[channel_number].SetVelocityParams(
+            self.to_device(max_velocity), self.to_device(acceleration)
+        )
+
+    def trace_channels(self):
+        """
+        Time every channel call and property read into the metrics registry.
+        """
+        self.channel = {
+            channel_number: TracedChannel(channel, f"stage_ch{channel_number}")
+            for channel_number, channel in self.channel.items()
+        }
+
+    def move_axes(self, targets, timeout=60.0, tolerance=1e-3, poll_interval=0.005):
+        """
+        Move several channels at once: every move is started without
+        blocking (MoveTo with timeout 0), then IsDeviceBusy is polled until
+        all have stopped, so a diagonal move takes as long as its slowest
+        axis. targets maps channel number to position.
+        """
+        started = time.monotonic()
+        for channel_number, position in targets.items():
+            self.channel[channel_number].MoveTo(self.to_device(position), 0)
+        moving = dict(targets)
+        while moving:
+            elapsed = time.monotonic() - started
+            for channel_number, position in list(moving.items()):
+                if self.move_finished(channel_number, position, elapsed, tolerance):
+                    del moving[channel_number]
+            if not moving:
+                break
+            if elapsed > timeout:
+                error = Exception(f"Move to {targets} timed out after {timeout}s")
+                metrics.error("stage", "move_axes", error)
+                raise error
+            time.sleep(poll_interval)
+        elapsed = time.monotonic() - started
+        metrics.observe("stage", "move_axes", elapsed)
+        return elapsed
+
+    def move_finished(self, channel_number, target, elapsed, tolerance=1e-3):
+        """
+        Whether a move started elapsed seconds ago has ended. A channel
+        reporting not busy away from its target is only trusted after
+        BUSY_GRACE, since the busy flag lags behind the move command by up
+        to one polling period.
+        """
+        channel = self.channel[channel_number]
+        if channel.IsDeviceBusy:
+            return False
+        return (
+            abs(to_float(channel.DevicePosition) - target) <= tolerance
+            or elapsed > BUSY_GRACE
+        )
+
+    def travel_limits(self, channel_number):
+        """
+        Travel range of a channel from its motor limits; (0, None) when
+        the device does not report them.
+        """
+        try:
+            limits = self.channel[channel_number].AdvancedMotorLimits
+            return to_float(limits.LengthMinimum), to_float(limits.LengthMaximum)
+        except Exception:
+            return 0.0, None
+
+    def get_kinematics(self):
+        """
+        Max velocity and acceleration of each channel, as floats.
+        """
+        kinematics = {}
+        for channel_number in self.channel:
+            vel_params = self.channel[channel_number].GetVelocityParams()
+            kinematics[channel_number] = (
+                to_float(vel_params.MaxVelocity),
+                to_float(vel_params.Acceleration),
+            )
+        return kinematics
+
+    def plan_rectangle(
+        self,
+        x1,
+        y1,
+        x2,
+        y2,
+        x_steps,
+        y_steps,
+        x_step_size,
+        y_step_size,
+        movement_mode,
+        path_strategy="serpentine",
+        points=None,
+    ):
+        """
+        Expand the scan parameters into the ordered list of (x, y) points
+        to visit. An explicit point list is ordered with one of the point
+        strategies, otherwise the rectangle grid with a grid strategy.
+        """
+        if points is not None:
+            if path_strategy not in POINT_STRATEGIES:
+                path_strategy = "2opt"
+            start = (
+                to_float(self.channel[1].DevicePosition),
+                to_float(self.channel[2].DevicePosition),
+            )
+            return order_points(
+                points, path_strategy, self.get_kinematics(), start, simultaneous=True
+            )
+        xs, _ = grid_axis(x1, x2, x_steps, x_step_size, movement_mode, "x")
+        ys, _ = grid_axis(y1, y2, y_steps, y_step_size, movement_mode, "y")
+        return plan_grid(xs, ys, path_strategy)
+
+    def plan_scan(self, params):
+        """
+        ScanPlan of RectangleParams from the current position, channel
+        kinematics and lock-in filter. Scans started with it visit
+        exactly its points.
+        """
+        start = (
+            to_float(self.channel[1].DevicePosition),
+            to_float(self.channel[2].DevicePosition),
+        )
+        return build_plan(
+            params,
+            self.get_kinematics(),
+            start,
+            global_state.lockin.state,
+            self.travel_limits(1),
+        )
+
+    def move_in_rectangle(
+        self,
+        x1,
+        y1,
+        x2,
+        y2,
+        x_steps,
+        y_steps,
+        x_step_size,
+        y_step_size,
+        movement_mode,
+        delay,
+        acquisition_mode="poll",
+        capture_rate=None,
+        path_strategy="serpentine",
+        points=None,
+        settle=None,
+        job=None,
+        retry=None,
+        multimeter=None,
+        auto_range=None,
+        scan_plan=None,
+        sweep=None,
+    ):
+        """
+        Visit the planned points and record the instruments at each one.
+        Without settle parameters every point waits a fixed delay,
+        otherwise the lock-in output is watched until it has settled.
+        A ScanJob, if given, is checkpointed before every point. Given a
+        ScanPlan, its points are visited instead of expanding the grid.
+        With SweepParams every point records a spectrum, one record per
+        reference frequency, and the spectra are saved as spectra.npz.
+        """
+        if sweep is not None:
+            settle = sweep_settle(settle)
+        if scan_plan is not None:
+            plan = list(scan_plan.points)
+        else:
+            plan = self.plan_rectangle(
+                x1,
+                y1,
+                x2,
+                y2,
+                x_steps,
+                y_steps,
+                x_step_size,
+                y_step_size,
+                movement_mode,
+                path_strategy,
+                points,
+            )
+        settings = {
+            "delay": 1 if delay is None else delay,
+            "acquisition_mode": acquisition_mode,
+            "capture_rate": capture_rate,
+            "path_strategy": path_strategy,
+            "settle": settle.model_dump() if settle is not None else None,
+            "retry": retry.model_dump() if retry is not None else None,
+            "multimeter": multimeter.model_dump() if multimeter is not None else None,
+            "auto_range": auto_range.model_dump() if auto_range is not None else None,
+            "sweep": sweep.model_dump() if sweep is not None else None,
+        }
+        summary = self.run_scan(plan, settings, job=job)
+        if sweep is not None:
+            summary["spectra"] = self.save_spectra(summary["output"], plan, sweep)
+        return summary
+
+    def save_spectra(self, path, plan, sweep):
+        """
+        Arrange the records of a finished sweep scan into spectra.npz, on
+        the grid when the plan covers one, otherwise per point.
+        """
+        xs = sorted({x for x, _ in plan})
+        ys = sorted({y for _, y in plan})
+        if len(xs) * len(ys) != len(plan):
+            xs = ys = None
+        frequencies = np.asarray(sweep.frequencies, dtype=np.float64)
+        amplitudes = np.full(len(frequencies), np.nan)
+        if sweep.amplitudes is not None:
+            amplitudes[:] = sweep.amplitudes
+        cubes = spectrum_cube(
+            global_state.scan_buffer.view(), plan, xs, ys, len(frequencies)
+        )
+        if xs is not None:
+            axes = {"x": np.asarray(xs), "y": np.asarray(ys)}
+        else:
+            axes = {"points": np.asarray(plan, dtype=np.float64)}
+        return save_spectra(path, frequencies, amplitudes, axes, cubes)
+
+    def adaptive_scan(
+        self,
+        x1,
+        y1,
+        x2,
+        y2,
+        x_steps,
+        y_steps,
+        x_step_size,
+        y_step_size,
+        movement_mode,
+        delay,
+        adaptive,
+        acquisition_mode="poll",
+        capture_rate=None,
+        settle=None,
+        job=None,
+        retry=None,
+        multimeter=None,
+        auto_range=None,
+        scan_plan=None,
+    ):
+        """
+        Scan the rectangle grid as a coarse level and refine it where the
+        signal changes (see QuadtreeRefiner). The point cloud is written
+        like any other scan, with the level of each point, and is
+        resampled onto the finest grid reached as grid.npz. A ScanPlan,
+        if given, supplies the coarse grid.
+        """
+        if scan_plan is not None:
+            xs, ys = scan_plan.xs, scan_plan.ys
+        else:
+            xs, _ = grid_axis(x1, x2, x_steps, x_step_size, movement_mode, "x")
+            ys, _ = grid_axis(y1, y2, y_steps, y_step_size, movement_mode, "y")
+        if len(xs) < 2 or len(ys) < 2:
+            raise Exception("An adaptive scan needs at least a 2 x 2 coarse grid")
+        refiner = QuadtreeRefiner(xs, ys, adaptive, self.get_kinematics())
+        plan = list(refiner.coarse)
+        settings = {
+            "delay": 1 if delay is None else delay,
+            "acquisition_mode": acquisition_mode,
+            "capture_rate": capture_rate,
+            "path_strategy": "adaptive",
+            "settle": settle.model_dump() if settle is not None else None,
+            "retry": retry.model_dump() if retry is not None else None,
+            "multimeter": multimeter.model_dump() if multimeter is not None else None,
+            "auto_range": auto_range.model_dump() if auto_range is not None else None,
+            "adaptive": adaptive.model_dump(),
+        }
+        # The live map has the resolution of the deepest level the scan may reach
+        divisions = 2**adaptive.max_depth
+        map_axes = (
+            axis_points(xs[0], xs[-1], (xs[1] - xs[0]) / divisions),
+            axis_points(ys[0], ys[-1], (ys[1] - ys[0]) / divisions),
+        )
+        summary = self.run_scan(
+            plan, settings, job=job, refiner=refiner, map_axes=map_axes
+        )
+        refiner.finish()
+        grid_xs, grid_ys, grids = refiner.resample(plan, global_state.scan_buffer)
+        summary["grid"] = save_grid(summary["output"], grid_xs, grid_ys, grids)
+        summary["levels"] = refiner.level_counts()
+        summary["uniform_points"] = len(grid_xs) * len(grid_ys)
+        print(
+            f"---Adaptive scan: {len(plan)} points instead of {summary['uniform_points']} "
+            f"on the uniform grid, per level {summary['levels']}"
+        )
+        return summary
+
+    def resume_scan(self, path, job=None, retry=None, tolerance=0.01):
+        """
+        Continue an interrupted scan from its checkpoint. The points whose
+        records already reached disk are skipped, both channels are
+        re-homed and the position is validated at the first missing
+        point, and the new records are appended to the same output.
+        """
+        checkpoint = read_checkpoint(path)
+        if checkpoint["status"] == "completed":
+            raise Exception(f"Scan {path} is already complete")
+        settings = checkpoint["settings"]
+        if retry is not None:
+            settings["retry"] = retry.model_dump()
+        plan = [tuple(point) for point in checkpoint["plan"]]
+        existing = read_scan(path)
+        completed = set(existing["point_index"].tolist())
+        remaining = [index for index in range(len(plan)) if index not in completed]
+        print(
+            f"---Resuming {path}: {len(completed)} of {len(plan)} points done, {len(remaining)} left"
+        )
+        if remaining:
+            self.rehome_and_validate(plan[remaining[0]], tolerance)
+        summary = self.run_scan(
+            plan,
+            settings,
+            job=job,
+            output=path,
+            completed=completed,
+            existing=existing,
+            levels=checkpoint.get("levels"),
+        )
+        if settings.get("sweep"):
+            summary["spectra"] = self.save_spectra(
+                path, plan, SweepParams(**settings["sweep"])
+            )
+        return summary
+
+    def rehome_and_validate(self, point, tolerance=0.01):
+        self.home_channels(force=True)
+        self.move_axes({1: point[0], 2: point[1]})
+        for channel_number, target in zip((1, 2), point):
+            position = to_float(self.channel[channel_number].DevicePosition)
+            if abs(position - target) > tolerance:
+                raise Exception(
+                    f"Channel {channel_number} at {position} instead of {target} after re-homing"
+                )
+
+    def run_scan(
+        self,
+        plan,
+        settings,
+        job=None,
+        output=None,
+        completed=None,
+        existing=None,
+        levels=None,
+        refiner=None,
+        map_axes=None,
+    ):
+        """
+        Acquire every point of plan not in completed. The plan and scan
+        settings are written to checkpoint.json next to the data, and every
+        record carries its point index, so the records on disk are the
+        list of completed points if the scan dies. A refiner (adaptive
+        scans) is asked for more points each time the plan runs out.
+        """
+        start = time.time()
+        sample_count = 0
+        settle_times = []
+        stats = AcquisitionStats()
+        completed = completed or set()
+        delay = settings["delay"]
+        acquisition_mode = settings["acquisition_mode"]
+        capture_rate = settings["capture_rate"]
+        path_strategy = settings["path_strategy"]
+        settle = SettleParams(**settings["settle"]) if settings["settle"] else None
+        retry = RetryParams(**settings["retry"]) if settings["retry"] else RetryParams()
+        if acquisition_mode == "stream" and global_state.lockin_stream is None:
+            raise Exception("Start the lock-in stream before a stream mode scan")
+        sweep = settings.get("sweep")
+        steps = None
+        if sweep:
+            sweep = SweepParams(**sweep)
+            steps = sweep_steps(sweep)
+            if acquisition_mode == "capture":
+                raise Exception("Sweeps cannot use capture mode, use poll or stream")
+        burst = settings.get("multimeter")
+        burst = BurstParams(**burst) if burst else None
+        # The lock-in ranges itself while the scan runs, as it did before afterwards
+        auto_range = settings.get("auto_range")
+        previous_auto_range = global_state.lockin.auto_range
+        if auto_range:
+            global_state.lockin.configure_auto_range(AutoRangeParams(**auto_range))
+        timing_start = metrics.snapshot()
+        buffer = ScanBuffer(len(plan) * (len(steps) if steps else 1))
+        if existing is not None:
+            buffer.extend(existing)
+        global_state.scan_buffer = buffer
+        scan_map = ScanMap(plan, *(map_axes or (None, None)))
+        scan_map.update_rows(buffer.view())
+        global_state.scan_map = scan_map
+        writer = ScanWriter(
+            output, epoch_offset_ns=buffer.epoch_offset_ns, resume=output is not None
+        )
+        if burst is not None:
+            global_state.multimeter.hold_burst()
+            global_state.multimeter.configure_burst(
+                burst.samples, burst.trigger_source, burst.nplc
+            )
+        levels = list(levels) if levels is not None else [0] * len(plan)
+        checkpoint = {
+            "plan": [list(point) for point in plan],
+            "levels": levels,
+            "settings": settings,
+            "instruments": {
+                "lockin": global_state.lockin.state.model_dump(),
+                "multimeter": global_state.multimeter.state.model_dump(),
+            },
+            "status": "running",
+        }
+        write_checkpoint(writer.path, checkpoint)
+        if job is not None:
+            job.output = writer.path
+        # A resumed scan keeps the time base of the original records
+        clock_shift = buffer.epoch_offset_ns - writer.epoch_offset_ns
+        buffer.epoch_offset_ns = writer.epoch_offset_ns
+        failed = []
+        try:
+            # Points sharing a y position form a segment, the capture buffer is armed once per segment
+            segment = []
+            windows = []
+            current_y = None
+            next_index = 0
+            while next_index < len(plan):
+                for point_index in range(next_index, len(plan)):
+                    x, y = plan[point_index]
+                    if point_index in completed:
+                        continue
+                    if job is not None:
+                        job.checkpoint(len(completed) + sample_count, len(plan))
+                    if y != current_y:
+                        if acquisition_mode == "capture" and segment:
+                            self.read_capture_segment(segment, windows, buffer, writer)
+                            segment, windows = [], []
+                        if acquisition_mode == "capture":
+                            global_state.lockin.arm_capture(
+                                capture_rate
+                                or self.capture_rate_for_row(
+                                    plan, point_index, delay, settle
+                                )
+                            )
+                    if steps:
+                        point_steps = point_order(steps, sweep.order, point_index)
+                    for attempt in range(1, retry.max_attempts + 1):
+                        try:
+                            # On a row change both axes travel together
+                            targets = {1: x} if y == current_y else {1: x, 2: y}
+                            if steps:
+                                move_time = self.move_for_sweep(targets, point_steps[0])
+                            else:
+                                move_time = self.move_axes(targets)
+                            current_y = y
+                            stats.move.append(move_time)
+                            if steps:
+                                records = self.measure_spectrum(
+                                    point_steps,
+                                    delay,
+                                    acquisition_mode,
+                                    settle,
+                                    stats,
+                                    burst,
+                                )
+                            else:
+                                records = [
+                                    self.measure_point(
+                                        delay, acquisition_mode, settle, stats, burst
+                                    )
+                                ]
+                            break
+                        except Exception as e:
+                            print(
+                                f"---Point {point_index} attempt {attempt}/{retry.max_attempts} failed: {e}"
+                            )
+                            if attempt == retry.max_attempts:
+                                if retry.on_failure == "skip":
+                                    records = None
+                                    break
+                                raise
+                            metrics.increment("tops_scan_retries_total")
+                            time.sleep(retry.backoff * attempt)
+                            current_y = None
+                            if retry.rehome_on_failure:
+                                self.rehome_and_validate((x, y))
+                    if records is None:
+                        metrics.increment("tops_scan_failed_points_total")
+                        failed.append(point_index)
+                        continue
+                    first = len(buffer)
+                    for values, settle_time, window in records:
+                        values["point_index"] = point_index
+                        values["level"] = levels[point_index]
+                        values["timestamp_ns"] += clock_shift
+                        if settle_time is not None:
+                            settle_times.append(settle_time)
+                        if acquisition_mode == "capture":
+                            windows.append(window)
+                            segment.append(buffer.append(values))
+                        else:
+                            buffer.append(values)
+                        metrics.increment("tops_scan_samples_total")
+                    if acquisition_mode != "capture":
+                        # A spectrum reaches disk whole, a resumed sweep never finds half a point
+                        writer.append(buffer.view(first, len(buffer)))
+                        scan_map.update_rows(buffer.view(first, len(buffer)))
+                    sample_count += 1
+                next_index = len(plan)
+                if acquisition_mode == "capture" and segment:
+                    self.read_capture_segment(segment, windows, buffer, writer)
+                    segment, windows = [], []
+                    current_y = None
+                if refiner is not None:
+                    new_points = refiner.extend(plan, buffer)
+                    plan.extend(new_points)
+                    levels.extend(refiner.level(x, y) for x, y in new_points)
+                    checkpoint["plan"] = [list(point) for point in plan]
+                    write_checkpoint(writer.path, checkpoint)
+            checkpoint["status"] = "completed" if not failed else "incomplete"
+        finally:
+            writer.close()
+            write_checkpoint(writer.path, checkpoint)
+            if burst is not None:
+                global_state.multimeter.hold_burst(False)
+            if auto_range:
+                global_state.lockin.configure_auto_range(previous_auto_range)
+            if job is not None:
+                job.points_done = len(completed) + sample_count
+        elapsed = time.time() - start
+        print(
+            f"---Logged {sample_count} samples during {path_strategy} scan in {elapsed}s time\n{sample_count / elapsed} samples/second"
+        )
+        summary = {
+            "samples": sample_count,
+            "resumed_from": len(completed),
+            "failed_points": failed,
+            "elapsed": elapsed,
+            "samples_per_second": sample_count / elapsed,
+            "settle_times": settle_times,
+            "settle_time_stats": summarize_settle_times(settle_times),
+            "acquisition": stats.summary(),
+            "timing": metrics.report(timing_start),
+            "output": writer.path,
+        }
+        if settle_times:
+            print(
+                f"---Settle time per point: min {summary['settle_time_stats']['min']:.3f}s, "
+                f"mean {summary['settle_time_stats']['mean']:.3f}s, max {summary['settle_time_stats']['max']:.3f}s"
+            )
+        if summary["acquisition"]:
+            acquisition = summary["acquisition"]
+            print(
+                f"---Acquisition per point: {acquisition['total']['mean'] * 1000:.1f}ms "
+                f"(sequential {acquisition['sequential']['mean'] * 1000:.1f}ms), "
+                f"max skew {acquisition['skew']['max'] * 1000:.1f}ms"
+            )
+        return summary
+
+    def capture_rate_for_row(self, plan, start, delay, settle):
+        """
+        Capture rate at which the lock-in buffer lasts for the row of plan
+        starting at index start: its expected duration from the measured
+        move and acquisition times, with a margin of two.
+        """
+        y = plan[start][1]
+        count = 1
+        while start + count < len(plan) and plan[start + count][1] == y:
+            count += 1
+        per_point = (
+            delay
+            + (metrics.mean("stage", "move_axes") or 0.5)
+            + (metrics.mean("scan", "acquire") or 0.05)
+        )
+        if settle is not None:
+            per_point += full_settle_time(global_state.lockin.state)
+        return global_state.lockin.capture_rate_for(2 * count * per_point)
+
+    def move_for_sweep(self, targets, step):
+        """
+        Move to the next point of a sweep while the lock-in switches to
+        its first reference step, so only the reference write overlaps the
+        travel. Settling is not shortened: the signal at the new point only
+        exists once the move ends, and measure_spectrum settles in full from
+        there. When the reference is already right, as with the serpentine
+        order, nothing is written.
+        """
+        _, frequency, amplitude = step
+        state = global_state.lockin.state
+        if frequency == state.frequency and amplitude in (None, state.amplitude):
+            return self.move_axes(targets)
+        results, _ = acquire(
+            {"lockin": (global_state.lockin, "set_reference", frequency, amplitude)},
+            {"move": lambda: self.move_axes(targets)},
+        )
+        return results["move"]
+
+    def measure_spectrum(
+        self, steps, delay, acquisition_mode, settle, stats=None, burst=None
+    ):
+        """
+        Record the instruments at every reference step of a sweep at the
+        current point. Returns one (record, settle time, window) per step.
+        """
+        records = []
+        for index, frequency, amplitude in steps:
+            state = global_state.lockin.state
+            if frequency != state.frequency or amplitude not in (
+                None,
+                state.amplitude,
+            ):
+                global_state.lockin.set_reference(frequency, amplitude)
+            values, settle_time, window = self.measure_point(
+                delay, acquisition_mode, settle, stats, burst
+            )
+            values["sweep_step"] = index
+            records.append((values, settle_time, window))
+        return records
+
+    def measure_point(self, delay, acquisition_mode, settle, stats=None, burst=None):
+        """
+        Record the instruments at the current point. Returns the record,
+        the settle time (or None) and, in capture and stream modes, the
+        dwell window whose lock-in samples belong to this point.
+        """
+        settle_time = None
+        window = None
+        if settle is not None:
+            with metrics.timer("scan", "settle"):
+                snapshot, settle_time = wait_for_settle(global_state.lockin, settle)
+                if global_state.lockin.auto_range is not None:
+                    # A range change disturbs the output, settle again on the new range
+                    for _ in range(global_state.lockin.auto_range.max_steps):
+                        if not global_state.lockin.track_range(snapshot[2]):
+                            break
+                        snapshot, more = wait_for_settle(global_state.lockin, settle)
+                        settle_time += more
+        # In capture and stream modes the lock-in records on its own, only
+        # remember the dwell window of this point
+        windowed = acquisition_mode in ("capture", "stream")
+        if windowed:
+            window_start = time.monotonic()
+        # The instruments are independent, read them all at once
+        if burst is not None:
+            reads = {
+                "multimeter": (
+                    global_state.multimeter,
+                    "measure_burst",
+                    burst.samples,
+                    burst.trigger_source,
+                )
+            }
+        else:
+            reads = {"multimeter": (global_state.multimeter, "read_value")}
+        if not windowed and settle is None:
+            reads["lockin"] = (global_state.lockin, "read_values")
+        with metrics.timer("scan", "acquire"):
+            results, timing = acquire(reads, {"stage": self.read_positions})
+        if stats is not None:
+            stats.record(timing)
+        if windowed:
+            values = {}
+        elif settle is not None:
+            values = global_state.lockin.format_values(*snapshot)
+        else:
+            values = results["lockin"]
+        if settle is not None:
+            values["settle_time"] = settle_time
+        values["timestamp_ns"] = timing["timestamp_ns"]
+        values["positionX"], values["positionY"] = results["stage"]
+        if burst is not None:
+            voltage = results["multimeter"] or {}
+            values["voltage"] = voltage.get("mean")
+            values["voltage_std"] = voltage.get("std")
+        else:
+            values["voltage"] = results["multimeter"]
+        print(f"---Current position: ({values['positionX']}, {values['positionY']})")
+        if windowed or settle is None:
+            time.sleep(delay)
+        if windowed:
+            window = (window_start, time.monotonic())
+        if acquisition_mode == "stream":
+            snapshot, _ = global_state.lockin_stream.average(*window)
+            values.update(global_state.lockin.format_values(*snapshot))
+        return values, settle_time, window
+
+    def read_positions(self):
+        return self.channel[1].DevicePosition, self.channel[2].DevicePosition
+
+    def read_capture_segment(self, segment, windows, buffer, writer):
+        global_state.lockin.stop_capture()
+        capture = global_state.lockin.read_capture()
+        for index, lockin_values in zip(
+            segment, global_state.lockin.average_capture(capture, windows)
+        ):
+            buffer.set(index, lockin_values)
+        writer.append(buffer.view(segment[0], segment[-1] + 1))
+        global_state.scan_map.update_rows(buffer.view(segment[0], segment[-1] + 1))
+
+    def fly_scan_rectangle(
+        self,
+        x1,
+        y1,
+        x2,
+        y2,
+        x_steps,
+        y_steps,
+        x_step_size,
+        y_step_size,
+        movement_mode,
+        acquisition_mode="poll",
+        capture_rate=None,
+        path_strategy="serpentine",
+        position_poll_ms=20,
+        job=None,
+        scan_plan=None,
+    ):
+        """
+        Sweep X at constant velocity along each row while the instruments
+        record timestamped samples, then place every sample by time
+        interpolation of the logged X positions and bin it onto the grid.
+        With the serpentine strategy every other row is swept backwards.
+        A ScanJob, if given, is checkpointed before every row. A ScanPlan,
+        if given, supplies the grid.
+        """
+        start = time.time()
+        timing_start = metrics.snapshot()
+        if scan_plan is not None:
+            xs, ys = scan_plan.xs, scan_plan.ys
+        else:
+            xs, _ = grid_axis(x1, x2, x_steps, x_step_size, movement_mode, "x")
+            ys, _ = grid_axis(y1, y2, y_steps, y_step_size, movement_mode, "y")
+        if len(xs) > 1:
+            x_step_size = float(xs[1] - xs[0])
+        max_velocity, acceleration = self.get_kinematics()[1]
+        lockin = global_state.lockin
+        velocity, run_up = choose_sweep_velocity(
+            x_step_size, lockin.state.time_constant, max_velocity, acceleration
+        )
+        sweep_start, sweep_end, clamped = sweep_range(
+            xs, x_step_size, run_up, self.travel_limits(1)
+        )
+        if clamped:
+            print("---Fly scan: run-up cut short by the travel limits")
+        if acquisition_mode == "capture" and capture_rate is None:
+            # Aim for at least 20 lock-in samples per grid cell
+            capture_rate = 20 * velocity / x_step_size
+        print(
+            f"---Fly scan: {len(xs)}x{len(ys)} grid, sweep velocity {velocity:.4f}, run-up {run_up:.4f}"
+        )
+        buffer = ScanBuffer(len(xs) * len(ys))
+        global_state.scan_buffer = buffer
+        scan_map = ScanMap(xs=xs, ys=ys)
+        global_state.scan_map = scan_map
+        writer = ScanWriter(epoch_offset_ns=buffer.epoch_offset_ns)
+        if job is not None:
+            job.output = writer.path
+        self.channel[1].StopPolling()
+        self.channel[1].StartPolling(position_poll_ms)
+        try:
+            for row, y in enumerate(ys):
+                if job is not None:
+                    job.checkpoint(len(buffer), len(xs) * len(ys))
+                forward = path_strategy != "serpentine" or row % 2 == 0
+                begin, end = (
+                    (sweep_start, sweep_end) if forward else (sweep_end, sweep_start)
+                )
+                self.move_axes({1: begin, 2: y})
+                self.channel[1].SetVelocityParams(
+                    self.to_device(velocity), self.to_device(acceleration)
+                )
+                position_log = ([], [])
+                lockin_log = ([], [], [], [], [])
+                if acquisition_mode == "capture":
+                    lockin.arm_capture(capture_rate)
+                self.channel[1].MoveTo(self.to_device(end), 0)
+                sweep_started = time.monotonic()
+                # The multimeter is read on its own thread, between position reads only the lock-in is
+                sampler = TimedSampler(
+                    global_state.multimeter.read_value, position_poll_ms / 1000
+                )
+                try:
+                    while True:
+                        position_log[0].append(time.monotonic())
+                        position_log[1].append(to_float(self.channel[1].DevicePosition))
+                        reached = (
+                            position_log[1][-1] >= end
+                            if forward
+                            else position_log[1][-1] <= end
+                        )
+                        if reached or self.move_finished(
+                            1, end, time.monotonic() - sweep_started
+                        ):
+                            break
+                        if acquisition_mode != "capture":
+                            t = time.monotonic()
+                            x, y_value, r, theta = lockin.read_snapshot()
+                            for log, value in zip(
+                                lockin_log, (t, x, y_value, r, theta)
+                            ):
+                                log.append(value)
+                        time.sleep(position_poll_ms / 1000)
+                finally:
+                    voltage_log = sampler.stop()
+                if acquisition_mode == "capture":
+                    lockin.stop_capture()
+                    capture = lockin.read_capture()
+                    lockin_log = (
+                        capture["timestamp"],
+                        capture["X"],
+                        capture["Y"],
+                        capture["R"],
+                        capture["theta"],
+                    )
+                self.channel[1].SetVelocityParams(
+                    self.to_device(max_velocity), self.to_device(acceleration)
+                )
+                sample_x = interpolate_positions(lockin_log[0], *position_log)
+                binned = [
+                    bin_samples(sample_x, values, xs)[0] for values in lockin_log[1:]
+                ]
+                voltage_x = interpolate_positions(voltage_log[0], *position_log)
+                voltages, _ = bin_samples(voltage_x, voltage_log[1], xs)
+                timestamp = time.monotonic_ns()
+                first = len(buffer)
+                for i, x in enumerate(xs):
+                    values = lockin.format_values(
+                        binned[0][i], binned[1][i], binned[2][i], binned[3][i]
+                    )
+                    values["timestamp_ns"] = timestamp
+                    values["positionX"] = float(x)
+                    values["positionY"] = to_float(self.channel[2].DevicePosition)
+                    values["voltage"] = voltages[i]
+                    buffer.append(values)
+                writer.append(buffer.view(first))
+                scan_map.update_rows(buffer.view(first))
+        finally:
+            writer.close()
+            if job is not None:
+                job.points_done = len(buffer)
+            self.channel[1].SetVelocityParams(
+                self.to_device(max_velocity), self.to_device(acceleration)
+            )
+            self.channel[1].StopPolling()
+            self.channel[1].StartPolling(250)
+        elapsed = time.time() - start
+        print(
+            f"---Logged {len(xs) * len(ys)} grid points during fly scan in {elapsed}s time\n{len(xs) * len(ys) / elapsed} samples/second"
+        )
+        return {
+            "samples": len(xs) * len(ys),
+            "elapsed": elapsed,
+            "samples_per_second": len(xs) * len(ys) / elapsed,
+            "timing": metrics.report(timing_start),
+            "output": writer.path,
+        }
+
+    def read_position_values(self):
+        try:
+            x, y = self.read_positions()
+            return {"x": to_float(x), "y": to_float(y)}
+        except Exception as e:
+            print(f"Error reading from stage: {e}")
+            return None
+
+    def read_values(self):
+        try:
+            x = self.channel[1].DevicePosition
+            y = self.channel[2].DevicePosition
+            return {"x": f"{x}", "y": f"{y}"}
+        except Exception as e:
+            print(f"Error reading from stage: {e}")
+            return None
+
+    def move(self, x, y):
+        try:
+            self.move_axes({1: x, 2: y})
+        except Exception as e:
+            print(f"---Error in moving: {e}")
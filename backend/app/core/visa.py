@@ -0,0 +1,91 @@
+import json
+import os
+import threading
+import pyvisa
+
+# Resource names found by earlier runs, keyed by the serial or ID pattern
+# they were searched for; list_resources() probes every interface and can
+# take many seconds, so it only runs when a cached name fails to open
+CACHE_PATH = os.environ.get("VISA_CACHE", "visa_resources.json")
+
+_lock = threading.Lock()
+_resource_manager = None
+_resources = None
+
+
+def resource_manager():
+    """
+    The ResourceManager shared by every instrument of the process.
+    """
+    global _resource_manager
+    with _lock:
+        if _resource_manager is None:
+            _resource_manager = pyvisa.ResourceManager()
+        return _resource_manager
+
+
+def read_cache():
+    try:
+        with open(CACHE_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_cache(cache):
+    try:
+        with open(CACHE_PATH, "w") as f:
+            json.dump(cache, f, indent=2)
+    except OSError as e:
+        print(f"---Could not write VISA resource cache: {e}")
+
+
+def list_resources(refresh=False):
+    # One scan serves every device connecting at the same time
+    global _resources
+    rm = resource_manager()
+    with _lock:
+        if _resources is None or refresh:
+            print("---Scanning VISA resources")
+            _resources = rm.list_resources()
+        return _resources
+
+
+def find_resource(pattern, refresh=False):
+    """
+    Name of the resource containing pattern (e.g. a serial number), from
+    the cache unless refresh, otherwise from a resource scan.
+    """
+    if not refresh:
+        cached = read_cache().get(pattern)
+        if cached is not None:
+            return cached
+    for resource in list_resources(refresh):
+        if pattern in resource:
+            with _lock:
+                cache = read_cache()
+                cache[pattern] = resource
+                write_cache(cache)
+            return resource
+    return None
+
+
+def open_resource(pattern, label):
+    """
+    Open the resource matching pattern. A cached name that no longer
+    opens (instrument moved to another port) triggers a fresh scan.
+    """
+    rm = resource_manager()
+    resource_name = find_resource(pattern)
+    if resource_name is None:
+        raise Exception(f"{label} not found!")
+    try:
+        print(f"---Connecting to {label}: {resource_name}")
+        return rm.open_resource(resource_name)
+    except Exception as e:
+        print(f"---Cached resource {resource_name} failed ({e}), rescanning")
+    resource_name = find_resource(pattern, refresh=True)
+    if resource_name is None:
+        raise Exception(f"{label} not found!")
+    print(f"---Connecting to {label}: {resource_name}")
+    return rm.open_resource(resource_name)
@@ -0,0 +1,8 @@
+from pydantic import BaseModel
+from typing import Optional
+
+
+class ArchiveIndexParams(BaseModel):
+    path: Optional[str] = None
+    directory: Optional[str] = None
+    force: bool = False
@@ -0,0 +1,44 @@
+from pydantic import BaseModel
+from typing import Optional
+
+
+class LockinState(BaseModel):
+    input_mode: Optional[int] = None
+    frequency: Optional[float] = None
+    phase: Optional[float] = None
+    time_constant: Optional[float] = None
+    filter_slope: Optional[int] = None
+    sensitivity_index: Optional[int] = None
+    sensitivity: Optional[float] = None
+    amplitude: Optional[float] = None
+    auto_range: bool = False
+    overloads: int = 0
+
+
+class LockinSettings(BaseModel):
+    frequency: Optional[float] = None
+    phase: Optional[float] = None
+    input_mode: Optional[int] = None
+    time_constant: Optional[float] = None
+    sensitivity: Optional[float] = None
+    amplitude: Optional[float] = None
+
+
+class AutoRangeParams(BaseModel):
+    enabled: bool = True
+    # Fractions of full scale: change range above upper or below lower, to land R near target
+    upper: float = 0.9
+    lower: float = 0.1
+    target: float = 0.5
+    overload: float = 1.0
+    settle_time_constants: Optional[float] = None
+    max_steps: int = 5
+
+
+class LockinStreamParams(BaseModel):
+    port: int = 1865
+    channels: str = "XYRT"
+    rate: Optional[float] = None
+    format: str = "float32"
+    packet_size: int = 1024
+    capacity: int = 1 << 18
@@ -0,0 +1,22 @@
+from pydantic import BaseModel
+from typing import Optional
+
+
+class MultimeterState(BaseModel):
+    mode: Optional[str] = None
+    nplc: Optional[float] = None
+    sample_count: int = 1
+    trigger_source: str = "IMM"
+
+
+class MultimeterSettings(BaseModel):
+    mode: Optional[str] = None
+    nplc: Optional[float] = None
+    sample_count: Optional[int] = None
+    trigger_source: Optional[str] = None
+
+
+class BurstParams(BaseModel):
+    samples: int = 10
+    nplc: Optional[float] = None
+    trigger_source: str = "IMM"
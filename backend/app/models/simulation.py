@@ -0,0 +1,12 @@
+from pydantic import BaseModel
+from typing import List
+
+
+class SimulationSettings(BaseModel):
+    devices: List[str] = []
+    latency: float = 0.005
+    jitter: float = 0.0
+    max_velocity: float = 10.0
+    acceleration: float = 10.0
+    lockin_signal: str = "drift"
+    multimeter_signal: str = "drift"
@@ -1,5 +1,38 @@
-from pydantic import BaseModel
-from typing import Optional
+from pydantic import BaseModel, Field
+from typing import List, Literal, Optional, Tuple
+from app.models.multimeter import BurstParams
+from app.models.lockin import AutoRangeParams
+
+
+class SettleParams(BaseModel):
+    mode: str = "convergence"
+    tolerance: float = 0.01
+    samples: int = 3
+    time_constants: Optional[float] = None
+    interval: Optional[float] = None
+    timeout: Optional[float] = None
+
+
+class RetryParams(BaseModel):
+    max_attempts: int = Field(3, ge=1)
+    backoff: float = Field(0.5, ge=0)
+    rehome_on_failure: bool = False
+    on_failure: Literal["abort", "skip"] = "abort"
+
+
+class AdaptiveParams(BaseModel):
+    r_threshold: Optional[float] = None
+    theta_threshold: Optional[float] = None
+    voltage_threshold: Optional[float] = None
+    max_depth: int = 3
+    max_points: Optional[int] = None
+
+
+class SweepParams(BaseModel):
+    frequencies: List[float]
+    # Sine output amplitude in volts, one per frequency
+    amplitudes: Optional[List[float]] = None
+    order: str = "serpentine"
 
 
 class RectangleParams(BaseModel):
@@ -13,8 +46,30 @@ class RectangleParams(BaseModel):
     y_step_size: Optional[float] = None
     movement_mode: str
     delay: Optional[float] = None
+    settle: Optional[SettleParams] = None
+    scan_mode: str = "step"
+    acquisition_mode: str = "poll"
+    capture_rate: Optional[float] = None
+    path_strategy: str = "serpentine"
+    points: Optional[List[Tuple[float, float]]] = None
+    retry: Optional[RetryParams] = None
+    multimeter: Optional[BurstParams] = None
+    adaptive: Optional[AdaptiveParams] = None
+    auto_range: Optional[AutoRangeParams] = None
+    sweep: Optional[SweepParams] = None
+
+
+class ResumeParams(BaseModel):
+    path: str
+    retry: Optional[RetryParams] = None
 
 
 class MovementParams(BaseModel):
     x: float
     y: float
+
+
+class ExportParams(BaseModel):
+    path: str
+    filename: Optional[str] = None
+    grid: bool = False
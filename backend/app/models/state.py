@@ -1,14 +1,15 @@
-from fastapi import WebSocket
-
-
 class GlobalState:
     def __init__(self):
         self.stage = None
         self.lockin = None
+        self.lockin_stream = None
         self.multimeter = None
-        self.ws_lockin: WebSocket = None
-        self.ws_multimeter: WebSocket = None
-        self.ws_stage: WebSocket = None
+        self.scan_buffer = None
+        self.scan_map = None
+        self.telemetry = None
+        self.scheduler = None
+        self.plans = {}
+        self.archive = None
 
 
 global_state = GlobalState()
@@ -0,0 +1,9 @@
+from pydantic import BaseModel
+from typing import Optional
+
+
+class StreamOptions(BaseModel):
+    encoding: str = "json"
+    rate: Optional[float] = None
+    decimation: str = "none"
+    batch: int = 1
@@ -1,22 +1,41 @@
 from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
 from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 import asyncio
+import numpy as np
 from app.models.stage import *
 from app.models.channel import *
+from app.models.lockin import *
+from app.models.multimeter import *
+from app.models.archive import *
 from app.models.state import global_state
-import clr
-from System import Decimal
+from app.utils.file_utils import (
+    MEASUREMENT_DIR,
+    export_csv,
+    export_grid_csv,
+    measurement_path,
+)
+from app.services.metrics import registry as metrics
+from app.services.lockin_stream import open_ingest
+from app.services.path_planner import (
+    POINT_STRATEGIES,
+    compare_plans,
+    estimate_travel,
+)
+from app.services.scan_plan import grid_axis
 
 router = APIRouter()
 executor = ThreadPoolExecutor()
 
+# Plans kept for /plan/{plan_id}/start, oldest dropped first
+MAX_PLANS = 32
+
 
 @router.post("/move")
 async def move(params: MovementParams):
     try:
-        await asyncio.get_event_loop().run_in_executor(
-            executor, lambda: global_state.stage.move(params.x, params.y)
-        )
+        await global_state.stage.run("move", params.x, params.y)
         return {"status": "success", "message": "Movement completed"}
     except Exception as e:
         return {"status": "error", "message": str(e)}
@@ -25,46 +44,144 @@ async def move(params: MovementParams):
 @router.post("/start")
 async def start_movement(params: RectangleParams):
     try:
-        future = asyncio.get_event_loop().run_in_executor(
-            executor,
-            lambda: global_state.stage.move_in_rectangle(
+        job = global_state.scheduler.submit(params)
+        return {"status": "success", "message": "Scan queued", "job_id": job.id}
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+
+@router.post("/plan")
+async def plan_scan(params: RectangleParams, points: bool = False):
+    try:
+        # A dry run from cached positions and kinematics, not queued behind a running scan
+        await global_state.stage.ready()
+        plan = await asyncio.get_event_loop().run_in_executor(
+            executor, lambda: global_state.stage.plan_scan(params)
+        )
+        global_state.plans[plan.id] = plan
+        while len(global_state.plans) > MAX_PLANS:
+            global_state.plans.pop(next(iter(global_state.plans)))
+        return {"status": "success", **plan.summary(points)}
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+
+@router.post("/plan/{plan_id}/start")
+async def start_plan(plan_id: str):
+    try:
+        if plan_id not in global_state.plans:
+            raise KeyError(f"Unknown plan {plan_id}")
+        plan = global_state.plans.pop(plan_id)
+        job = global_state.scheduler.submit(plan.params, plan)
+        return {"status": "success", "message": "Scan queued", "job_id": job.id}
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+
+@router.post("/resume_scan")
+async def resume_scan(params: ResumeParams):
+    try:
+        params.path = measurement_path(params.path)
+        job = global_state.scheduler.submit(params)
+        return {"status": "success", "message": "Resume queued", "job_id": job.id}
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+
+@router.get("/jobs")
+async def list_jobs():
+    return {"status": "success", "jobs": global_state.scheduler.list()}
+
+
+@router.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    try:
+        return {"status": "success", **global_state.scheduler.get(job_id).to_dict()}
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+
+@router.post("/jobs/{job_id}/pause")
+async def pause_job(job_id: str):
+    try:
+        global_state.scheduler.get(job_id).pause()
+        return {"status": "success", "message": "Pause requested"}
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+
+@router.post("/jobs/{job_id}/resume")
+async def resume_job(job_id: str):
+    try:
+        global_state.scheduler.get(job_id).resume()
+        return {"status": "success", "message": "Job resumed"}
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+
+@router.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    try:
+        global_state.scheduler.get(job_id).cancel()
+        return {"status": "success", "message": "Cancel requested"}
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+
+@router.post("/compare_paths")
+async def compare_paths(params: RectangleParams):
+    try:
+
+        await global_state.stage.ready()
+
+        def estimate():
+            kinematics = global_state.stage.get_kinematics()
+            if params.points is not None:
+                plans = {}
+                for strategy in POINT_STRATEGIES:
+                    points = global_state.stage.plan_rectangle(
+                        params.x1,
+                        params.y1,
+                        params.x2,
+                        params.y2,
+                        params.x_steps,
+                        params.y_steps,
+                        params.x_step_size,
+                        params.y_step_size,
+                        params.movement_mode,
+                        strategy,
+                        params.points,
+                    )
+                    distance, duration = estimate_travel(
+                        points, kinematics, simultaneous=True
+                    )
+                    plans[strategy] = {
+                        "points": len(points),
+                        "travel_distance": distance,
+                        "travel_time": duration,
+                    }
+                return plans
+            xs, _ = grid_axis(
                 params.x1,
-                params.y1,
                 params.x2,
-                params.y2,
                 params.x_steps,
-                params.y_steps,
                 params.x_step_size,
+                params.movement_mode,
+                "x",
+            )
+            ys, _ = grid_axis(
+                params.y1,
+                params.y2,
+                params.y_steps,
                 params.y_step_size,
                 params.movement_mode,
-                params.delay,
-            ),
-        )
-        await future
-        for ws in [
-            global_state.ws_lockin,
-            global_state.ws_multimeter,
-            global_state.ws_stage,
-        ]:
-            if ws is not None:
-                try:
-                    await ws.close()
-                    ws = None
-                except Exception as e:
-                    print(f"Error closing {ws} websocket: {e}")
-        return {"status": "success", "message": "Movement completed"}
+                "y",
+            )
+            return compare_plans(xs, ys, kinematics, simultaneous=True)
+
+        plans = await asyncio.get_event_loop().run_in_executor(executor, estimate)
+        return {"status": "success", "plans": plans}
     except Exception as e:
-        for ws in [
-            global_state.ws_lockin,
-            global_state.ws_multimeter,
-            global_state.ws_stage,
-        ]:
-            if ws is not None:
-                try:
-                    await ws.close()
-                    ws = None
-                except Exception as e:
-                    print(f"Error closing {ws} websocket: {e}")
         return {"status": "error", "message": str(e)}
 
 
@@ -72,21 +189,11 @@ async def start_movement(params: RectangleParams):
 async def home(params: ChannelParams):
     try:
         if params.channel_direction == "x":
-            await asyncio.get_event_loop().run_in_executor(
-                executor, lambda: global_state.stage.home_channel(1)
-            )
+            await global_state.stage.run("home_channel", 1)
         elif params.channel_direction == "y":
-            await asyncio.get_event_loop().run_in_executor(
-                executor, lambda: global_state.stage.home_channel(2)
-            )
+            await global_state.stage.run("home_channel", 2)
         else:
-            await asyncio.get_event_loop().run_in_executor(
-                executor,
-                lambda: (
-                    global_state.stage.home_channel(1),
-                    global_state.stage.home_channel(2),
-                ),
-            )
+            await global_state.stage.run("home_channels", [1, 2], True)
         return {"status": "success", "message": "Homing completed"}
     except Exception as e:
         return {"status": "error", "message": str(e)}
@@ -95,6 +202,7 @@ async def home(params: ChannelParams):
 @router.get("/get_movement_params")
 async def get_movement_params_api():
     try:
+        await global_state.stage.ready()
         params = await asyncio.get_event_loop().run_in_executor(
             executor,
             lambda: (
@@ -120,22 +228,19 @@ async def get_movement_params_api():
 @router.post("/set_movement_params")
 async def set_movement_params_api(params: Settings):
     try:
-        await asyncio.get_event_loop().run_in_executor(
-            executor,
+        await global_state.stage.run(
             lambda: (
-                global_state.stage.channel[1].SetHomingVelocity(
-                    Decimal(params.channel1.homing_velocity)
+                global_state.stage.set_movement_params(
+                    1,
+                    params.channel1.homing_velocity,
+                    params.channel1.max_velocity,
+                    params.channel1.acceleration,
                 ),
-                global_state.stage.channel[1].SetVelocityParams(
-                    Decimal(params.channel1.max_velocity),
-                    Decimal(params.channel1.acceleration),
-                ),
-                global_state.stage.channel[2].SetHomingVelocity(
-                    Decimal(params.channel2.homing_velocity)
-                ),
-                global_state.stage.channel[2].SetVelocityParams(
-                    Decimal(params.channel2.max_velocity),
-                    Decimal(params.channel2.acceleration),
+                global_state.stage.set_movement_params(
+                    2,
+                    params.channel2.homing_velocity,
+                    params.channel2.max_velocity,
+                    params.channel2.acceleration,
                 ),
             ),
         )
@@ -160,6 +265,278 @@ async def get_current_position():
         return {"status": "error", "x": "NaN", "y": "NaN"}
 
 
+@router.get("/get_lockin_state")
+async def get_lockin_state(refresh: bool = False):
+    try:
+        if refresh:
+            state = await global_state.lockin.run("refresh_state")
+        else:
+            await global_state.lockin.ready()
+            state = global_state.lockin.state
+        return {"status": "success", **state.model_dump()}
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+
+@router.post("/set_lockin_params")
+async def set_lockin_params(params: LockinSettings):
+    try:
+
+        def apply():
+            if params.frequency is not None:
+                global_state.lockin.set_frequency(params.frequency)
+            if params.phase is not None:
+                global_state.lockin.set_phase(params.phase)
+            if params.input_mode is not None:
+                global_state.lockin.set_input_mode(params.input_mode)
+            if params.time_constant is not None:
+                global_state.lockin.set_time_constant(params.time_constant)
+            if params.sensitivity is not None:
+                global_state.lockin.set_sensitivity(params.sensitivity)
+            if params.amplitude is not None:
+                global_state.lockin.set_amplitude(params.amplitude)
+            return global_state.lockin.state
+
+        state = await global_state.lockin.run(apply)
+        return {"status": "success", **state.model_dump()}
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+
+@router.post("/set_lockin_auto_range")
+async def set_lockin_auto_range(params: AutoRangeParams):
+    try:
+        state = await global_state.lockin.run("configure_auto_range", params)
+        return {"status": "success", **state.model_dump()}
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+
+@router.get("/get_lockin_range_events")
+async def get_lockin_range_events():
+    try:
+        await global_state.lockin.ready()
+        return {"status": "success", "events": list(global_state.lockin.range_events)}
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+
+async def close_lockin_stream():
+    await global_state.lockin.run("stop_stream")
+    stats = global_state.lockin_stream.stats()
+    global_state.lockin_stream.close()
+    global_state.lockin_stream = None
+    # The socket is released on the next loop iteration, before the port can be bound again
+    await asyncio.sleep(0)
+    return stats
+
+
+@router.post("/start_lockin_stream")
+async def start_lockin_stream(params: LockinStreamParams):
+    try:
+        if global_state.lockin_stream is not None:
+            await close_lockin_stream()
+        ingest = await open_ingest(
+            params.port,
+            params.capacity,
+            sensitivity=lambda: global_state.lockin.state.sensitivity,
+        )
+        try:
+            ingest.rate = await global_state.lockin.run(
+                "start_stream",
+                params.port,
+                params.channels,
+                params.rate,
+                params.format,
+                params.packet_size,
+            )
+        except Exception:
+            ingest.close()
+            raise
+        global_state.lockin_stream = ingest
+        return {"status": "success", **ingest.stats()}
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+
+@router.post("/stop_lockin_stream")
+async def stop_lockin_stream():
+    try:
+        if global_state.lockin_stream is None:
+            return {"status": "error", "message": "The lock-in is not streaming"}
+        stats = await close_lockin_stream()
+        return {"status": "success", **stats}
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+
+@router.get("/get_lockin_stream_stats")
+async def get_lockin_stream_stats():
+    if global_state.lockin_stream is None:
+        return {"status": "error", "message": "The lock-in is not streaming"}
+    return {"status": "success", **global_state.lockin_stream.stats()}
+
+
+@router.get("/get_multimeter_state")
+async def get_multimeter_state():
+    try:
+        await global_state.multimeter.ready()
+        return {"status": "success", **global_state.multimeter.state.model_dump()}
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+
+@router.post("/set_multimeter_params")
+async def set_multimeter_params(params: MultimeterSettings):
+    try:
+
+        def apply():
+            multimeter = global_state.multimeter
+            if params.mode is not None:
+                if not multimeter.configure_measurement(params.mode, params.nplc):
+                    raise Exception(f"Could not switch to {params.mode}")
+            elif params.nplc is not None:
+                multimeter.set_nplc(params.nplc)
+            if params.trigger_source is not None:
+                multimeter.set_trigger_source(params.trigger_source)
+            if params.sample_count is not None:
+                multimeter.set_sample_count(params.sample_count)
+            return multimeter.state
+
+        state = await global_state.multimeter.run(apply)
+        return {"status": "success", **state.model_dump()}
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+
+@router.get("/scan_preview")
+async def scan_preview(start: int = 0, step: int = 1):
+    try:
+        buffer = global_state.scan_buffer
+        if buffer is None:
+            return {"status": "error", "message": "No scan has been started"}
+        rows = buffer.view(start)[:: max(step, 1)]
+        return {
+            "status": "success",
+            "size": len(buffer),
+            "start": start,
+            "step": max(step, 1),
+            "columns": {
+                name: np.where(np.isnan(rows[name]), None, rows[name]).tolist()
+                for name in rows.dtype.names
+                if name != "timestamp_ns"
+            },
+            "timestamp_ns": rows["timestamp_ns"].tolist(),
+        }
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+
+@router.post("/export_csv")
+async def export_csv_api(params: ExportParams):
+    try:
+        export = export_grid_csv if params.grid else export_csv
+        path = measurement_path(params.path)
+        filename = params.filename
+        if filename is not None:
+            filename = measurement_path(filename)
+        filename = await asyncio.get_event_loop().run_in_executor(
+            executor, lambda: export(path, filename)
+        )
+        return {"status": "success", "filename": filename}
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+
+@router.post("/archive/index")
+async def archive_index(params: ArchiveIndexParams):
+    try:
+        archive = global_state.archive
+        if params.path is not None:
+            path = measurement_path(params.path)
+            work = lambda: [archive.index(path, force=params.force)]
+        else:
+            directory = measurement_path(params.directory or MEASUREMENT_DIR)
+            work = lambda: archive.index_directory(directory, params.force)
+        scan_ids = await asyncio.get_event_loop().run_in_executor(executor, work)
+        return {"status": "success", "scan_ids": scan_ids}
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+
+@router.get("/archive/scans")
+async def archive_scans(
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+    scan_mode: Optional[str] = None,
+    x_min: Optional[float] = None,
+    x_max: Optional[float] = None,
+    y_min: Optional[float] = None,
+    y_max: Optional[float] = None,
+    limit: int = 100,
+):
+    try:
+        region = {"x_min": x_min, "x_max": x_max, "y_min": y_min, "y_max": y_max}
+        scans = await asyncio.get_event_loop().run_in_executor(
+            executor,
+            lambda: global_state.archive.scans(since, until, scan_mode, region, limit),
+        )
+        return {"status": "success", "scans": scans}
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+
+@router.get("/archive/scans/{scan_id}")
+async def archive_scan(scan_id: int):
+    try:
+        return {"status": "success", **global_state.archive.scan(scan_id)}
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+
+@router.get("/archive/scans/{scan_id}/data")
+async def archive_scan_data(
+    scan_id: int,
+    t_min: Optional[float] = None,
+    t_max: Optional[float] = None,
+    x_min: Optional[float] = None,
+    x_max: Optional[float] = None,
+    y_min: Optional[float] = None,
+    y_max: Optional[float] = None,
+    columns: Optional[str] = None,
+    step: int = 1,
+    max_rows: Optional[int] = None,
+):
+    try:
+        region = {
+            "t_min": t_min,
+            "t_max": t_max,
+            "x_min": x_min,
+            "x_max": x_max,
+            "y_min": y_min,
+            "y_max": y_max,
+        }
+        names = columns.split(",") if columns else None
+        result = await asyncio.get_event_loop().run_in_executor(
+            executor,
+            lambda: global_state.archive.read(scan_id, region, names, step, max_rows),
+        )
+        result["columns"] = {
+            name: np.where(np.isnan(values), None, values).tolist()
+            for name, values in result["columns"].items()
+        }
+        return {"status": "success", **result}
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
 @router.get("/")
 def read_root():
     return {"status": "API is running"}
@@ -0,0 +1,94 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from app.core.device_actor import DeviceActor
+
+# Instruments not wrapped in a DeviceActor (e.g. in scripts) are read here
+executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="acquire")
+
+
+def timed(fn, *args):
+    def run():
+        start = time.monotonic_ns()
+        value = fn(*args)
+        return value, start, time.monotonic_ns()
+
+    return run
+
+
+def submit_read(device, method, *args):
+    if isinstance(device, DeviceActor):
+        # Run on the instrument's own I/O thread, queued behind its other requests
+        return device.submit(timed(getattr(device.target, method), *args))
+    return executor.submit(timed(getattr(device, method), *args))
+
+
+def acquire(reads, inline=None):
+    """
+    Read several instruments at once. reads maps a name to (device,
+    method, args), each is started on its instrument's thread; inline maps
+    a name to a callable run on the calling thread meanwhile (the stage,
+    whose calls must stay on its own thread). Returns the values by name
+    and the timing: latency per instrument in seconds, the shared
+    timestamp (mean midpoint of all reads, monotonic ns) and the skew
+    between the earliest and latest midpoint in seconds.
+    """
+    started = time.monotonic_ns()
+    futures = {name: submit_read(*read) for name, read in reads.items()}
+    results = {name: timed(fn)() for name, fn in (inline or {}).items()}
+    for name, future in futures.items():
+        results[name] = future.result()
+    midpoints = [(start + end) / 2 for _, start, end in results.values()]
+    return {name: value for name, (value, _, _) in results.items()}, {
+        "latency": {
+            name: (end - start) / 1e9 for name, (_, start, end) in results.items()
+        },
+        "timestamp_ns": int(sum(midpoints) / len(midpoints)),
+        "skew": (max(midpoints) - min(midpoints)) / 1e9,
+        "total": (time.monotonic_ns() - started) / 1e9,
+    }
+
+
+def summarize(values):
+    if not values:
+        return None
+    return {
+        "min": min(values),
+        "max": max(values),
+        "mean": sum(values) / len(values),
+    }
+
+
+class AcquisitionStats:
+    """
+    Collects the timing of every point of a scan. "total" is the wall time
+    of the parallel read, "sequential" the sum of the instrument latencies,
+    i.e. what the same reads would have cost one after the other; "move"
+    the stage travel time before each point.
+    """
+
+    def __init__(self):
+        self.move = []
+        self.latency = {}
+        self.skew = []
+        self.total = []
+        self.sequential = []
+
+    def record(self, timing):
+        for name, latency in timing["latency"].items():
+            self.latency.setdefault(name, []).append(latency)
+        self.skew.append(timing["skew"])
+        self.total.append(timing["total"])
+        self.sequential.append(sum(timing["latency"].values()))
+
+    def summary(self):
+        if not self.total:
+            return None
+        return {
+            "latency": {
+                name: summarize(values) for name, values in self.latency.items()
+            },
+            "skew": summarize(self.skew),
+            "total": summarize(self.total),
+            "sequential": summarize(self.sequential),
+            "move": summarize(self.move),
+        }
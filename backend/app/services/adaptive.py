@@ -0,0 +1,221 @@
+import numpy as np
+from app.services.path_planner import order_points, plan_grid
+
+
+def point_key(x, y):
+    return (round(float(x), 9), round(float(y), 9))
+
+
+def angle_spread(angles):
+    """
+    Largest difference between phase angles in degrees, taking the
+    wrap-around at +-180 into account.
+    """
+    angles = np.sort(np.mod(angles, 360.0))
+    gaps = np.diff(np.concatenate((angles, [angles[0] + 360.0])))
+    return 360.0 - gaps.max()
+
+
+class QuadtreeRefiner:
+    """
+    Plans an adaptive scan level by level. Level 0 is a coarse grid; each
+    later level subdivides the cells whose corners differ by more than a
+    threshold in R, theta or voltage into four, which adds the cell
+    centre and edge midpoints. Cells are refined in order of how far they
+    exceed their threshold until max_depth or the point budget is reached.
+    Points are identified by their coordinates, so corners shared by
+    neighbouring cells are measured once.
+    """
+
+    def __init__(self, xs, ys, params, kinematics):
+        self.params = params
+        self.kinematics = kinematics
+        self.levels = {}
+        self.leaves = []
+        self.cells = [
+            (xs[i], ys[j], xs[i + 1], ys[j + 1], 0)
+            for j in range(len(ys) - 1)
+            for i in range(len(xs) - 1)
+        ]
+        self.coarse = plan_grid(xs, ys, "serpentine")
+        for x, y in self.coarse:
+            self.levels[point_key(x, y)] = 0
+        self.step = (
+            (xs[1] - xs[0]) if len(xs) > 1 else 0.0,
+            (ys[1] - ys[0]) if len(ys) > 1 else 0.0,
+        )
+        self.depth = 0
+
+    def level(self, x, y):
+        return self.levels[point_key(x, y)]
+
+    def score(self, corners):
+        """
+        How far the corner values of a cell exceed the thresholds, as a
+        multiple of the threshold (NaN corners are ignored).
+        """
+        score = 0.0
+        for name, threshold in (
+            ("R", self.params.r_threshold),
+            ("theta", self.params.theta_threshold),
+            ("voltage", self.params.voltage_threshold),
+        ):
+            if not threshold:
+                continue
+            values = np.array(
+                [corner.get(name, np.nan) for corner in corners], dtype=np.float64
+            )
+            values = values[~np.isnan(values)]
+            if len(values) < 2:
+                continue
+            if name == "theta":
+                spread = angle_spread(values)
+            else:
+                spread = values.max() - values.min()
+            score = max(score, spread / threshold)
+        return score
+
+    def extend(self, plan, buffer):
+        """
+        Refine the cells of the last level from the values measured so far
+        and return the points of the next level, ordered for travel from
+        the last point of plan. Returns an empty list when done.
+        """
+        values = self.collect(plan, buffer)
+        while self.cells:
+            if self.depth >= self.params.max_depth:
+                self.finish()
+                break
+            new_points = self.refine_level(values)
+            if new_points:
+                print(
+                    f"---Refining {len(self.cells) // 4} cells to level {self.depth}: {len(new_points)} new points"
+                )
+                return order_points(
+                    new_points,
+                    "nearest",
+                    self.kinematics,
+                    start=plan[-1],
+                    simultaneous=True,
+                )
+        return []
+
+    def refine_level(self, values):
+        """
+        Split the cells of the current level that exceed a threshold, most
+        exceeding first, while the point budget allows. Children whose
+        points were all measured already (shared with a neighbour) are
+        refined further in the next pass without new measurements.
+        """
+        scored = []
+        for cell in self.cells:
+            x0, y0, x1, y1, _ = cell
+            corners = [
+                values.get(point_key(x, y), {})
+                for x, y in ((x0, y0), (x1, y0), (x0, y1), (x1, y1))
+            ]
+            scored.append((self.score(corners), cell))
+        scored.sort(key=lambda item: item[0], reverse=True)
+        budget = self.params.max_points
+        total = len(self.levels)
+        children = []
+        new_points = []
+        for score, cell in scored:
+            fresh = [
+                point
+                for point in self.subdivision_points(cell)
+                if point_key(*point) not in self.levels
+            ]
+            if score <= 1.0 or (budget is not None and total + len(fresh) > budget):
+                self.leaves.append(cell)
+                continue
+            x0, y0, x1, y1, level = cell
+            xm, ym = (x0 + x1) / 2, (y0 + y1) / 2
+            children += [
+                (x0, y0, xm, ym, level + 1),
+                (xm, y0, x1, ym, level + 1),
+                (x0, ym, xm, y1, level + 1),
+                (xm, ym, x1, y1, level + 1),
+            ]
+            for x, y in fresh:
+                self.levels[point_key(x, y)] = level + 1
+                new_points.append((x, y))
+            total += len(fresh)
+        self.cells = children
+        if children:
+            self.depth += 1
+        return new_points
+
+    def subdivision_points(self, cell):
+        x0, y0, x1, y1, _ = cell
+        xm, ym = (x0 + x1) / 2, (y0 + y1) / 2
+        return [(xm, y0), (x0, ym), (xm, ym), (x1, ym), (xm, y1)]
+
+    def collect(self, plan, buffer):
+        """
+        Values measured so far by point key, from the rows of the buffer.
+        """
+        values = {}
+        indices = buffer.column("point_index")
+        for row, point_index in enumerate(indices):
+            x, y = plan[int(point_index)]
+            values[point_key(x, y)] = {
+                name: float(buffer.data[name][row])
+                for name in ("R", "theta", "voltage")
+            }
+        return values
+
+    def finish(self):
+        """
+        Close the tree after the last level, so every cell is a leaf.
+        """
+        self.leaves += self.cells
+        self.cells = []
+
+    def resample(self, plan, buffer, names=("X", "Y", "R", "theta", "voltage")):
+        """
+        Resample the point cloud onto the regular grid of the finest level
+        reached: every grid node is interpolated bilinearly from the
+        corners of the leaf cell containing it.
+        """
+        divisions = 2**self.depth
+        x_step = self.step[0] / divisions
+        y_step = self.step[1] / divisions
+        x_min = min(cell[0] for cell in self.leaves)
+        y_min = min(cell[1] for cell in self.leaves)
+        x_max = max(cell[2] for cell in self.leaves)
+        y_max = max(cell[3] for cell in self.leaves)
+        xs = x_min + np.arange(int(round((x_max - x_min) / x_step)) + 1) * x_step
+        ys = y_min + np.arange(int(round((y_max - y_min) / y_step)) + 1) * y_step
+        measured = {}
+        indices = buffer.column("point_index")
+        for row, point_index in enumerate(indices):
+            x, y = plan[int(point_index)]
+            measured[point_key(x, y)] = buffer.data[row]
+        grids = {name: np.full((len(ys), len(xs)), np.nan) for name in names}
+        for x0, y0, x1, y1, _ in self.leaves:
+            corners = [
+                measured.get(point_key(x, y))
+                for x, y in ((x0, y0), (x1, y0), (x0, y1), (x1, y1))
+            ]
+            if any(corner is None for corner in corners):
+                continue
+            i0, i1 = (int(round((x - x_min) / x_step)) for x in (x0, x1))
+            j0, j1 = (int(round((y - y_min) / y_step)) for y in (y0, y1))
+            u = ((xs[i0 : i1 + 1] - x0) / (x1 - x0))[np.newaxis, :]
+            v = ((ys[j0 : j1 + 1] - y0) / (y1 - y0))[:, np.newaxis]
+            for name in names:
+                c00, c10, c01, c11 = (float(corner[name]) for corner in corners)
+                grids[name][j0 : j1 + 1, i0 : i1 + 1] = (
+                    c00 * (1 - u) * (1 - v)
+                    + c10 * u * (1 - v)
+                    + c01 * (1 - u) * v
+                    + c11 * u * v
+                )
+        return xs, ys, grids
+
+    def level_counts(self):
+        counts = {}
+        for level in self.levels.values():
+            counts[level] = counts.get(level, 0) + 1
+        return dict(sorted(counts.items()))
@@ -0,0 +1,465 @@
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from datetime import datetime
+import numpy as np
+from app.utils.file_utils import (
+    chunk_columns,
+    list_chunks,
+    read_checkpoint,
+    read_schema,
+)
+
+ARCHIVE_PATH = os.environ.get("MEASUREMENT_ARCHIVE", "measurements.db")
+
+# Rows per indexed block of a CSV; .scan directories are indexed per chunk
+CSV_BLOCK_ROWS = 256
+
+# CSV headers written over time, mapped to the record field names. Version
+# 1 is the layout of the early files (no R, theta or phase), version 2 the
+# one save_to_file and export_csv write.
+CSV_COLUMNS = {
+    "Timestamp": "time",
+    "PositionX": "positionX",
+    "PositionY": "positionY",
+    "X(V)": "X",
+    "Y(V)": "Y",
+    "R(V)": "R",
+    "Theta(deg)": "theta",
+    "Frequency(Hz)": "frequency",
+    "Phase(deg)": "phase",
+    "Voltage(V)": "voltage",
+}
+CSV_SCHEMAS = {
+    (
+        "Timestamp",
+        "PositionX",
+        "PositionY",
+        "X(V)",
+        "Y(V)",
+        "Frequency(Hz)",
+        "Voltage(V)",
+    ): 1,
+    (
+        "Timestamp",
+        "PositionX",
+        "PositionY",
+        "X(V)",
+        "Y(V)",
+        "R(V)",
+        "Theta(deg)",
+        "Frequency(Hz)",
+        "Phase(deg)",
+        "Voltage(V)",
+    ): 2,
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scans (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    format TEXT NOT NULL,
+    schema_version INTEGER,
+    columns TEXT NOT NULL,
+    records INTEGER NOT NULL,
+    started REAL,
+    finished REAL,
+    x_min REAL,
+    x_max REAL,
+    y_min REAL,
+    y_max REAL,
+    status TEXT,
+    scan_mode TEXT,
+    params TEXT,
+    settings TEXT,
+    instruments TEXT,
+    modified REAL,
+    indexed REAL
+);
+CREATE INDEX IF NOT EXISTS scans_started ON scans (started);
+CREATE INDEX IF NOT EXISTS scans_bounds ON scans (x_min, x_max, y_min, y_max);
+CREATE TABLE IF NOT EXISTS blocks (
+    scan_id INTEGER NOT NULL REFERENCES scans (id) ON DELETE CASCADE,
+    block INTEGER NOT NULL,
+    source TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    rows INTEGER NOT NULL,
+    t_min REAL,
+    t_max REAL,
+    x_min REAL,
+    x_max REAL,
+    y_min REAL,
+    y_max REAL,
+    PRIMARY KEY (scan_id, block)
+);
+CREATE INDEX IF NOT EXISTS blocks_time ON blocks (scan_id, t_min, t_max);
+CREATE INDEX IF NOT EXISTS blocks_bounds ON blocks (scan_id, x_min, x_max, y_min, y_max);
+"""
+
+
+def bounds(columns):
+    """
+    (t_min, t_max, x_min, x_max, y_min, y_max) of some records, None for
+    a quantity without finite values.
+    """
+    result = []
+    for name in ("time", "positionX", "positionY"):
+        values = columns.get(name)
+        values = values[np.isfinite(values)] if values is not None else []
+        if len(values):
+            result += [float(values.min()), float(values.max())]
+        else:
+            result += [None, None]
+    return tuple(result)
+
+
+def region_mask(columns, region):
+    count = len(next(iter(columns.values())))
+    mask = np.ones(count, dtype=bool)
+    for name, low, high in (
+        ("time", "t_min", "t_max"),
+        ("positionX", "x_min", "x_max"),
+        ("positionY", "y_min", "y_max"),
+    ):
+        if name not in columns:
+            continue
+        if region.get(low) is not None:
+            mask &= columns[name] >= region[low]
+        if region.get(high) is not None:
+            mask &= columns[name] <= region[high]
+    return mask
+
+
+def parse_time(value):
+    try:
+        return datetime.strptime(value, "%Y-%m-%d %H:%M:%S.%f").timestamp()
+    except ValueError:
+        return float("nan")
+
+
+def parse_csv_rows(lines, names):
+    """
+    Columns of CSV data lines, with the timestamp in epoch seconds.
+    """
+    rows = [line.rstrip("\r\n").split(",") for line in lines if line.strip()]
+    columns = {}
+    for index, name in enumerate(names):
+        values = [row[index] if index < len(row) else "" for row in rows]
+        if name == "time":
+            columns[name] = np.array([parse_time(value) for value in values])
+        else:
+            columns[name] = np.array(
+                [
+                    float(value) if value not in ("", "None") else np.nan
+                    for value in values
+                ]
+            )
+    return columns
+
+
+def scan_columns(path, chunk, fields, epoch_offset_ns):
+    """
+    One chunk of a .scan directory as columns, the timestamp converted to
+    epoch seconds under the name "time".
+    """
+    with np.load(os.path.join(path, chunk)) as arrays:
+        columns = chunk_columns(arrays, fields)
+    if "timestamp_ns" in columns:
+        columns["time"] = (columns.pop("timestamp_ns") + epoch_offset_ns) / 1e9
+    return columns
+
+
+class MeasurementArchive:
+    """
+    SQLite catalogue of the measurements on disk. Every scan (a .scan
+    directory or a CSV) gets a row with its parameters, instrument
+    settings, schema version and bounds, and its data is indexed in blocks
+    (chunks of a .scan, runs of CSV lines by byte offset) with their own
+    time and position bounds, so a sub-region is read from the blocks
+    that overlap it rather than from the whole file. Connections are
+    opened per call, so it can be used from any thread.
+    """
+
+    def __init__(self, path=ARCHIVE_PATH):
+        self.path = path
+        with self.connect() as db:
+            db.executescript(SCHEMA)
+
+    @contextmanager
+    def connect(self):
+        # One transaction per block, committed on success
+        db = sqlite3.connect(self.path, timeout=30)
+        db.row_factory = sqlite3.Row
+        try:
+            db.execute("PRAGMA foreign_keys = ON")
+            db.execute("PRAGMA journal_mode = WAL")
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def index(self, path, params=None, force=False):
+        """
+        Add or refresh the entry of a .scan directory or CSV file and
+        return its id. Unchanged files are not read again unless force.
+        """
+        path = os.path.abspath(path)
+        modified = self.modified(path)
+        with self.connect() as db:
+            row = db.execute(
+                "SELECT id, modified FROM scans WHERE path = ?", (path,)
+            ).fetchone()
+        if row is not None and row["modified"] == modified and not force:
+            if params is not None:
+                with self.connect() as db:
+                    db.execute(
+                        "UPDATE scans SET params = ?, scan_mode = ? WHERE id = ?",
+                        (json.dumps(params), params.get("scan_mode"), row["id"]),
+                    )
+            return row["id"]
+        if os.path.isdir(path):
+            entry, blocks = self.read_scan_dir(path)
+        else:
+            entry, blocks = self.read_csv(path)
+        if params is not None:
+            entry["params"] = json.dumps(params)
+            entry["scan_mode"] = params.get("scan_mode")
+        entry.update(path=path, modified=modified, indexed=time.time())
+        names = list(entry)
+        with self.connect() as db:
+            if row is not None:
+                db.execute("DELETE FROM blocks WHERE scan_id = ?", (row["id"],))
+                db.execute(
+                    f"UPDATE scans SET {', '.join(f'{name} = ?' for name in names)} WHERE id = ?",
+                    [entry[name] for name in names] + [row["id"]],
+                )
+                scan_id = row["id"]
+            else:
+                scan_id = db.execute(
+                    f"INSERT INTO scans ({', '.join(names)}) VALUES ({', '.join('?' * len(names))})",
+                    [entry[name] for name in names],
+                ).lastrowid
+            db.executemany(
+                "INSERT INTO blocks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(scan_id, number) + block for number, block in enumerate(blocks)],
+            )
+        return scan_id
+
+    def index_directory(self, directory, force=False):
+        """
+        Index every .scan directory and Measurements CSV in directory.
+        """
+        indexed = []
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            is_scan = name.endswith(".scan") and os.path.isdir(path)
+            is_csv = name.endswith(".csv") and os.path.isfile(path)
+            if not (is_scan or is_csv):
+                continue
+            try:
+                indexed.append(self.index(path, force=force))
+            except Exception as e:
+                print(f"---Could not archive {path}: {e}")
+        return indexed
+
+    def modified(self, path):
+        if os.path.isdir(path):
+            return max(
+                (
+                    os.path.getmtime(os.path.join(path, name))
+                    for name in os.listdir(path)
+                ),
+                default=os.path.getmtime(path),
+            )
+        return os.path.getmtime(path)
+
+    def read_scan_dir(self, path):
+        schema = read_schema(path)
+        fields = schema["fields"]
+        epoch_offset_ns = schema.get("epoch_offset_ns", 0)
+        try:
+            checkpoint = read_checkpoint(path)
+        except Exception:
+            checkpoint = {}
+        blocks = []
+        for chunk in list_chunks(path):
+            columns = scan_columns(path, chunk, fields, epoch_offset_ns)
+            rows = len(next(iter(columns.values()), []))
+            blocks.append((chunk, 0, rows) + bounds(columns))
+        columns = ["time" if name == "timestamp_ns" else name for name, _ in fields]
+        entry = {
+            "format": "scan",
+            "schema_version": schema.get("schema_version"),
+            "columns": json.dumps(columns),
+            "status": checkpoint.get("status"),
+            "settings": json.dumps(checkpoint.get("settings")),
+            "instruments": json.dumps(checkpoint.get("instruments")),
+        }
+        entry.update(self.totals(blocks))
+        return entry, blocks
+
+    def read_csv(self, path):
+        blocks = []
+        with open(path, "rb") as f:
+            header = f.readline().decode().strip().split(",")
+            names = [CSV_COLUMNS.get(name, name) for name in header]
+            while True:
+                offset = f.tell()
+                lines = [f.readline() for _ in range(CSV_BLOCK_ROWS)]
+                lines = [line.decode() for line in lines if line]
+                if not lines:
+                    break
+                columns = parse_csv_rows(lines, names)
+                blocks.append(("csv", offset, len(lines)) + bounds(columns))
+        entry = {
+            "format": "csv",
+            # Exports of .scan directories append their extra fields
+            "schema_version": CSV_SCHEMAS.get(tuple(header[: len(CSV_COLUMNS)])),
+            "columns": json.dumps(names),
+        }
+        entry.update(self.totals(blocks))
+        return entry, blocks
+
+    def totals(self, blocks):
+        def extreme(index, pick):
+            values = [block[index] for block in blocks if block[index] is not None]
+            return pick(values) if values else None
+
+        return {
+            "records": sum(block[2] for block in blocks),
+            "started": extreme(3, min),
+            "finished": extreme(4, max),
+            "x_min": extreme(5, min),
+            "x_max": extreme(6, max),
+            "y_min": extreme(7, min),
+            "y_max": extreme(8, max),
+        }
+
+    def scans(
+        self,
+        since=None,
+        until=None,
+        scan_mode=None,
+        region=None,
+        limit=100,
+    ):
+        """
+        Catalogue entries, newest first: started in [since, until], of a
+        scan mode, and covering part of region (x/y limits).
+        """
+        query = "SELECT * FROM scans WHERE 1 = 1"
+        args = []
+        if since is not None:
+            query += " AND started >= ?"
+            args.append(since)
+        if until is not None:
+            query += " AND started <= ?"
+            args.append(until)
+        if scan_mode is not None:
+            query += " AND scan_mode = ?"
+            args.append(scan_mode)
+        for column, limit_name, compare in (
+            ("x_max", "x_min", ">="),
+            ("x_min", "x_max", "<="),
+            ("y_max", "y_min", ">="),
+            ("y_min", "y_max", "<="),
+        ):
+            if region and region.get(limit_name) is not None:
+                query += f" AND {column} {compare} ?"
+                args.append(region[limit_name])
+        query += " ORDER BY started DESC LIMIT ?"
+        args.append(limit)
+        with self.connect() as db:
+            return [self.entry(row) for row in db.execute(query, args)]
+
+    def scan(self, scan_id):
+        with self.connect() as db:
+            row = db.execute("SELECT * FROM scans WHERE id = ?", (scan_id,)).fetchone()
+        if row is None:
+            raise KeyError(f"Unknown scan {scan_id}")
+        return self.entry(row)
+
+    def entry(self, row):
+        entry = dict(row)
+        for name in ("columns", "params", "settings", "instruments"):
+            if entry[name] is not None:
+                entry[name] = json.loads(entry[name])
+        return entry
+
+    def read(self, scan_id, region=None, columns=None, step=1, max_rows=None):
+        """
+        Records of a scan inside region (optional t_min/t_max in epoch
+        seconds, x_min/x_max, y_min/y_max), as one array per column. Only
+        blocks whose bounds overlap the region are read. Every step-th
+        matching record is kept, or an even stride down to max_rows.
+        """
+        region = region or {}
+        entry = self.scan(scan_id)
+        query = "SELECT * FROM blocks WHERE scan_id = ?"
+        args = [scan_id]
+        # Blocks without bounds (e.g. all-NaN positions) are always read
+        for column, limit_name, compare in (
+            ("t_max", "t_min", ">="),
+            ("t_min", "t_max", "<="),
+            ("x_max", "x_min", ">="),
+            ("x_min", "x_max", "<="),
+            ("y_max", "y_min", ">="),
+            ("y_min", "y_max", "<="),
+        ):
+            if region.get(limit_name) is not None:
+                query += f" AND ({column} IS NULL OR {column} {compare} ?)"
+                args.append(region[limit_name])
+        query += " ORDER BY block"
+        with self.connect() as db:
+            blocks = db.execute(query, args).fetchall()
+        names = columns or entry["columns"]
+        unknown = [name for name in names if name not in entry["columns"]]
+        if unknown:
+            raise KeyError(f"Scan {scan_id} has no columns {unknown}")
+        parts = []
+        if entry["format"] == "scan":
+            schema = read_schema(entry["path"])
+            for block in blocks:
+                parts.append(
+                    scan_columns(
+                        entry["path"],
+                        block["source"],
+                        schema["fields"],
+                        schema.get("epoch_offset_ns", 0),
+                    )
+                )
+        else:
+            with open(entry["path"], "rb") as f:
+                for block in blocks:
+                    f.seek(block["offset"])
+                    lines = [f.readline().decode() for _ in range(block["rows"])]
+                    parts.append(parse_csv_rows(lines, entry["columns"]))
+        data = {
+            name: (
+                np.concatenate([part[name] for part in parts]) if parts else np.empty(0)
+            )
+            for name in set(names) | {"time", "positionX", "positionY"}
+            if name in entry["columns"]
+        }
+        matched = region_mask(data, region) if parts else np.zeros(0, dtype=bool)
+        rows = np.flatnonzero(matched)
+        step = max(int(step), 1)
+        if max_rows is not None and len(rows) > max_rows * step:
+            step = int(np.ceil(len(rows) / max_rows))
+        rows = rows[::step]
+        return {
+            "scan_id": scan_id,
+            "blocks_read": len(blocks),
+            "blocks_total": self.block_count(scan_id),
+            "matched": int(matched.sum()),
+            "step": step,
+            "columns": {name: data[name][rows] for name in names},
+        }
+
+    def block_count(self, scan_id):
+        with self.connect() as db:
+            return db.execute(
+                "SELECT COUNT(*) FROM blocks WHERE scan_id = ?", (scan_id,)
+            ).fetchone()[0]
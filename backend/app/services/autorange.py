@@ -0,0 +1,34 @@
+import math
+
+# Ranges to step out of an overload at once: with R clipped the true
+# value is unknown, so go one decade less sensitive and look again
+OVERLOAD_STEP = 3
+
+
+def best_index(r, sensitivities, target):
+    """
+    Index of the most sensitive full scale (sensitivities are ordered
+    from least to most sensitive) that puts r at or below target of it.
+    """
+    for index in range(len(sensitivities) - 1, -1, -1):
+        if abs(r) <= target * sensitivities[index]:
+            return index
+    return 0
+
+
+def next_range(r, index, sensitivities, params):
+    """
+    Decide on the range for a reading r taken at sensitivity index.
+    Returns the new index, or None to stay, and whether r overloads.
+    Between params.lower and params.upper of full scale the range is
+    kept, so a signal near a range boundary does not flip back and forth.
+    """
+    ratio = abs(r) / sensitivities[index]
+    if math.isnan(ratio):
+        return None, False
+    if ratio >= params.overload:
+        return (max(index - OVERLOAD_STEP, 0) if index > 0 else None), True
+    if params.lower <= ratio <= params.upper:
+        return None, False
+    new_index = best_index(r, sensitivities, params.target)
+    return (new_index if new_index != index else None), False
@@ -0,0 +1,107 @@
+import threading
+import time
+import numpy as np
+
+# Number of lock-in time constants each grid cell should span during a sweep
+TIME_CONSTANTS_PER_CELL = 5
+
+
+def choose_sweep_velocity(step_size, time_constant, max_velocity, acceleration):
+    """
+    Velocity at which one grid cell is crossed in TIME_CONSTANTS_PER_CELL
+    lock-in time constants, capped at the channel's max velocity.
+    Returns the velocity and the run-up distance needed to reach it.
+    """
+    velocity = max_velocity
+    if time_constant:
+        velocity = min(
+            max_velocity, step_size / (TIME_CONSTANTS_PER_CELL * time_constant)
+        )
+    run_up = velocity**2 / (2 * acceleration) if acceleration else 0.0
+    return velocity, run_up
+
+
+def sweep_range(xs, step_size, run_up, limits=(0.0, None)):
+    """
+    Start and end of the sweep over the grid positions xs: half a cell and
+    the run-up beyond either end, clamped to the (lower, upper) travel
+    limits. Also returns whether the run-up was cut short.
+    """
+    lower, upper = limits
+    start = xs[0] - step_size / 2 - run_up
+    end = xs[-1] + step_size / 2 + run_up
+    clamped = start < lower or (upper is not None and end > upper)
+    start = max(start, lower)
+    if upper is not None:
+        end = min(end, upper)
+    return start, end, clamped
+
+
+class TimedSampler:
+    """
+    Calls read() on its own thread, interval seconds apart, until stopped
+    and logs every value that is not None with the monotonic time of its
+    call. A slow instrument then never stretches the position log.
+    """
+
+    def __init__(self, read, interval):
+        self.read = read
+        self.interval = interval
+        self.times = []
+        self.values = []
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.is_set():
+            t = time.monotonic()
+            value = self.read()
+            if value is not None:
+                self.times.append(t)
+                self.values.append(value)
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        return self.times, self.values
+
+
+def interpolate_positions(sample_times, position_times, positions):
+    """
+    Position of every sample by linear interpolation of the logged stage
+    positions in time. Repeated readings (the controller only refreshes
+    DevicePosition at its polling interval) are collapsed to the first
+    time they were seen.
+    """
+    position_times = np.asarray(position_times, dtype=np.float64)
+    positions = np.asarray(positions, dtype=np.float64)
+    order = np.argsort(position_times, kind="stable")
+    position_times, positions = position_times[order], positions[order]
+    changed = np.concatenate(([True], np.diff(positions) != 0))
+    # Keep the last reading too so the end of the sweep is anchored
+    changed[-1] = True
+    return np.interp(sample_times, position_times[changed], positions[changed])
+
+
+def bin_samples(sample_positions, values, grid):
+    """
+    Mean and count of the samples falling in each grid cell, where cell i
+    spans grid[i] +/- half a step. Cells without samples are NaN.
+    """
+    grid = np.asarray(grid, dtype=np.float64)
+    if grid.size > 1:
+        half = (grid[1] - grid[0]) / 2
+    else:
+        half = np.inf
+    edges = np.concatenate((grid - half, [grid[-1] + half]))
+    index = np.searchsorted(edges, sample_positions, side="right") - 1
+    inside = (index >= 0) & (index < grid.size)
+    counts = np.bincount(index[inside], minlength=grid.size)
+    sums = np.bincount(
+        index[inside], weights=np.asarray(values)[inside], minlength=grid.size
+    )
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / counts
+    return means, counts
@@ -0,0 +1,273 @@
+import asyncio
+import math
+import struct
+import threading
+import time
+import numpy as np
+
+# STREAMCH code -> columns of every sample, in packet order
+STREAM_CHANNELS = {"X": 0, "XY": 1, "RT": 2, "XYRT": 3}
+STREAM_COLUMNS = {
+    0: ["X"],
+    1: ["X", "Y"],
+    2: ["R", "theta"],
+    3: ["X", "Y", "R", "theta"],
+}
+# STREAMFMT code -> sample type
+STREAM_FORMATS = {"float32": 0, "int16": 1}
+# STREAMPCKT code -> payload bytes
+PACKET_SIZES = [1024, 512, 256, 128]
+
+# Every packet starts with a big-endian 32 bit header:
+#   bits 0-7   packet counter, wraps at 256
+#   bits 8-11  content: STREAMCH code, +4 for int16 samples
+#   bits 12-15 STREAMPCKT code
+#   bits 16-23 STREAMRATE code
+#   bits 24-27 status, bit 24 set on overload
+#   bits 28-31 options, bit 28 set for little-endian samples
+HEADER = struct.Struct(">I")
+OVERLOAD_BIT = 1 << 24
+LITTLE_ENDIAN_BIT = 1 << 28
+
+# int16 samples are fractions of full scale, theta of 180 degrees
+INT16_FULL_SCALE = 32768
+
+
+def parse_header(word):
+    return {
+        "counter": word & 0xFF,
+        "content": (word >> 8) & 0xF,
+        "packet": (word >> 12) & 0xF,
+        "rate": (word >> 16) & 0xFF,
+        "overload": bool(word & OVERLOAD_BIT),
+        "little_endian": bool(word & LITTLE_ENDIAN_BIT),
+    }
+
+
+def encode_packet(counter, content, rate_code, samples, little_endian=True, status=0):
+    """
+    Build a packet the way the SR865A sends it, from a (samples, columns)
+    array already in the wire type (float32 or int16). Used by replayers.
+    """
+    packet = PACKET_SIZES.index(samples.nbytes) if samples.nbytes in PACKET_SIZES else 0
+    word = (
+        (counter & 0xFF)
+        | (content << 8)
+        | (packet << 12)
+        | (rate_code << 16)
+        | status
+        | (LITTLE_ENDIAN_BIT if little_endian else 0)
+    )
+    dtype = samples.dtype.newbyteorder("<" if little_endian else ">")
+    return HEADER.pack(word) + samples.astype(dtype).tobytes()
+
+
+def decode_payload(data, header, sensitivity=None):
+    """
+    View the samples of a packet as a (samples, columns) array without
+    copying the payload. int16 samples are scaled to volts (or amps) and
+    degrees, which needs the full scale, and does copy.
+    """
+    columns = STREAM_COLUMNS[header["content"] & 3]
+    int16 = bool(header["content"] & 4)
+    order = "<" if header["little_endian"] else ">"
+    dtype = np.dtype(f"{order}i2" if int16 else f"{order}f4")
+    payload = memoryview(data)[HEADER.size :]
+    count = len(payload) // (dtype.itemsize * len(columns))
+    samples = np.frombuffer(payload, dtype=dtype, count=count * len(columns))
+    samples = samples.reshape(count, len(columns))
+    if int16:
+        scale = np.array(
+            [180.0 if name == "theta" else (sensitivity or 1.0) for name in columns]
+        )
+        samples = samples * (scale / INT16_FULL_SCALE)
+    return columns, samples
+
+
+class SampleRing:
+    """
+    Fixed-size ring of the most recent stream samples: a monotonic time
+    and one value per column. Samples are numbered from the start of the
+    stream, so readers can ask for everything after the last one they saw.
+    """
+
+    def __init__(self, columns, capacity=1 << 18):
+        self.columns = columns
+        self.capacity = capacity
+        self.times = np.full(capacity, np.nan)
+        self.values = np.full((capacity, len(columns)), np.nan)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def write(self, times, values):
+        with self.lock:
+            n = min(len(times), self.capacity)
+            times, values = times[-n:], values[-n:]
+            start = self.count % self.capacity
+            first = min(n, self.capacity - start)
+            self.times[start : start + first] = times[:first]
+            self.values[start : start + first] = values[:first]
+            self.times[: n - first] = times[first:]
+            self.values[: n - first] = values[first:]
+            self.count += n
+
+    def since(self, index):
+        """
+        Copies of the samples numbered index and later that are still in
+        the ring, and the number of the next sample.
+        """
+        with self.lock:
+            count = self.count
+            index = max(index, count - self.capacity, 0)
+            positions = np.arange(index, count) % self.capacity
+            return self.times[positions], self.values[positions], count
+
+    def search(self, value, first, last):
+        # Sample times increase with the sample number, bisect over numbers
+        while first < last:
+            middle = (first + last) // 2
+            if self.times[middle % self.capacity] < value:
+                first = middle + 1
+            else:
+                last = middle
+        return first
+
+    def window(self, start, end):
+        """
+        Copies of the samples timed within [start, end) of the monotonic
+        clock.
+        """
+        with self.lock:
+            first = max(self.count - self.capacity, 0)
+            lo = self.search(start, first, self.count)
+            hi = self.search(end, lo, self.count)
+            positions = np.arange(lo, hi) % self.capacity
+            return self.times[positions], self.values[positions]
+
+    def latest_time(self):
+        with self.lock:
+            if not self.count:
+                return None
+            return self.times[(self.count - 1) % self.capacity]
+
+
+class LockinStreamIngest(asyncio.DatagramProtocol):
+    """
+    Receives the UDP data stream of an SR865A into a SampleRing. Samples
+    are timed back from the arrival of their packet at the stream rate,
+    and gaps in the packet counter are counted as dropped packets.
+    """
+
+    def __init__(self, rate=None, capacity=1 << 18, sensitivity=None):
+        self.rate = rate
+        self.capacity = capacity
+        # Callable returning the full scale, int16 samples are fractions of it
+        self.sensitivity = sensitivity
+        self.ring = None
+        self.read_index = 0
+        self.transport = None
+        self.last_counter = None
+        self.packets = 0
+        self.dropped = 0
+        self.overloads = 0
+        self.errors = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            self.feed(data, time.monotonic())
+        except Exception as e:
+            self.errors += 1
+            print(f"---Lockin stream packet error: {e}")
+
+    def feed(self, data, arrived):
+        if self.rate is None:
+            # Not configured yet, the rate is needed to time the samples
+            return
+        header = parse_header(HEADER.unpack_from(data)[0])
+        columns, samples = decode_payload(
+            data, header, self.sensitivity() if self.sensitivity else None
+        )
+        if self.ring is None or self.ring.columns != columns:
+            self.ring = SampleRing(columns, self.capacity)
+            self.read_index = 0
+        if self.last_counter is not None:
+            self.dropped += (header["counter"] - self.last_counter - 1) & 0xFF
+        self.last_counter = header["counter"]
+        self.packets += 1
+        if header["overload"]:
+            self.overloads += 1
+        times = arrived - np.arange(len(samples) - 1, -1, -1) / self.rate
+        self.ring.write(times, samples)
+
+    def wait_until(self, end, timeout=0.5):
+        """
+        Block (in a worker thread) until samples up to end have arrived.
+        """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            latest = self.ring.latest_time() if self.ring is not None else None
+            if latest is not None and latest >= end:
+                return True
+            time.sleep(0.001)
+        return False
+
+    def average(self, start, end):
+        """
+        Mean of every column over a monotonic time window, with R and theta
+        derived from X and Y when the stream does not carry them.
+        """
+        if self.ring is None:
+            raise Exception("No lock-in stream data received")
+        self.wait_until(end)
+        times, values = self.ring.window(start, end)
+        if not len(times):
+            # Window shorter than one sample period, use the samples around its end
+            times, values = self.ring.window(end - 1 / self.rate, end + 1 / self.rate)
+        means = dict(zip(self.ring.columns, values.mean(axis=0))) if len(times) else {}
+        return self.snapshot(means), len(times)
+
+    def recent(self):
+        """
+        Mean (X, Y, R, theta) of the samples received since the previous
+        call, or None if there are none; for the live telemetry.
+        """
+        if self.ring is None:
+            return None
+        _, values, self.read_index = self.ring.since(self.read_index)
+        if not len(values):
+            return None
+        return self.snapshot(dict(zip(self.ring.columns, values.mean(axis=0))))
+
+    def snapshot(self, means):
+        x = means.get("X", math.nan)
+        y = means.get("Y", math.nan)
+        r = means.get("R", math.hypot(x, y))
+        theta = means.get("theta", math.degrees(math.atan2(y, x)))
+        return x, y, r, theta
+
+    def stats(self):
+        received = self.ring.count if self.ring is not None else 0
+        return {
+            "rate": self.rate,
+            "packets": self.packets,
+            "dropped_packets": self.dropped,
+            "samples": received,
+            "overloads": self.overloads,
+            "errors": self.errors,
+        }
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+
+async def open_ingest(port, capacity=1 << 18, sensitivity=None, host="0.0.0.0"):
+    loop = asyncio.get_running_loop()
+    _, ingest = await loop.create_datagram_endpoint(
+        lambda: LockinStreamIngest(None, capacity, sensitivity),
+        local_addr=(host, port),
+    )
+    return ingest
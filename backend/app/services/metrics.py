@@ -0,0 +1,327 @@
+import bisect
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Histogram bucket bounds in seconds, from 50 us VISA round trips to long moves
+BUCKETS = [
+    5e-5,
+    1e-4,
+    2.5e-4,
+    5e-4,
+    1e-3,
+    2.5e-3,
+    5e-3,
+    1e-2,
+    2.5e-2,
+    5e-2,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+]
+QUANTILES = [0.5, 0.9, 0.99]
+
+
+class Histogram:
+    """
+    Latency histogram of one device and command: cumulative bucket counts
+    for Prometheus plus the most recent durations for rolling quantiles.
+    """
+
+    def __init__(self, window=1024):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self.lock:
+            self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+            self.count += 1
+            self.sum += seconds
+            self.recent.append(seconds)
+
+    def quantiles(self):
+        with self.lock:
+            recent = sorted(self.recent)
+        if not recent:
+            return {}
+        return {
+            q: recent[min(int(q * len(recent)), len(recent) - 1)] for q in QUANTILES
+        }
+
+
+def bucket_quantile(q, counts, count):
+    """
+    Estimate a quantile from bucket counts, by linear interpolation inside
+    the bucket it falls in.
+    """
+    rank = q * count
+    seen = 0
+    for index, bucket_count in enumerate(counts):
+        if bucket_count and seen + bucket_count >= rank:
+            lower = BUCKETS[index - 1] if index > 0 else 0.0
+            upper = BUCKETS[index] if index < len(BUCKETS) else BUCKETS[-1]
+            return lower + (upper - lower) * (rank - seen) / bucket_count
+        seen += bucket_count
+    return None
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels) + "}"
+
+
+class MetricsRegistry:
+    """
+    Process-wide latency histograms keyed by (device, command) and
+    counters keyed by name and labels. Recording is a dict lookup and a
+    lock per histogram, cheap enough to leave on during scans.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def histogram(self, device, command):
+        key = (device, command)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram())
+        return histogram
+
+    def observe(self, device, command, seconds):
+        self.histogram(device, command).observe(seconds)
+
+    def mean(self, device, command):
+        """
+        Mean of the most recent durations, None before the first call.
+        """
+        histogram = self.histograms.get((device, command))
+        if histogram is None:
+            return None
+        with histogram.lock:
+            recent = list(histogram.recent)
+        return sum(recent) / len(recent) if recent else None
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    @contextmanager
+    def timer(self, device, command):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(device, command, time.perf_counter() - start)
+
+    def error(self, device, command, error):
+        message = str(error).lower()
+        if "timeout" in message or "timed out" in message:
+            kind = "timeout"
+        else:
+            kind = "error"
+        self.increment(
+            "tops_instrument_errors_total", device=device, command=command, kind=kind
+        )
+
+    def snapshot(self):
+        """
+        Copy of all histogram counts and counters, for report().
+        """
+        histograms = {}
+        for key, histogram in list(self.histograms.items()):
+            with histogram.lock:
+                histograms[key] = (
+                    list(histogram.counts),
+                    histogram.count,
+                    histogram.sum,
+                )
+        with self.lock:
+            counters = dict(self.counters)
+        return histograms, counters
+
+    def report(self, since=None):
+        """
+        Timings recorded since an earlier snapshot, e.g. for one scan:
+        count, total, mean and estimated quantiles per device and command,
+        plus the counter increments.
+        """
+        before_histograms, before_counters = since or ({}, {})
+        histograms, counters = self.snapshot()
+        timings = {}
+        for (device, command), (counts, count, total) in histograms.items():
+            old_counts, old_count, old_total = before_histograms.get(
+                (device, command), ([0] * len(counts), 0, 0.0)
+            )
+            count -= old_count
+            if not count:
+                continue
+            counts = [new - old for new, old in zip(counts, old_counts)]
+            total -= old_total
+            timings[f"{device}.{command}"] = {
+                "count": count,
+                "total": total,
+                "mean": total / count,
+                "p50": bucket_quantile(0.5, counts, count),
+                "p95": bucket_quantile(0.95, counts, count),
+            }
+        events = {}
+        for (name, labels), value in counters.items():
+            value -= before_counters.get((name, labels), 0)
+            if value:
+                events[name + format_labels(labels)] = value
+        return {"timings": timings, "counters": events}
+
+    def render(self):
+        """
+        All metrics in the Prometheus text exposition format.
+        """
+        lines = [
+            "# HELP tops_instrument_seconds Duration of instrument calls and scan steps.",
+            "# TYPE tops_instrument_seconds histogram",
+        ]
+        recent = [
+            "# HELP tops_instrument_recent_seconds Quantiles over the most recent calls.",
+            "# TYPE tops_instrument_recent_seconds summary",
+        ]
+        for (device, command), histogram in sorted(self.histograms.items()):
+            with histogram.lock:
+                counts, count, total = (
+                    list(histogram.counts),
+                    histogram.count,
+                    histogram.sum,
+                )
+            labels = [("device", device), ("command", command)]
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS + ["+Inf"], counts):
+                cumulative += bucket_count
+                lines.append(
+                    f"tops_instrument_seconds_bucket{format_labels(labels + [('le', bound)])} {cumulative}"
+                )
+            lines.append(f"tops_instrument_seconds_sum{format_labels(labels)} {total}")
+            lines.append(
+                f"tops_instrument_seconds_count{format_labels(labels)} {count}"
+            )
+            for q, value in histogram.quantiles().items():
+                recent.append(
+                    f"tops_instrument_recent_seconds{format_labels(labels + [('quantile', q)])} {value}"
+                )
+            # Quantiles cover the recent calls, sum and count all of them as usual for summaries
+            recent.append(
+                f"tops_instrument_recent_seconds_sum{format_labels(labels)} {total}"
+            )
+            recent.append(
+                f"tops_instrument_recent_seconds_count{format_labels(labels)} {count}"
+            )
+        lines += recent
+        with self.lock:
+            counters = sorted(self.counters.items())
+        names = sorted({name for (name, _), _ in counters})
+        for name in names:
+            lines.append(f"# TYPE {name} counter")
+            for (counter_name, labels), value in counters:
+                if counter_name == name:
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+def command_name(command):
+    """
+    Metric label for a VISA command: its header without arguments, so
+    "FREQ 1000" and "FREQ 2000" share one histogram.
+    """
+    return command.strip().split(" ", 1)[0].upper()
+
+
+class TracedResource:
+    """
+    Wraps a pyvisa resource and times every write and query by command.
+    Other attributes (timeout, close, ...) pass through.
+    """
+
+    def __init__(self, inst, device):
+        self.__dict__["inst"] = inst
+        self.__dict__["device"] = device
+
+    def call(self, method, command, *args, **kwargs):
+        name = command_name(command)
+        start = time.perf_counter()
+        try:
+            return getattr(self.inst, method)(command, *args, **kwargs)
+        except Exception as e:
+            registry.error(self.device, name, e)
+            raise
+        finally:
+            registry.observe(self.device, name, time.perf_counter() - start)
+
+    def write(self, command, *args, **kwargs):
+        return self.call("write", command, *args, **kwargs)
+
+    def query(self, command, *args, **kwargs):
+        return self.call("query", command, *args, **kwargs)
+
+    def query_ascii_values(self, command, *args, **kwargs):
+        return self.call("query_ascii_values", command, *args, **kwargs)
+
+    def query_binary_values(self, command, *args, **kwargs):
+        return self.call("query_binary_values", command, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.inst, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.inst, name, value)
+
+
+class TracedChannel:
+    """
+    Wraps a Kinesis channel and times every method call (MoveTo, Home,
+    ...) and property read (DevicePosition, IsDeviceBusy, ...) by name.
+    """
+
+    def __init__(self, channel, device):
+        self.__dict__["channel"] = channel
+        self.__dict__["device"] = device
+
+    def __getattr__(self, name):
+        start = time.perf_counter()
+        attribute = getattr(self.channel, name)
+        if not callable(attribute):
+            registry.observe(self.device, name, time.perf_counter() - start)
+            return attribute
+
+        def traced(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return attribute(*args, **kwargs)
+            except Exception as e:
+                registry.error(self.device, name, e)
+                raise
+            finally:
+                registry.observe(self.device, name, time.perf_counter() - start)
+
+        return traced
+
+    def __setattr__(self, name, value):
+        setattr(self.channel, name, value)
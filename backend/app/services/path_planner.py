@@ -0,0 +1,177 @@
+import numpy as np
+
+GRID_STRATEGIES = ["raster", "serpentine", "spiral"]
+POINT_STRATEGIES = ["given", "nearest", "2opt"]
+
+
+def axis_points(start, stop, step_size):
+    """
+    Grid positions from start to stop (inclusive, with a small tolerance
+    for floating point error), computed from the iteration count so the
+    error does not accumulate.
+    """
+    lo, hi = min(start, stop), max(start, stop)
+    count = int(np.floor((hi - lo) / step_size + 1e-9)) + 1
+    return lo + np.arange(count) * step_size
+
+
+def move_time(distance, max_velocity, acceleration):
+    """
+    Duration of a point-to-point move under a trapezoidal velocity
+    profile (triangular when the move is too short to reach max velocity).
+    """
+    distance = np.abs(distance)
+    if not acceleration:
+        return distance / max_velocity
+    ramp = max_velocity**2 / acceleration
+    return np.where(
+        distance < ramp,
+        2 * np.sqrt(distance / acceleration),
+        distance / max_velocity + max_velocity / acceleration,
+    )
+
+
+def leg_time(a, b, kinematics, simultaneous=False):
+    """
+    Time to move between points a and b (arrays of shape (..., 2)).
+    The axes either move one after the other or together.
+    """
+    a, b = np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64)
+    tx = move_time(b[..., 0] - a[..., 0], *kinematics[1])
+    ty = move_time(b[..., 1] - a[..., 1], *kinematics[2])
+    if simultaneous:
+        return np.maximum(tx, ty)
+    return tx + ty
+
+
+def spiral_cells(nx, ny):
+    """
+    (i, j) indices of an nx by ny grid in a spiral from the centre
+    outward. Built as the walk around each ring from the outside in,
+    then reversed, so every move is to a neighbouring cell, also on even
+    grids whose centre falls between cells.
+    """
+    cells = []
+    left, right, bottom, top = 0, nx - 1, 0, ny - 1
+    while left <= right and bottom <= top:
+        cells += [(i, bottom) for i in range(left, right + 1)]
+        cells += [(right, j) for j in range(bottom + 1, top + 1)]
+        if bottom < top:
+            cells += [(i, top) for i in range(right - 1, left - 1, -1)]
+        if left < right:
+            cells += [(left, j) for j in range(top - 1, bottom, -1)]
+        left, right, bottom, top = left + 1, right - 1, bottom + 1, top - 1
+    return cells[::-1]
+
+
+def plan_grid(xs, ys, strategy="serpentine"):
+    """
+    Order the points of the xs by ys grid. Returns a list of (x, y).
+    """
+    if strategy == "raster":
+        return [(float(x), float(y)) for y in ys for x in xs]
+    if strategy == "serpentine":
+        return [
+            (float(x), float(y))
+            for row, y in enumerate(ys)
+            for x in (xs if row % 2 == 0 else xs[::-1])
+        ]
+    if strategy == "spiral":
+        return [(float(xs[i]), float(ys[j])) for i, j in spiral_cells(len(xs), len(ys))]
+    raise ValueError(f"Unknown path strategy: {strategy}")
+
+
+def nearest_neighbour(points, kinematics, start=None, simultaneous=False):
+    """
+    Greedy ordering that always moves to the quickest unvisited point.
+    """
+    remaining = np.asarray(points, dtype=np.float64)
+    current = remaining[0] if start is None else np.asarray(start, dtype=np.float64)
+    route = []
+    while len(remaining):
+        index = int(np.argmin(leg_time(current, remaining, kinematics, simultaneous)))
+        current = remaining[index]
+        route.append(current)
+        remaining = np.delete(remaining, index, axis=0)
+    return np.array(route)
+
+
+def two_opt(route, kinematics, simultaneous=False, max_passes=10):
+    """
+    Improve an open path by reversing segments while that shortens the
+    total travel time. Each pass tries every first edge against all later
+    edges at once.
+    """
+    route = np.array(route, dtype=np.float64)
+    n = len(route)
+    for _ in range(max_passes):
+        improved = False
+        for i in range(n - 2):
+            a, b = route[i], route[i + 1]
+            js = np.arange(i + 2, n)
+            c = route[js]
+            has_next = js < n - 1
+            d = route[np.minimum(js + 1, n - 1)]
+            old = leg_time(a, b, kinematics, simultaneous) + np.where(
+                has_next, leg_time(c, d, kinematics, simultaneous), 0
+            )
+            new = leg_time(a, c, kinematics, simultaneous) + np.where(
+                has_next, leg_time(b, d, kinematics, simultaneous), 0
+            )
+            best = int(np.argmin(new - old))
+            if new[best] - old[best] < -1e-9:
+                j = js[best]
+                route[i + 1 : j + 1] = route[i + 1 : j + 1][::-1].copy()
+                improved = True
+        if not improved:
+            break
+    return route
+
+
+def order_points(points, strategy, kinematics, start=None, simultaneous=False):
+    """
+    Order an arbitrary list of (x, y) points.
+    """
+    if strategy == "given":
+        route = np.asarray(points, dtype=np.float64)
+    elif strategy == "nearest":
+        route = nearest_neighbour(points, kinematics, start, simultaneous)
+    elif strategy == "2opt":
+        route = two_opt(
+            nearest_neighbour(points, kinematics, start, simultaneous),
+            kinematics,
+            simultaneous,
+        )
+    else:
+        raise ValueError(f"Unknown path strategy: {strategy}")
+    return [(float(x), float(y)) for x, y in route]
+
+
+def estimate_travel(points, kinematics, start=None, simultaneous=False):
+    """
+    Total per-axis travel distance and estimated move time of a path.
+    """
+    route = np.asarray(points, dtype=np.float64)
+    if start is not None:
+        route = np.vstack(([start], route))
+    if len(route) < 2:
+        return 0.0, 0.0
+    distance = float(np.abs(np.diff(route, axis=0)).sum())
+    duration = float(leg_time(route[:-1], route[1:], kinematics, simultaneous).sum())
+    return distance, duration
+
+
+def compare_plans(xs, ys, kinematics, start=None, simultaneous=False):
+    """
+    Travel estimate of every grid strategy for the same grid.
+    """
+    plans = {}
+    for strategy in GRID_STRATEGIES:
+        points = plan_grid(xs, ys, strategy)
+        distance, duration = estimate_travel(points, kinematics, start, simultaneous)
+        plans[strategy] = {
+            "points": len(points),
+            "travel_distance": distance,
+            "travel_time": duration,
+        }
+    return plans
@@ -0,0 +1,80 @@
+import threading
+import time
+import numpy as np
+from app.utils.file_utils import SCAN_FIELDS, to_number
+
+SCAN_DTYPE = np.dtype(SCAN_FIELDS)
+
+
+def empty_rows(count):
+    rows = np.zeros(count, dtype=SCAN_DTYPE)
+    for name in SCAN_DTYPE.names:
+        if SCAN_DTYPE[name].kind == "f":
+            rows[name] = np.nan
+    return rows
+
+
+class ScanBuffer:
+    """
+    Preallocated structured array holding the records of one scan. Grid
+    scans size it from the plan, open-ended scans grow it by grow_by rows.
+    Readers get views into the array rather than copies; a view taken
+    before the buffer grows keeps pointing at the old (still valid) rows.
+    """
+
+    def __init__(self, capacity=None, grow_by=4096):
+        self.grow_by = grow_by
+        self.data = empty_rows(capacity or grow_by)
+        self.size = 0
+        # Offset from monotonic to wall-clock time, to convert timestamps for export
+        self.epoch_offset_ns = time.time_ns() - time.monotonic_ns()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.size
+
+    def grow(self, rows):
+        data = empty_rows(len(self.data) + rows)
+        data[: self.size] = self.data[: self.size]
+        self.data = data
+
+    def append(self, record):
+        """
+        Store a record dict and return its row index.
+        """
+        with self.lock:
+            if self.size == len(self.data):
+                self.grow(self.grow_by)
+            index = self.size
+            self.set(index, record)
+            self.size += 1
+        return index
+
+    def extend(self, columns):
+        """
+        Append rows given as one array per field, e.g. from read_scan.
+        """
+        count = len(next(iter(columns.values()), ()))
+        with self.lock:
+            if self.size + count > len(self.data):
+                self.grow(self.size + count - len(self.data) + self.grow_by)
+            for name in SCAN_DTYPE.names:
+                if name in columns:
+                    self.data[name][self.size : self.size + count] = columns[name]
+            self.size += count
+
+    def set(self, index, record):
+        for name in SCAN_DTYPE.names:
+            if name in record:
+                self.data[name][index] = to_number(record[name])
+
+    def view(self, start=0, stop=None):
+        """
+        Rows start..stop of the filled part of the buffer, without copying.
+        """
+        if stop is None or stop > self.size:
+            stop = self.size
+        return self.data[start:stop]
+
+    def column(self, name):
+        return self.data[name][: self.size]
@@ -0,0 +1,272 @@
+import asyncio
+import threading
+import time
+import uuid
+from app.models.state import global_state
+from app.models.stage import AdaptiveParams, ResumeParams
+
+
+class ScanCancelled(Exception):
+    pass
+
+
+class ScanJob:
+    """
+    One queued scan. The scan loop calls checkpoint() between points,
+    which records progress, blocks while the job is paused and raises
+    ScanCancelled once a cancel has been requested. The ScanPlan the
+    scan runs from is kept with the job so progress can be compared with
+    its estimate.
+    """
+
+    def __init__(self, params, on_update=None, plan=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.params = params
+        self.plan = plan
+        self.status = "queued"
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.points_done = 0
+        self.points_total = None
+        self.paused_seconds = 0.0
+        self.summary = None
+        self.output = None
+        self.error = None
+        self.archive_id = None
+        self.cancel_requested = False
+        self.resume_event = threading.Event()
+        self.resume_event.set()
+        self.on_update = on_update
+        self.last_update = 0.0
+
+    def update(self, force=False):
+        # Progress is throttled to a few messages per second
+        now = time.monotonic()
+        if self.on_update is not None and (force or now - self.last_update >= 0.25):
+            self.last_update = now
+            self.on_update(self.to_dict())
+
+    def checkpoint(self, done, total):
+        self.points_done = done
+        self.points_total = total
+        self.update(force=done == 0)
+        if not self.resume_event.is_set():
+            self.status = "paused"
+            self.update(force=True)
+            paused_at = time.monotonic()
+            self.resume_event.wait()
+            self.paused_seconds += time.monotonic() - paused_at
+            if not self.cancel_requested:
+                self.status = "running"
+                self.update(force=True)
+        if self.cancel_requested:
+            raise ScanCancelled()
+
+    def pause(self):
+        if self.status in ("queued", "running"):
+            self.resume_event.clear()
+
+    def resume(self):
+        self.resume_event.set()
+
+    def cancel(self):
+        self.cancel_requested = True
+        self.resume_event.set()
+        if self.status == "queued":
+            self.status = "cancelled"
+            self.finished = time.time()
+            self.update(force=True)
+
+    def progress(self):
+        elapsed = None
+        rate = None
+        eta = None
+        if self.started is not None:
+            end = self.finished or time.time()
+            elapsed = end - self.started - self.paused_seconds
+            if elapsed > 0 and self.points_done:
+                rate = self.points_done / elapsed
+                if self.points_total:
+                    eta = (self.points_total - self.points_done) / rate
+        return {
+            "points_done": self.points_done,
+            "points_total": self.points_total,
+            "elapsed": elapsed,
+            "samples_per_second": rate,
+            "eta": eta,
+        }
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "progress": self.progress(),
+            "summary": self.summary,
+            "output": self.output,
+            "archive_id": self.archive_id,
+            "error": self.error,
+            "params": self.params.model_dump(),
+            "plan_id": self.plan.id if self.plan is not None else None,
+            "estimate": self.plan.estimate if self.plan is not None else None,
+        }
+
+
+def run_scan_job(job):
+    """
+    Run a job's scan on the stage. Called on the stage's I/O thread.
+    Jobs submitted without a ScanPlan are planned here, so every scan
+    runs from the same expansion /plan reports.
+    """
+    params = job.params
+    stage = global_state.stage
+    if isinstance(params, ResumeParams):
+        return stage.resume_scan(params.path, job=job, retry=params.retry)
+    if job.plan is None:
+        job.plan = stage.plan_scan(params)
+        job.update(force=True)
+    if params.scan_mode == "fly":
+        return stage.fly_scan_rectangle(
+            params.x1,
+            params.y1,
+            params.x2,
+            params.y2,
+            params.x_steps,
+            params.y_steps,
+            params.x_step_size,
+            params.y_step_size,
+            params.movement_mode,
+            params.acquisition_mode,
+            params.capture_rate,
+            params.path_strategy,
+            job=job,
+            scan_plan=job.plan,
+        )
+    if params.scan_mode == "adaptive":
+        return stage.adaptive_scan(
+            params.x1,
+            params.y1,
+            params.x2,
+            params.y2,
+            params.x_steps,
+            params.y_steps,
+            params.x_step_size,
+            params.y_step_size,
+            params.movement_mode,
+            params.delay,
+            params.adaptive or AdaptiveParams(),
+            params.acquisition_mode,
+            params.capture_rate,
+            params.settle,
+            job=job,
+            retry=params.retry,
+            multimeter=params.multimeter,
+            auto_range=params.auto_range,
+            scan_plan=job.plan,
+        )
+    return stage.move_in_rectangle(
+        params.x1,
+        params.y1,
+        params.x2,
+        params.y2,
+        params.x_steps,
+        params.y_steps,
+        params.x_step_size,
+        params.y_step_size,
+        params.movement_mode,
+        params.delay,
+        params.acquisition_mode,
+        params.capture_rate,
+        params.path_strategy,
+        params.points,
+        params.settle,
+        job=job,
+        retry=params.retry,
+        multimeter=params.multimeter,
+        auto_range=params.auto_range,
+        scan_plan=job.plan,
+        sweep=params.sweep if params.scan_mode == "sweep" else None,
+    )
+
+
+class ScanScheduler:
+    """
+    FIFO queue of scan jobs run one at a time against the stage. Progress
+    of every job is published to the "jobs" topic of the telemetry hub.
+    Must be created and used from the event loop.
+    """
+
+    def __init__(self, hub=None):
+        self.hub = hub
+        self.jobs = {}
+        self.queue = asyncio.Queue()
+        self.loop = asyncio.get_running_loop()
+        self.task = None
+
+    def publish(self, message):
+        if self.hub is not None:
+            self.loop.call_soon_threadsafe(self.hub.publish, "jobs", message)
+
+    def submit(self, params, plan=None):
+        job = ScanJob(params, self.publish, plan)
+        self.jobs[job.id] = job
+        self.queue.put_nowait(job)
+        job.update(force=True)
+        return job
+
+    def get(self, job_id):
+        if job_id not in self.jobs:
+            raise KeyError(f"Unknown job {job_id}")
+        return self.jobs[job_id]
+
+    def list(self):
+        return [job.to_dict() for job in self.jobs.values()]
+
+    async def worker(self):
+        while True:
+            job = await self.queue.get()
+            if job.cancel_requested:
+                continue
+            job.status = "paused" if not job.resume_event.is_set() else "running"
+            job.started = time.time()
+            job.update(force=True)
+            try:
+                job.summary = await global_state.stage.run(run_scan_job, job)
+                status = "completed"
+            except ScanCancelled:
+                status = "cancelled"
+            except Exception as e:
+                print(f"---Scan job {job.id} failed: {e}")
+                status = "failed"
+                job.error = str(e)
+            # Partial scans are archived too, the job ends once its entry exists
+            if job.output is not None and global_state.archive is not None:
+                await self.archive(job)
+            job.status = status
+            job.finished = time.time()
+            job.update(force=True)
+
+    async def archive(self, job):
+        # A resumed scan keeps the parameters it was archived with
+        params = None
+        if not isinstance(job.params, ResumeParams):
+            params = job.params.model_dump()
+        try:
+            job.archive_id = await self.loop.run_in_executor(
+                None, global_state.archive.index, job.output, params
+            )
+        except Exception as e:
+            print(f"---Could not archive {job.output}: {e}")
+
+    def start(self):
+        self.task = asyncio.create_task(self.worker())
+
+    async def stop(self):
+        for job in self.jobs.values():
+            job.cancel()
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
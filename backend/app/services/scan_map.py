@@ -0,0 +1,134 @@
+import math
+import struct
+import threading
+import numpy as np
+
+MAP_QUANTITIES = ["R", "X", "Y", "theta", "voltage"]
+
+# Binary frames, little-endian. Full: type, downsample factor, rows, cols,
+# sequence, then rows * cols float32 (NaN where nothing was measured yet).
+# Delta: type, sequence, count, then count uint32 cell indices into the
+# full-resolution grid (row-major) and count float32 values.
+FULL_FRAME = 1
+DELTA_FRAME = 2
+FULL_HEADER = struct.Struct("<BHIII")
+DELTA_HEADER = struct.Struct("<BII")
+
+# Axes of point-list scans are binned down to this many positions
+MAX_AXIS_POINTS = 2048
+
+
+def map_axis(values):
+    axis = np.unique(np.round(np.asarray(values, dtype=np.float64), 9))
+    if len(axis) > MAX_AXIS_POINTS:
+        axis = np.linspace(axis[0], axis[-1], MAX_AXIS_POINTS)
+    return axis
+
+
+def nearest_index(axis, values):
+    values = np.asarray(values, dtype=np.float64)
+    if len(axis) == 1:
+        return np.zeros(values.shape, dtype=np.int64)
+    index = np.clip(np.searchsorted(axis, values), 1, len(axis) - 1)
+    closer_left = values - axis[index - 1] < axis[index] - values
+    return index - closer_left
+
+
+class ScanMap:
+    """
+    Server-side image of the active scan: one 2D grid per quantity and a
+    per-cell sequence number of the last update, so every client can be
+    sent just the cells that changed since its last frame, however far
+    behind it is. Updated from the scan thread, read from the event loop.
+    """
+
+    def __init__(self, plan=None, xs=None, ys=None):
+        self.plan = plan
+        self.xs = map_axis([x for x, _ in plan]) if xs is None else np.asarray(xs)
+        self.ys = map_axis([y for _, y in plan]) if ys is None else np.asarray(ys)
+        shape = (len(self.ys), len(self.xs))
+        self.grids = {
+            name: np.full(shape, np.nan, dtype=np.float32) for name in MAP_QUANTITIES
+        }
+        self.versions = np.zeros(shape, dtype=np.int64)
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+    def meta(self, quantity, factor):
+        return {
+            "type": "meta",
+            "quantity": quantity,
+            "shape": list(self.versions.shape),
+            "x": [float(self.xs[0]), float(self.xs[-1])],
+            "y": [float(self.ys[0]), float(self.ys[-1])],
+            "downsample": factor,
+        }
+
+    def update_rows(self, rows):
+        """
+        Enter records (rows of the scan buffer) into the map. Points are
+        placed by their planned coordinates when the map has a plan,
+        otherwise by the recorded positions.
+        """
+        if not len(rows):
+            return
+        if self.plan is not None:
+            points = np.array([self.plan[int(index)] for index in rows["point_index"]])
+            x, y = points[:, 0], points[:, 1]
+        else:
+            x, y = rows["positionX"], rows["positionY"]
+        i = nearest_index(self.xs, x)
+        j = nearest_index(self.ys, y)
+        with self.lock:
+            self.sequence += 1
+            for name in MAP_QUANTITIES:
+                self.grids[name][j, i] = rows[name]
+            self.versions[j, i] = self.sequence
+
+    def downsample_factor(self, max_cells):
+        return max(1, math.ceil(math.sqrt(self.versions.size / max_cells)))
+
+    def full_frame(self, quantity, factor):
+        """
+        The whole grid averaged over factor x factor blocks, and the
+        sequence number it is current to.
+        """
+        with self.lock:
+            grid = self.grids[quantity].copy()
+            sequence = self.sequence
+        if factor > 1:
+            rows, cols = grid.shape
+            padded = np.full(
+                (math.ceil(rows / factor) * factor, math.ceil(cols / factor) * factor),
+                np.nan,
+                dtype=np.float32,
+            )
+            padded[:rows, :cols] = grid
+            blocks = padded.reshape(
+                padded.shape[0] // factor, factor, padded.shape[1] // factor, factor
+            )
+            counts = np.sum(~np.isnan(blocks), axis=(1, 3))
+            sums = np.nansum(blocks, axis=(1, 3))
+            with np.errstate(invalid="ignore", divide="ignore"):
+                grid = np.where(counts > 0, sums / counts, np.nan).astype(np.float32)
+        header = FULL_HEADER.pack(
+            FULL_FRAME, factor, grid.shape[0], grid.shape[1], sequence
+        )
+        return header + grid.astype("<f4").tobytes(), sequence
+
+    def delta_frame(self, quantity, since):
+        """
+        The cells updated after sequence number since, or None if there
+        are none, and the new sequence number.
+        """
+        with self.lock:
+            if self.sequence == since:
+                return None, since
+            changed = np.flatnonzero(self.versions > since)
+            values = self.grids[quantity].ravel()[changed]
+            sequence = self.sequence
+        header = DELTA_HEADER.pack(DELTA_FRAME, sequence, len(changed))
+        return (
+            header + changed.astype("<u4").tobytes() + values.astype("<f4").tobytes(),
+            sequence,
+        )
@@ -0,0 +1,263 @@
+import time
+import uuid
+import numpy as np
+from app.services.fly_scan import choose_sweep_velocity, sweep_range
+from app.services.metrics import registry as metrics
+from app.services.path_planner import (
+    POINT_STRATEGIES,
+    axis_points,
+    estimate_travel,
+    leg_time,
+    move_time,
+    order_points,
+    plan_grid,
+)
+from app.services.settling import SETTLE_TIME_CONSTANTS, full_settle_time
+from app.services.sweep import sweep_settle, sweep_steps
+
+# Acquisition time per point assumed before any has been measured
+DEFAULT_ACQUIRE_TIME = 0.02
+
+
+def grid_axis(start, stop, steps, step_size, movement_mode, name):
+    """
+    Grid positions of one axis and warnings about them. With "steps" the
+    span is divided into exactly steps intervals, both ends included;
+    with a step size the axis starts at the lower end. Warnings only say
+    when the grid differs from what was asked: an empty span, or an upper
+    end that is not on the grid.
+    """
+    lo, hi = min(start, stop), max(start, stop)
+    warnings = []
+    if movement_mode == "steps":
+        if not steps or steps < 1:
+            raise ValueError(f"{name}_steps must be at least 1")
+        axis = np.linspace(lo, hi, int(steps) + 1)
+        if hi == lo and steps > 1:
+            warnings.append(
+                f"{name} range is empty, all {int(steps) + 1} {name} positions are {lo:g}"
+            )
+        return axis, warnings
+    if not step_size or step_size <= 0:
+        raise ValueError(f"{name}_step_size must be positive")
+    axis = axis_points(lo, hi, step_size)
+    if hi - axis[-1] > 1e-9 * max(abs(hi), 1.0):
+        warnings.append(
+            f"{name} = {hi:g} is not on the grid, the last {name} is {axis[-1]:g}"
+        )
+    return axis, warnings
+
+
+def acquire_time():
+    """
+    Measured mean time to record a point: the whole concurrent read if
+    a scan has run, otherwise the slowest instrument read seen so far.
+    """
+    measured = metrics.mean("scan", "acquire")
+    if measured is not None:
+        return measured, "measured"
+    reads = [
+        metrics.mean("lockin", "SNAPD?"),
+        metrics.mean("multimeter", "READ?"),
+        metrics.mean("stage_ch1", "DevicePosition"),
+    ]
+    reads = [value for value in reads if value is not None]
+    if reads:
+        return max(reads), "instruments"
+    return DEFAULT_ACQUIRE_TIME, "default"
+
+
+def dwell_time(params, lockin_state, settle=None):
+    """
+    Expected wait at every point: the fixed delay, or the settle time
+    (measured in earlier scans when the output is watched for convergence).
+    In capture and stream modes the delay is the dwell window and is
+    waited after settling too.
+    """
+    delay = 1.0 if params.delay is None else params.delay
+    settle = settle or params.settle
+    if settle is None:
+        return delay
+    if params.acquisition_mode not in ("capture", "stream"):
+        delay = 0.0
+    if settle.mode == "time_constants":
+        count = settle.time_constants
+        if count is None:
+            count = SETTLE_TIME_CONSTANTS.get(lockin_state.filter_slope, 10)
+        return delay + count * (lockin_state.time_constant or 0.0)
+    measured = metrics.mean("scan", "settle")
+    if measured is None:
+        measured = full_settle_time(lockin_state)
+    return delay + measured
+
+
+class ScanPlan:
+    """
+    A scan expanded ahead of time: the exact ordered points, the grid
+    axes and the estimated duration. /plan returns it for review and a
+    scan started from it visits exactly these points.
+    """
+
+    def __init__(self, params, points, xs=None, ys=None, warnings=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.created = time.time()
+        self.params = params
+        self.points = points
+        self.xs = xs
+        self.ys = ys
+        self.warnings = warnings or []
+        self.estimate = None
+
+    def summary(self, include_points=False):
+        summary = {
+            "plan_id": self.id,
+            "created": self.created,
+            "scan_mode": self.params.scan_mode,
+            "path_strategy": self.params.path_strategy,
+            "points": len(self.points),
+            "estimate": self.estimate,
+            "warnings": self.warnings,
+        }
+        if self.xs is not None:
+            summary["axes"] = {
+                name: {
+                    "count": len(axis),
+                    "first": float(axis[0]),
+                    "last": float(axis[-1]),
+                    "step": float(axis[1] - axis[0]) if len(axis) > 1 else None,
+                }
+                for name, axis in (("x", self.xs), ("y", self.ys))
+            }
+        if include_points:
+            summary["point_list"] = [list(point) for point in self.points]
+        return summary
+
+
+def build_plan(params, kinematics, start, lockin_state, x_limits=(0.0, None)):
+    """
+    Expand RectangleParams into a ScanPlan and estimate it from the
+    channel kinematics, the start position of the stage, the dwell at
+    every point and the measured instrument latency. Fly sweeps are
+    clamped to x_limits, the X travel limits.
+    """
+    warnings = []
+    xs = ys = None
+    if params.scan_mode == "sweep":
+        if params.sweep is None:
+            raise ValueError("A sweep scan needs sweep parameters")
+        sweep_steps(params.sweep)
+    if params.scan_mode == "fly" and params.points is not None:
+        raise ValueError("Fly scans sweep whole rows, give a rectangle, not points")
+    if params.points is not None:
+        strategy = params.path_strategy
+        if strategy not in POINT_STRATEGIES:
+            strategy = "2opt"
+        points = order_points(
+            params.points, strategy, kinematics, start, simultaneous=True
+        )
+    else:
+        xs, x_warnings = grid_axis(
+            params.x1,
+            params.x2,
+            params.x_steps,
+            params.x_step_size,
+            params.movement_mode,
+            "x",
+        )
+        ys, y_warnings = grid_axis(
+            params.y1,
+            params.y2,
+            params.y_steps,
+            params.y_step_size,
+            params.movement_mode,
+            "y",
+        )
+        warnings += x_warnings + y_warnings
+        strategy = "serpentine" if params.scan_mode == "adaptive" else None
+        points = plan_grid(xs, ys, strategy or params.path_strategy)
+    plan = ScanPlan(params, points, xs, ys, warnings)
+    if params.scan_mode == "fly":
+        plan.estimate = estimate_fly(plan, kinematics, start, lockin_state, x_limits)
+    else:
+        plan.estimate = estimate_steps(plan, kinematics, start, lockin_state)
+    if params.scan_mode == "adaptive":
+        plan.warnings.append(
+            "Adaptive scans add points where the signal changes, the estimate covers the coarse grid"
+        )
+    return plan
+
+
+def estimate_steps(plan, kinematics, start, lockin_state):
+    """
+    Step scans move, wait and read at every point; sweeps wait and read
+    once per reference frequency, changing the reference in between.
+    """
+    distance, travel = estimate_travel(
+        plan.points, kinematics, start, simultaneous=True
+    )
+    steps = 1
+    reference = 0.0
+    settle = None
+    if plan.params.scan_mode == "sweep":
+        steps = len(plan.params.sweep.frequencies)
+        settle = sweep_settle(plan.params.settle)
+        reference = (steps - 1) * (metrics.mean("lockin", "FREQ") or 0.0)
+    dwell = dwell_time(plan.params, lockin_state, settle) * steps + reference
+    acquire, source = acquire_time()
+    acquire *= steps
+    if source == "default":
+        plan.warnings.append(
+            "No instrument latency measured yet, assumed "
+            f"{DEFAULT_ACQUIRE_TIME * 1000:.0f} ms per point"
+        )
+    count = len(plan.points)
+    estimate = {
+        "travel_distance": distance,
+        "travel_time": travel,
+        "dwell_time": dwell * count,
+        "acquire_time": acquire * count,
+        "acquire_source": source,
+        "per_point": (travel + (dwell + acquire) * count) / count if count else 0.0,
+        "eta": travel + (dwell + acquire) * count,
+    }
+    if steps > 1:
+        estimate["records"] = count * steps
+    return estimate
+
+
+def estimate_fly(plan, kinematics, start, lockin_state, x_limits=(0.0, None)):
+    """
+    Fly scans sweep every row at constant velocity between run-ups, then
+    step to the next row: back to the row start, or with the serpentine
+    strategy straight down from the end of the sweep.
+    """
+    xs, ys = plan.xs, plan.ys
+    x_step = float(xs[1] - xs[0]) if len(xs) > 1 else plan.params.x_step_size
+    max_velocity, acceleration = kinematics[1]
+    velocity, run_up = choose_sweep_velocity(
+        x_step, lockin_state.time_constant, max_velocity, acceleration
+    )
+    sweep_start, sweep_end, _ = sweep_range(xs, x_step, run_up, x_limits)
+    sweep = sweep_end - sweep_start
+    sweep_time = float(move_time(sweep, velocity, acceleration))
+    row_step = float(move_time(ys[1] - ys[0], *kinematics[2])) if len(ys) > 1 else 0
+    row_return = 0.0
+    if plan.params.path_strategy != "serpentine":
+        row_return = float(move_time(sweep, max_velocity, acceleration))
+    first = 0.0
+    if start is not None:
+        first = float(
+            leg_time(start, (sweep_start, ys[0]), kinematics, simultaneous=True)
+        )
+    rows = len(ys)
+    moves = (rows - 1) * max(row_step, row_return)
+    return {
+        "travel_distance": float(
+            sweep * rows + (sweep if row_return else 0.0) * (rows - 1) + ys[-1] - ys[0]
+        ),
+        "travel_time": first + moves,
+        "sweep_velocity": velocity,
+        "sweep_time": sweep_time * rows,
+        "per_point": (first + moves + sweep_time * rows) / len(plan.points),
+        "eta": first + moves + sweep_time * rows,
+    }
@@ -0,0 +1,77 @@
+import math
+import time
+from collections import deque
+
+# Time constants needed to settle to 99% for each filter slope (dB/oct)
+SETTLE_TIME_CONSTANTS = {6: 5, 12: 7, 18: 9, 24: 10}
+
+# Floor for the reference magnitude so a zero signal can still converge
+NOISE_FLOOR = 1e-15
+
+
+def full_settle_time(state):
+    """
+    Worst-case settle time for the lock-in's current filter settings.
+    """
+    if not state.time_constant:
+        return 0.0
+    return SETTLE_TIME_CONSTANTS.get(state.filter_slope, 10) * state.time_constant
+
+
+def converged(history, tolerance):
+    """
+    True when every (X, Y) reading in the window lies within tolerance
+    of the window mean, relative to the mean magnitude.
+    """
+    x_mean = sum(sample[0] for sample in history) / len(history)
+    y_mean = sum(sample[1] for sample in history) / len(history)
+    reference = max(math.hypot(x_mean, y_mean), NOISE_FLOOR)
+    spread = max(
+        math.hypot(sample[0] - x_mean, sample[1] - y_mean) for sample in history
+    )
+    return spread / reference < tolerance
+
+
+def wait_for_settle(lockin, settle):
+    """
+    Block until the lock-in output has settled according to the
+    SettleParams and return the last (X, Y, R, theta) snapshot together
+    with the time spent waiting.
+    """
+    start = time.monotonic()
+    time_constant = lockin.state.time_constant or 0.0
+    if settle.mode == "time_constants":
+        count = settle.time_constants
+        if count is None:
+            count = SETTLE_TIME_CONSTANTS.get(lockin.state.filter_slope, 10)
+        time.sleep(count * time_constant)
+        return lockin.read_snapshot(), time.monotonic() - start
+    timeout = settle.timeout
+    if timeout is None:
+        timeout = max(2 * full_settle_time(lockin.state), 0.1)
+    interval = settle.interval
+    if interval is None:
+        interval = max(time_constant, 0.005)
+    history = deque(maxlen=settle.samples)
+    while True:
+        snapshot = lockin.read_snapshot()
+        history.append(snapshot)
+        elapsed = time.monotonic() - start
+        if len(history) == history.maxlen and converged(history, settle.tolerance):
+            break
+        if elapsed >= timeout:
+            print(f"---Settle timeout after {elapsed:.3f}s")
+            break
+        time.sleep(interval)
+    return snapshot, elapsed
+
+
+def summarize_settle_times(settle_times):
+    if not settle_times:
+        return None
+    return {
+        "min": min(settle_times),
+        "max": max(settle_times),
+        "mean": sum(settle_times) / len(settle_times),
+        "total": sum(settle_times),
+    }
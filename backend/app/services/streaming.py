@@ -0,0 +1,221 @@
+import asyncio
+import json
+import math
+import struct
+import warnings
+import numpy as np
+from fastapi.websockets import WebSocketDisconnect
+from app.models.streaming import StreamOptions
+from app.services.telemetry import CLOSE
+
+ENCODINGS = ["json", "binary"]
+DECIMATIONS = ["none", "mean", "minmax"]
+MAX_RATE = 100.0
+MAX_BATCH = 4096
+
+# Binary sample frame, little-endian: type, rows, columns, t0 (epoch
+# seconds), then rows * columns float32, row-major. Column 0 is the sample
+# time in seconds after t0, the others are named in the schema message.
+SAMPLES_FRAME = 3
+FRAME_HEADER = struct.Struct("<BHHd")
+
+
+def is_legacy(options):
+    """
+    Default options keep the original protocol: one JSON dict per reading.
+    """
+    return (
+        options.encoding == "json"
+        and options.rate is None
+        and options.decimation == "none"
+        and options.batch == 1
+    )
+
+
+def validate(options):
+    if options.encoding not in ENCODINGS:
+        raise ValueError(f"Unknown encoding {options.encoding}")
+    if options.decimation not in DECIMATIONS:
+        raise ValueError(f"Unknown decimation {options.decimation}")
+    if options.rate is not None and not 0 < options.rate <= MAX_RATE:
+        raise ValueError(f"Rate must be between 0 and {MAX_RATE} Hz")
+    if not 1 <= options.batch <= MAX_BATCH:
+        raise ValueError(f"Batch must be between 1 and {MAX_BATCH}")
+    return options
+
+
+def sample_columns(message):
+    # Everything but strings (e.g. the lock-in unit) is streamed, None as NaN
+    return [name for name, value in message.items() if not isinstance(value, str)]
+
+
+def output_columns(columns, decimation):
+    if decimation == "minmax":
+        return (
+            ["t"]
+            + [f"{name}.mean" for name in columns]
+            + [f"{name}.min" for name in columns]
+            + [f"{name}.max" for name in columns]
+        )
+    return ["t"] + columns
+
+
+def to_rows(entries, columns):
+    return np.array(
+        [
+            [t]
+            + [
+                np.nan if message.get(name) is None else message[name]
+                for name in columns
+            ]
+            for t, message in entries
+        ],
+        dtype=np.float64,
+    )
+
+
+def decimate(rows, decimation):
+    """
+    Reduce a window of rows to one row: the mean time plus the mean (and
+    for minmax also the min and max) of every column.
+    """
+    if decimation == "none" or len(rows) == 0:
+        return rows
+    t = rows[:, :1].mean(axis=0)
+    values = rows[:, 1:]
+    with warnings.catch_warnings():
+        # All-NaN columns (e.g. failed reads) stay NaN
+        warnings.simplefilter("ignore", RuntimeWarning)
+        parts = [t, np.nanmean(values, axis=0)]
+        if decimation == "minmax":
+            parts += [np.nanmin(values, axis=0), np.nanmax(values, axis=0)]
+    return np.concatenate(parts)[np.newaxis, :]
+
+
+def encode(rows, encoding):
+    if encoding == "binary":
+        t0 = rows[0, 0]
+        packed = rows.astype("<f4")
+        packed[:, 0] = rows[:, 0] - t0
+        return FRAME_HEADER.pack(SAMPLES_FRAME, len(rows), rows.shape[1], t0) + (
+            packed.tobytes()
+        )
+    return {
+        "type": "samples",
+        "rows": [
+            [None if math.isnan(value) else value for value in row]
+            for row in rows.tolist()
+        ],
+    }
+
+
+async def send(websocket, frame):
+    if isinstance(frame, bytes):
+        await websocket.send_bytes(frame)
+    else:
+        await websocket.send_json(frame)
+
+
+async def receive_options(websocket, state):
+    """
+    Apply option changes the client sends as JSON while streaming.
+    """
+    while True:
+        text = await websocket.receive_text()
+        try:
+            update = json.loads(text)
+            state["options"] = validate(
+                StreamOptions(**{**state["options"].model_dump(), **update})
+            )
+            state["changed"] = True
+        except Exception as e:
+            await websocket.send_json({"type": "error", "message": str(e)})
+
+
+async def stream_topic(websocket, hub, topic, options, legacy_format=None):
+    """
+    Stream a telemetry topic to a websocket. With the default options every
+    reading is sent as a JSON dict, as legacy_format shapes it. Otherwise
+    the client gets a schema message, then frames of samples: sent at the
+    requested rate (or every batch samples), decimated per window if asked,
+    JSON or packed float32. Clients renegotiate by sending new options.
+    """
+    await websocket.accept()
+    try:
+        options = validate(options)
+    except ValueError as e:
+        await websocket.close(code=1003, reason=str(e))
+        return
+    state = {"options": options, "changed": True}
+    subscription = hub.subscribe(topic, 32 if is_legacy(options) else MAX_BATCH)
+    receiver = asyncio.create_task(receive_options(websocket, state))
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            if state["changed"]:
+                state["changed"] = False
+                options = state["options"]
+                subscription.resize(32 if is_legacy(options) else MAX_BATCH)
+                columns = None
+                pending = []
+                interval = 1 / options.rate if options.rate else None
+                next_flush = loop.time() + (interval or 0)
+            if is_legacy(options):
+                entry = await subscription.get()
+                if entry is CLOSE:
+                    await websocket.close()
+                    break
+                message = entry[1]
+                await websocket.send_json(
+                    legacy_format(message) if legacy_format else message
+                )
+                continue
+            entry = None
+            timeout = None if interval is None else max(next_flush - loop.time(), 0)
+            try:
+                entry = await asyncio.wait_for(subscription.get(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            if entry is CLOSE:
+                await websocket.close()
+                break
+            if entry is not None:
+                if columns is None:
+                    columns = sample_columns(entry[1])
+                    await websocket.send_json(
+                        {
+                            "type": "schema",
+                            "topic": topic,
+                            **options.model_dump(),
+                            "columns": output_columns(columns, options.decimation),
+                        }
+                    )
+                pending.append(entry)
+            if interval is not None:
+                due = loop.time() >= next_flush
+            else:
+                due = len(pending) >= options.batch
+            if not due:
+                continue
+            if interval is not None:
+                next_flush = max(next_flush + interval, loop.time())
+            if not pending:
+                continue
+            rows = decimate(to_rows(pending, columns), options.decimation)
+            pending = []
+            for start in range(0, len(rows), options.batch):
+                await send(
+                    websocket,
+                    encode(rows[start : start + options.batch], options.encoding),
+                )
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        print(f"{topic.capitalize()} websocket error: {e}")
+        try:
+            await websocket.close()
+        except:
+            pass
+    finally:
+        receiver.cancel()
+        hub.unsubscribe(subscription)
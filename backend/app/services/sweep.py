@@ -0,0 +1,80 @@
+import numpy as np
+from app.models.stage import SettleParams
+
+SWEEP_ORDERS = ["serpentine", "ascending", "given"]
+
+# Fields kept per frequency in the spectra of a sweep scan
+SPECTRUM_FIELDS = ["X", "Y", "R", "theta", "voltage", "settle_time"]
+
+
+def sweep_steps(sweep):
+    """
+    The (frequency, amplitude) steps of SweepParams, with their index in
+    the given list; amplitude is None when the output level is left alone.
+    """
+    frequencies = sweep.frequencies
+    if not frequencies:
+        raise ValueError("A sweep needs at least one frequency")
+    if any(frequency <= 0 for frequency in frequencies):
+        raise ValueError("Sweep frequencies must be positive")
+    amplitudes = sweep.amplitudes
+    if amplitudes is None:
+        amplitudes = [None] * len(frequencies)
+    elif len(amplitudes) != len(frequencies):
+        raise ValueError("Give one amplitude per sweep frequency")
+    if sweep.order not in SWEEP_ORDERS:
+        raise ValueError(f"Unknown sweep order: {sweep.order}")
+    return [
+        (index, frequency, amplitude)
+        for index, (frequency, amplitude) in enumerate(zip(frequencies, amplitudes))
+    ]
+
+
+def sweep_settle(settle):
+    """
+    Settling of every sweep step: as given, otherwise the full settle
+    time of the lock-in filter, since each step changes the reference.
+    """
+    if settle is not None:
+        return settle
+    return SettleParams(mode="time_constants")
+
+
+def point_order(steps, order, point_number):
+    """
+    Steps in the order they are visited at one point. Sorted by frequency
+    the reference moves in the smallest increments; serpentine also runs
+    every other point downwards, so consecutive points start where the
+    previous one ended instead of jumping back across the whole band.
+    """
+    if order == "given":
+        return steps
+    steps = sorted(steps, key=lambda step: step[1])
+    if order == "serpentine" and point_number % 2:
+        return steps[::-1]
+    return steps
+
+
+def spectrum_cube(rows, plan, xs=None, ys=None, step_count=1):
+    """
+    Arrange the records of a sweep scan by position and frequency step:
+    (len(ys), len(xs), step_count) arrays for a grid scan, (len(plan),
+    step_count) for a point list. Steps never measured stay NaN.
+    """
+    point_index = rows["point_index"]
+    step = rows["sweep_step"]
+    if xs is not None:
+        points = np.asarray(plan, dtype=np.float64)[point_index]
+        i = np.abs(points[:, 0][:, None] - np.asarray(xs)[None, :]).argmin(axis=1)
+        j = np.abs(points[:, 1][:, None] - np.asarray(ys)[None, :]).argmin(axis=1)
+        shape = (len(ys), len(xs), step_count)
+        index = (j, i, step)
+    else:
+        shape = (len(plan), step_count)
+        index = (point_index, step)
+    cubes = {}
+    for name in SPECTRUM_FIELDS:
+        cube = np.full(shape, np.nan)
+        cube[index] = rows[name]
+        cubes[name] = cube
+    return cubes
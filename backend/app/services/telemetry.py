@@ -0,0 +1,104 @@
+import asyncio
+import time
+
+# Sentinel pushed to subscribers to ask their websocket to close
+CLOSE = object()
+
+
+class Subscription:
+    """
+    Bounded per-subscriber queue of (timestamp, message) pairs. When a
+    slow consumer falls behind the oldest message is dropped so it always
+    sees the most recent data.
+    """
+
+    def __init__(self, topic, maxsize=32):
+        self.topic = topic
+        self.queue = asyncio.Queue(maxsize)
+        self.dropped = 0
+
+    def put(self, message):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(message)
+
+    async def get(self):
+        return await self.queue.get()
+
+    def resize(self, maxsize):
+        # Keeps the newest messages that fit
+        queue = asyncio.Queue(maxsize)
+        while not self.queue.empty():
+            message = self.queue.get_nowait()
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(message)
+        self.queue = queue
+
+
+class TelemetryHub:
+    """
+    Fan-out of instrument readings. One acquisition loop per instrument
+    reads it once per tick and publishes the result to every subscriber
+    of its topic, however many there are. All methods must be called
+    from the event loop.
+    """
+
+    def __init__(self):
+        self.subscribers = {}
+        self.latest = {}
+        self.tasks = []
+
+    def subscribe(self, topic, maxsize=32):
+        subscription = Subscription(topic, maxsize)
+        self.subscribers.setdefault(topic, set()).add(subscription)
+        if topic in self.latest:
+            subscription.put(self.latest[topic])
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscribers.get(subscription.topic, set()).discard(subscription)
+
+    def subscriber_count(self, topic):
+        return len(self.subscribers.get(topic, ()))
+
+    def publish(self, topic, message):
+        entry = (time.time(), message)
+        self.latest[topic] = entry
+        for subscription in list(self.subscribers.get(topic, ())):
+            subscription.put(entry)
+
+    def close_subscribers(self, topics=None):
+        for topic in topics or list(self.subscribers):
+            for subscription in list(self.subscribers.get(topic, ())):
+                subscription.put(CLOSE)
+
+    async def acquire(self, topic, read, interval=0.1):
+        """
+        Poll read() every interval seconds while the topic has subscribers
+        and publish each reading.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            if self.subscriber_count(topic):
+                try:
+                    message = await read()
+                    if message is not None:
+                        self.publish(topic, message)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    print(f"---{topic} acquisition error: {e}")
+            await asyncio.sleep(max(interval - (loop.time() - started), 0))
+
+    def start(self, topic, read, interval=0.1):
+        self.tasks.append(asyncio.create_task(self.acquire(topic, read, interval)))
+
+    async def stop(self):
+        self.close_subscribers()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
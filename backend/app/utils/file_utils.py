@@ -1,18 +1,399 @@
+import json
+import os
+import queue
+import threading
+import time
+import numpy as np
 from datetime import datetime
+from app.services.metrics import registry as metrics
+
+SCHEMA_VERSION = 6
+
+# Where new scans are written, relative to the working directory by default
+MEASUREMENT_DIR = os.environ.get("MEASUREMENT_DIR", ".")
+
+# Fixed record layout of a scan, in the column order of the CSV export.
+# Timestamps are monotonic nanoseconds, converted with the epoch offset
+# stored next to the data. point_index is the position of the point in the
+# scan plan, which is what a resumed scan uses to skip finished points;
+# level is the refinement level of the point in an adaptive scan;
+# sweep_step the index of the reference frequency in a sweep scan.
+SCAN_FIELDS = [
+    ("timestamp_ns", "i8"),
+    ("point_index", "i8"),
+    ("level", "i8"),
+    ("positionX", "f8"),
+    ("positionY", "f8"),
+    ("X", "f8"),
+    ("Y", "f8"),
+    ("R", "f8"),
+    ("theta", "f8"),
+    ("frequency", "f8"),
+    ("phase", "f8"),
+    ("voltage", "f8"),
+    ("voltage_std", "f8"),
+    ("settle_time", "f8"),
+    ("sensitivity", "f8"),
+    ("amplitude", "f8"),
+    ("sweep_step", "i8"),
+]
+
+CSV_HEADER = "Timestamp,PositionX,PositionY,X(V),Y(V),R(V),Theta(deg),Frequency(Hz),Phase(deg),Voltage(V)\n"
+
+# Fields written by format_csv_row, the rest of a scan follows them by name
+CSV_FIELDS = [
+    "timestamp_ns",
+    "positionX",
+    "positionY",
+    "X",
+    "Y",
+    "R",
+    "theta",
+    "frequency",
+    "phase",
+    "voltage",
+]
+
+
+def format_timestamp(timestamp):
+    if isinstance(timestamp, str):
+        return timestamp
+    return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S.%f")
+
+
+def format_csv_row(measurement, epoch_offset_ns=0):
+    if "timestamp_ns" in measurement:
+        timestamp = (int(measurement["timestamp_ns"]) + epoch_offset_ns) / 1e9
+    else:
+        timestamp = measurement["timestamp"]
+    return (
+        f"{format_timestamp(timestamp)},{measurement['positionX']},{measurement['positionY']},"
+        f"{measurement['X']},{measurement['Y']},{measurement['R']},"
+        f"{measurement['theta']:.2f},{measurement['frequency']:.6f},"
+        f"{measurement['phase']:.2f},{measurement['voltage']}\n"
+    )
 
 
 def save_to_file(data, filename=None):
     if filename is None:
-        filename = f"Measurements_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-    with open(filename, "w") as f:
-        f.write(
-            "Timestamp,PositionX,PositionY,X(V),Y(V),R(V),Theta(deg),Frequency(Hz),Phase(deg),Voltage(V)\n"
+        filename = os.path.join(
+            MEASUREMENT_DIR,
+            f"Measurements_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
         )
+    with open(filename, "w") as f:
+        f.write(CSV_HEADER)
         for measurement in data:
-            f.write(
-                f"{measurement['timestamp']},{measurement['positionX']},{measurement['positionY']},"
-                f"{measurement['X']},{measurement['Y']},{measurement['R']},"
-                f"{measurement['theta']:.2f},{measurement['frequency']:.6f},"
-                f"{measurement['phase']:.2f},{measurement['voltage']}\n"
-            )
+            f.write(format_csv_row(measurement))
     print(f"\nData saved to {filename}")
+
+
+def to_number(value):
+    if value is None:
+        return np.nan
+    try:
+        return float(value)
+    except TypeError:
+        # .NET Decimal positions only convert through their string form
+        return float(str(value))
+
+
+def measurement_path(path):
+    """
+    Resolve a path given through the API against MEASUREMENT_DIR and
+    reject anything outside it.
+    """
+    root = os.path.realpath(MEASUREMENT_DIR)
+    resolved = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, resolved]) != root:
+        raise ValueError(f"{path} is outside the measurement directory")
+    return resolved
+
+
+def fsync_directory(path):
+    if os.name == "nt":
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class ScanWriter:
+    """
+    Streams scan records to a directory of columnar chunks. Records (dicts
+    or rows of a structured array) are handed over through a queue and
+    written by a background thread, each chunk as an .npz with one array
+    per field, written to a temporary file, fsynced and renamed into
+    place, so a crash loses at most the chunk that was still being filled.
+    """
+
+    def __init__(
+        self,
+        path=None,
+        fields=SCAN_FIELDS,
+        chunk_size=256,
+        flush_interval=5.0,
+        epoch_offset_ns=None,
+        resume=False,
+    ):
+        if path is None:
+            path = os.path.join(
+                MEASUREMENT_DIR,
+                f"Measurements_{datetime.now().strftime('%Y%m%d_%H%M%S')}.scan",
+            )
+        if epoch_offset_ns is None:
+            epoch_offset_ns = time.time_ns() - time.monotonic_ns()
+        self.path = path
+        self.fields = fields
+        self.dtype = np.dtype(fields)
+        self.chunk_size = chunk_size
+        self.flush_interval = flush_interval
+        self.chunk_index = 0
+        self.records_written = 0
+        self.error = None
+        os.makedirs(self.path, exist_ok=True)
+        if resume:
+            # Keep the existing chunks and their schema, so the scan stays
+            # readable as the version it was started with
+            schema = read_schema(self.path)
+            self.chunk_index = len(list_chunks(self.path))
+            self.fields = [(name, dtype) for name, dtype in schema["fields"]]
+            self.dtype = np.dtype(self.fields)
+            epoch_offset_ns = schema.get("epoch_offset_ns", epoch_offset_ns)
+        else:
+            with open(os.path.join(self.path, "schema.json"), "w") as f:
+                json.dump(
+                    {
+                        "schema_version": SCHEMA_VERSION,
+                        "fields": [[name, dtype] for name, dtype in fields],
+                        "epoch_offset_ns": epoch_offset_ns,
+                    },
+                    f,
+                )
+        self.epoch_offset_ns = epoch_offset_ns
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def append(self, record):
+        self.queue.put(record)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        print(f"\nData saved to {self.path} ({self.records_written} records)")
+        if self.error is not None:
+            raise self.error
+
+    def to_rows(self, record):
+        if isinstance(record, np.ndarray):
+            if record.dtype == self.dtype:
+                return record
+            rows = np.zeros(len(record), dtype=self.dtype)
+            for name in self.dtype.names:
+                if name in record.dtype.names:
+                    rows[name] = record[name]
+                elif self.dtype[name].kind == "f":
+                    rows[name] = np.nan
+            return rows
+        row = np.zeros(1, dtype=self.dtype)
+        for name in self.dtype.names:
+            value = record.get(name)
+            if value is not None:
+                row[name] = to_number(value)
+            elif self.dtype[name].kind == "f":
+                row[name] = np.nan
+        return row
+
+    def run(self):
+        rows = []
+        pending = 0
+        last_flush = time.monotonic()
+        while True:
+            try:
+                record = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                record = False
+            if record is None:
+                break
+            if record is not False:
+                rows.append(self.to_rows(record))
+                pending += len(rows[-1])
+            due = time.monotonic() - last_flush >= self.flush_interval
+            if pending >= self.chunk_size or (pending and due):
+                self.flush(rows)
+                rows = []
+                pending = 0
+                last_flush = time.monotonic()
+        if pending:
+            self.flush(rows)
+
+    def flush(self, rows):
+        filename = os.path.join(self.path, f"chunk_{self.chunk_index:06d}.npz")
+        temp = filename + ".tmp"
+        started = time.perf_counter()
+        try:
+            chunk = np.concatenate(rows)
+            with open(temp, "wb") as f:
+                np.savez(
+                    f,
+                    **{
+                        name: np.asarray(chunk[name], dtype=dtype)
+                        for name, dtype in self.fields
+                    },
+                )
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp, filename)
+            fsync_directory(self.path)
+            self.chunk_index += 1
+            self.records_written += len(chunk)
+            metrics.observe("writer", "flush", time.perf_counter() - started)
+        except Exception as e:
+            print(f"---Scan writer error: {e}")
+            metrics.error("writer", "flush", e)
+            self.error = e
+
+
+def read_schema(path):
+    with open(os.path.join(path, "schema.json")) as f:
+        return json.load(f)
+
+
+def write_checkpoint(path, checkpoint):
+    filename = os.path.join(path, "checkpoint.json")
+    with metrics.timer("writer", "checkpoint"):
+        with open(filename + ".tmp", "w") as f:
+            json.dump(checkpoint, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(filename + ".tmp", filename)
+        fsync_directory(path)
+
+
+def read_checkpoint(path):
+    filename = os.path.join(path, "checkpoint.json")
+    if not os.path.exists(filename):
+        raise Exception(f"{path} has no checkpoint, it cannot be resumed")
+    with open(filename) as f:
+        return json.load(f)
+
+
+def save_grid(path, xs, ys, grids):
+    """
+    Store a scan resampled onto a regular grid as grid.npz in the scan
+    directory: the axes plus one (len(ys), len(xs)) array per field.
+    """
+    filename = os.path.join(path, "grid.npz")
+    with open(filename + ".tmp", "wb") as f:
+        np.savez(f, x=xs, y=ys, **grids)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(filename + ".tmp", filename)
+    return filename
+
+
+def save_spectra(path, frequencies, amplitudes, axes, cubes):
+    """
+    Store the spectra of a sweep scan as spectra.npz in the scan
+    directory: the frequencies, amplitudes and spatial axes plus one array
+    per field, (len(y), len(x), len(frequency)) for grid scans and
+    (points, len(frequency)) for point lists.
+    """
+    filename = os.path.join(path, "spectra.npz")
+    with open(filename + ".tmp", "wb") as f:
+        np.savez(f, frequency=frequencies, amplitude=amplitudes, **axes, **cubes)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(filename + ".tmp", filename)
+    return filename
+
+
+def export_grid_csv(path, filename=None):
+    """
+    Convert the grid.npz of a scan directory to a CSV with one row per
+    grid node.
+    """
+    if filename is None:
+        filename = os.path.splitext(path.rstrip("/\\"))[0] + "_grid.csv"
+    with np.load(os.path.join(path, "grid.npz")) as arrays:
+        xs, ys = arrays["x"], arrays["y"]
+        names = [name for name in arrays.files if name not in ("x", "y")]
+        grids = {name: arrays[name] for name in names}
+    with open(filename, "w") as f:
+        f.write(",".join(["PositionX", "PositionY"] + names) + "\n")
+        for j, y in enumerate(ys):
+            for i, x in enumerate(xs):
+                row = [x, y] + [grids[name][j, i] for name in names]
+                f.write(",".join(str(value) for value in row) + "\n")
+    print(f"\nGrid exported to {filename}")
+    return filename
+
+
+def list_chunks(path):
+    return sorted(
+        name
+        for name in os.listdir(path)
+        if name.startswith("chunk_") and name.endswith(".npz")
+    )
+
+
+def chunk_columns(arrays, fields):
+    """
+    The fields of one loaded chunk. Fields the chunk lacks, e.g. in scans
+    resumed by an older version that rewrote the schema, read as NaN, or
+    zero for integers.
+    """
+    rows = len(arrays[arrays.files[0]]) if arrays.files else 0
+    columns = {}
+    for name, dtype in fields:
+        if name in arrays.files:
+            columns[name] = arrays[name]
+        else:
+            columns[name] = np.full(
+                rows, np.nan if np.dtype(dtype).kind == "f" else 0, dtype
+            )
+    return columns
+
+
+def read_scan(path):
+    """
+    Load every chunk of a scan directory into one array per field.
+    """
+    schema = read_schema(path)
+    chunks = list_chunks(path)
+    columns = {name: [] for name, _ in schema["fields"]}
+    for chunk in chunks:
+        with np.load(os.path.join(path, chunk)) as arrays:
+            for name, column in chunk_columns(arrays, schema["fields"]).items():
+                columns[name].append(column)
+    return {
+        name: (np.concatenate(columns[name]) if columns[name] else np.empty(0, dtype))
+        for name, dtype in schema["fields"]
+    }
+
+
+def export_csv(path, filename=None):
+    """
+    Convert a scan directory written by ScanWriter to the CSV layout of
+    save_to_file, followed by the other fields of its schema.
+    """
+    if filename is None:
+        filename = os.path.splitext(path.rstrip("/\\"))[0] + ".csv"
+    epoch_offset_ns = read_schema(path).get("epoch_offset_ns", 0)
+    columns = read_scan(path)
+    if "point_index" in columns:
+        # Points of a resumed scan are back in plan order
+        order = np.argsort(columns["point_index"], kind="stable")
+        columns = {name: column[order] for name, column in columns.items()}
+    names = list(columns)
+    extra = [name for name in names if name not in CSV_FIELDS]
+    with open(filename, "w") as f:
+        f.write(CSV_HEADER.rstrip("\n") + "".join(f",{name}" for name in extra) + "\n")
+        for row in zip(*columns.values()):
+            record = dict(zip(names, row))
+            line = format_csv_row(record, epoch_offset_ns).rstrip("\n")
+            f.write(line + "".join(f",{record[name]}" for name in extra) + "\n")
+    print(f"\nData exported to {filename}")
+    return filename
@@ -0,0 +1,70 @@
+"""
+Run an adaptive scan of a simulated sample, flat apart from one small
+Gaussian feature, and compare its point count with the uniform grid of
+the same finest resolution.
+
+Run from the backend directory:
+    python -m benchmarks.adaptive_scan --step 0.125 --depth 3
+"""
+
+import argparse
+import os
+import tempfile
+import numpy as np
+from app.core.lockin import SR865A
+from app.core.multimeter import BKPrecision5493C
+from app.core.simulated import (
+    SimulatedBBD302,
+    SimulatedBK5493CResource,
+    SimulatedSR865AResource,
+    feature_map,
+)
+from app.models.stage import AdaptiveParams
+from app.models.state import global_state
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=float, default=1.0)
+    parser.add_argument("--step", type=float, default=0.125)
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--threshold", type=float, default=5e-5)
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp())
+    stage = SimulatedBBD302(max_velocity=100.0, acceleration=1000.0)
+    global_state.stage = stage
+    global_state.lockin = SR865A(
+        inst=SimulatedSR865AResource(0.0005, source=feature_map(stage))
+    )
+    global_state.multimeter = BKPrecision5493C(inst=SimulatedBK5493CResource(0.0005))
+    global_state.multimeter.configure_measurement("VOLT:DC", 0.02)
+    summary = stage.adaptive_scan(
+        0,
+        0,
+        args.size,
+        args.size,
+        None,
+        None,
+        args.step,
+        args.step,
+        "step_size",
+        0,
+        AdaptiveParams(r_threshold=args.threshold, max_depth=args.depth),
+    )
+    points = summary["samples"]
+    print(f"---Points per level: {summary['levels']}")
+    print(
+        f"---Adaptive: {points} points, uniform grid: {summary['uniform_points']} points "
+        f"({summary['uniform_points'] / points:.1f}x fewer)"
+    )
+    with np.load(summary["grid"]) as grid:
+        peak = np.unravel_index(np.nanargmax(grid["R"]), grid["R"].shape)
+        print(
+            f"---Resampled grid {grid['R'].shape}, peak R at "
+            f"({grid['x'][peak[1]]:.3f}, {grid['y'][peak[0]]:.3f})"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""
+Compare the per-sample cost of SR865A.read_values_polled (one query per
+value) against the snapshot path of SR865A.read_values on a simulated
+VISA resource.
+
+Run from the backend directory:
+    python -m benchmarks.lockin_latency --latency 0.005 --samples 200
+"""
+
+import argparse
+import time
+from app.core.lockin import SR865A
+from app.core.simulated import SimulatedSR865AResource
+
+
+def measure(lockin, read, samples):
+    lockin.inst.query_count = 0
+    start = time.perf_counter()
+    for _ in range(samples):
+        read(True)
+    elapsed = time.perf_counter() - start
+    return elapsed / samples, lockin.inst.query_count / samples
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--latency", type=float, default=0.005)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--samples", type=int, default=200)
+    args = parser.parse_args()
+
+    lockin = SR865A(inst=SimulatedSR865AResource(args.latency, args.jitter))
+    results = {
+        "polled": measure(lockin, lockin.read_values_polled, args.samples),
+        "snapshot": measure(lockin, lockin.read_values, args.samples),
+    }
+    print(f"---Simulated per-query latency: {args.latency * 1e3:.2f} ms")
+    for name, (per_sample, queries) in results.items():
+        print(
+            f"---{name}: {queries:.1f} queries/sample, "
+            f"{per_sample * 1e3:.2f} ms/sample, {1 / per_sample:.1f} samples/second"
+        )
+    speedup = results["polled"][0] / results["snapshot"][0]
+    print(f"---Snapshot speedup: {speedup:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
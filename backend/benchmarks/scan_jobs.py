@@ -0,0 +1,78 @@
+"""
+Exercise the scan job scheduler against simulated instruments: queue
+two small scans, pause and resume the first, cancel the second and
+print the progress messages published on the "jobs" topic.
+
+Run from the backend directory:
+    python -m benchmarks.scan_jobs
+"""
+
+import asyncio
+import os
+import tempfile
+from app.core.device_actor import DeviceActor
+from app.core.lockin import SR865A
+from app.core.multimeter import BKPrecision5493C
+from app.core.simulated import (
+    SimulatedBBD302,
+    SimulatedBK5493CResource,
+    SimulatedSR865AResource,
+)
+from app.models.stage import RectangleParams
+from app.models.state import global_state
+from app.services.scan_jobs import ScanScheduler
+from app.services.telemetry import TelemetryHub
+
+
+async def print_progress(subscription):
+    while True:
+        _, message = await subscription.get()
+        progress = message["progress"]
+        print(
+            f"---Job {message['job_id']}: {message['status']} "
+            f"{progress['points_done']}/{progress['points_total']} ETA {progress['eta']}"
+        )
+
+
+async def main():
+    os.chdir(tempfile.mkdtemp())
+    global_state.stage = DeviceActor(SimulatedBBD302(), "stage")
+    global_state.lockin = DeviceActor(
+        SR865A(inst=SimulatedSR865AResource(0.002)), "lockin"
+    )
+    global_state.multimeter = DeviceActor(
+        BKPrecision5493C(inst=SimulatedBK5493CResource(0.002)), "multimeter"
+    )
+    hub = TelemetryHub()
+    scheduler = ScanScheduler(hub)
+    scheduler.start()
+    printer = asyncio.create_task(print_progress(hub.subscribe("jobs", 256)))
+
+    params = RectangleParams(
+        x1=0,
+        y1=0,
+        x2=1,
+        y2=1,
+        x_step_size=0.25,
+        y_step_size=0.25,
+        movement_mode="step_size",
+        delay=0.01,
+    )
+    first = scheduler.submit(params)
+    second = scheduler.submit(params)
+    await asyncio.sleep(0.5)
+    first.pause()
+    await asyncio.sleep(0.5)
+    first.resume()
+    second.cancel()
+    while first.status not in ("completed", "failed", "cancelled"):
+        await asyncio.sleep(0.1)
+    await asyncio.sleep(0.1)
+    for job in scheduler.list():
+        print(f"---{job['job_id']}: {job['status']}, output {job['output']}")
+    printer.cancel()
+    await scheduler.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
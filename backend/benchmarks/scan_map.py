@@ -0,0 +1,58 @@
+"""
+Fill a ScanMap of a large grid point by point the way a scan does and
+compare the size and build time of the delta frames a client receives
+against resending the whole image on every tick.
+
+Run from the backend directory:
+    python -m benchmarks.scan_map --side 320 --points-per-tick 20
+"""
+
+import argparse
+import time
+import numpy as np
+from app.services.path_planner import plan_grid
+from app.services.scan_buffer import empty_rows
+from app.services.scan_map import ScanMap
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--side", type=int, default=320)
+    parser.add_argument("--points-per-tick", type=int, default=20)
+    parser.add_argument("--ticks", type=int, default=500)
+    parser.add_argument("--max-cells", type=int, default=65536)
+    args = parser.parse_args()
+
+    axis = np.arange(args.side) * 0.01
+    plan = plan_grid(axis, axis, "serpentine")
+    scan_map = ScanMap(plan)
+    factor = scan_map.downsample_factor(args.max_cells)
+    frame, sequence = scan_map.full_frame("R", factor)
+    print(
+        f"---{len(plan)} point map, initial full frame {len(frame) / 1024:.1f} KiB "
+        f"(downsampled {factor}x)"
+    )
+    delta_bytes = 0
+    delta_time = 0.0
+    full_bytes = 0
+    for tick in range(args.ticks):
+        first = tick * args.points_per_tick
+        rows = empty_rows(args.points_per_tick)
+        rows["point_index"] = np.arange(first, first + args.points_per_tick)
+        rows["R"] = np.random.random(args.points_per_tick)
+        scan_map.update_rows(rows)
+        start = time.perf_counter()
+        frame, sequence = scan_map.delta_frame("R", sequence)
+        delta_time += time.perf_counter() - start
+        delta_bytes += len(frame)
+        full_bytes += scan_map.versions.size * 4
+    print(
+        f"---{args.ticks} ticks: delta frames {delta_bytes / 1024:.1f} KiB, "
+        f"{delta_time / args.ticks * 1e3:.3f} ms per frame; "
+        f"full images would be {full_bytes / 1024 / 1024:.1f} MiB "
+        f"({full_bytes / delta_bytes:.0f}x more)"
+    )
+
+
+if __name__ == "__main__":
+    main()
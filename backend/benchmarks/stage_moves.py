@@ -0,0 +1,67 @@
+"""
+Compare one-axis-after-the-other moves against StageBase.move_axes on the
+simulated stage, for a path through random points, and print the move
+times predicted by the path planner next to the measured ones.
+
+Run from the backend directory:
+    python -m benchmarks.stage_moves --points 10 --span 2
+"""
+
+import argparse
+import random
+import time
+from app.core.simulated import SimulatedBBD302
+from app.services.path_planner import estimate_travel
+
+
+def move_sequential(stage, x, y):
+    stage.channel[1].MoveTo(stage.to_device(x), 60000)
+    stage.channel[2].MoveTo(stage.to_device(y), 60000)
+
+
+def move_simultaneous(stage, x, y):
+    stage.move_axes({1: x, 2: y})
+
+
+def measure(stage, move, points):
+    move(stage, 0.0, 0.0)
+    start = time.perf_counter()
+    for x, y in points:
+        move(stage, x, y)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--points", type=int, default=10)
+    parser.add_argument("--span", type=float, default=2.0)
+    parser.add_argument("--velocity", type=float, default=10.0)
+    parser.add_argument("--acceleration", type=float, default=10.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    points = [
+        (random.uniform(0, args.span), random.uniform(0, args.span))
+        for _ in range(args.points)
+    ]
+    stage = SimulatedBBD302(max_velocity=args.velocity, acceleration=args.acceleration)
+    kinematics = stage.get_kinematics()
+    results = {}
+    for name, move, simultaneous in (
+        ("sequential", move_sequential, False),
+        ("simultaneous", move_simultaneous, True),
+    ):
+        measured = measure(stage, move, points)
+        _, predicted = estimate_travel(points, kinematics, (0.0, 0.0), simultaneous)
+        results[name] = measured
+        print(
+            f"---{name}: {measured:.3f}s measured, {predicted:.3f}s predicted "
+            f"for {len(points)} moves"
+        )
+    speedup = results["sequential"] / results["simultaneous"]
+    print(f"---Simultaneous speedup: {speedup:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
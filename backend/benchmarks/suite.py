@@ -0,0 +1,181 @@
+"""
+Offline benchmark suite on the simulated instruments: lock-in read cost,
+the step-scan loop (samples/s and per-point latency breakdown) and the
+throughput of the streaming websockets. Needs no hardware, so it can run
+in CI; --json writes the results for comparison between runs.
+
+Run from the backend directory:
+    python -m benchmarks.suite --latency 0.005 --json results.json
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+from app.core.device_actor import DeviceActor
+from app.core.devices import create_devices
+from app.models.simulation import SimulationSettings
+from app.models.state import global_state
+from benchmarks.lockin_latency import measure as measure_lockin
+
+TOPICS = ["lockin", "multimeter", "stage"]
+
+
+def bench_lockin(settings, samples):
+    _, lockin, _ = create_devices(settings)
+    results = {}
+    for name, read in (
+        ("polled", lockin.read_values_polled),
+        ("snapshot", lockin.read_values),
+    ):
+        per_sample, queries = measure_lockin(lockin, read, samples)
+        results[name] = {"seconds_per_sample": per_sample, "queries": queries}
+        print(
+            f"---lockin {name}: {per_sample * 1e3:.2f} ms/sample, {queries:.1f} queries"
+        )
+    return results
+
+
+def bench_scan(settings, size, step):
+    stage, lockin, multimeter = create_devices(settings)
+    global_state.stage = DeviceActor(stage, "stage")
+    global_state.lockin = DeviceActor(lockin, "lockin")
+    global_state.multimeter = DeviceActor(multimeter, "multimeter")
+    try:
+        summary = global_state.stage.call(
+            "move_in_rectangle",
+            0,
+            0,
+            size,
+            size,
+            None,
+            None,
+            step,
+            step,
+            "step_size",
+            0,
+        )
+    finally:
+        for actor in (global_state.stage, global_state.lockin, global_state.multimeter):
+            actor.stop()
+    acquisition = summary["acquisition"]
+    breakdown = {
+        "point": summary["elapsed"] / summary["samples"],
+        "move": acquisition["move"]["mean"],
+        "acquire": acquisition["total"]["mean"],
+        "skew": acquisition["skew"]["mean"],
+    }
+    breakdown.update(
+        {name: stats["mean"] for name, stats in acquisition["latency"].items()}
+    )
+    print(
+        f"---scan: {summary['samples']} points, {summary['samples_per_second']:.1f} samples/s"
+    )
+    print(
+        "---scan per point: "
+        + ", ".join(f"{name} {value * 1e3:.2f} ms" for name, value in breakdown.items())
+    )
+    return {
+        "samples": summary["samples"],
+        "samples_per_second": summary["samples_per_second"],
+        "per_point": breakdown,
+    }
+
+
+# Legacy JSON per reading, and packed float32 frames of 10 readings
+STREAM_MODES = {"json": "", "binary": "?encoding=binary&batch=10"}
+
+
+def receive(client, url, duration, counts):
+    with client.websocket_connect(url) as websocket:
+        end = time.monotonic() + duration
+        messages = 0
+        size = 0
+        while time.monotonic() < end:
+            message = websocket.receive()
+            size += len(message.get("text") or message.get("bytes") or "")
+            messages += 1
+        counts.append((messages, size))
+
+
+def bench_websockets(settings, clients, duration, interval):
+    # TestClient needs httpx; the app picks the simulators up from SIMULATE
+    from fastapi.testclient import TestClient
+
+    os.environ["SIMULATE"] = ",".join(settings.devices)
+    os.environ["SIM_LATENCY"] = str(settings.latency)
+    os.environ["SIM_JITTER"] = str(settings.jitter)
+    os.environ["TELEMETRY_INTERVAL"] = str(interval)
+    import main
+
+    results = {}
+    with TestClient(main.app) as client:
+        for topic in TOPICS:
+            for mode, query in STREAM_MODES.items():
+                counts = []
+                threads = [
+                    threading.Thread(
+                        target=receive,
+                        args=(client, f"/ws/{topic}{query}", duration, counts),
+                    )
+                    for _ in range(clients)
+                ]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                messages = sum(count for count, _ in counts)
+                size = sum(size for _, size in counts)
+                results[f"{topic}.{mode}"] = {
+                    "clients": clients,
+                    "messages_per_second": messages / duration,
+                    "bytes_per_second": size / duration,
+                }
+                print(
+                    f"---ws/{topic} {mode}: {clients} clients, "
+                    f"{messages / duration:.1f} messages/s, {size / duration / 1024:.1f} KiB/s"
+                )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--latency", type=float, default=0.005)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--samples", type=int, default=100)
+    parser.add_argument("--size", type=float, default=1.0)
+    parser.add_argument("--step", type=float, default=0.1)
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=2.0)
+    parser.add_argument("--interval", type=float, default=0.01)
+    parser.add_argument("--skip-websockets", action="store_true")
+    parser.add_argument("--json")
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp())
+    settings = SimulationSettings(
+        devices=["stage", "lockin", "multimeter"],
+        latency=args.latency,
+        jitter=args.jitter,
+        max_velocity=100.0,
+        acceleration=1000.0,
+        lockin_signal="feature",
+    )
+    results = {
+        "settings": settings.model_dump(),
+        "lockin": bench_lockin(settings, args.samples),
+        "scan": bench_scan(settings, args.size, args.step),
+    }
+    if not args.skip_websockets:
+        results["websockets"] = bench_websockets(
+            settings, args.clients, args.duration, args.interval
+        )
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
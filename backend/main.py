@@ -1,34 +1,106 @@
-from fastapi import FastAPI, WebSocket
+import os
+from typing import Optional
+from fastapi import Depends, FastAPI, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
 from app.routers import endpoints
 from contextlib import asynccontextmanager
 from app.models.state import global_state
-from app.core.stage import ThorlabsBBD302
-from app.core.multimeter import BKPrecision5493C
-from app.core.lockin import SR865A
+from app.core.devices import (
+    device_factories,
+    lazy_devices_from_env,
+    simulation_settings_from_env,
+)
+from app.core.device_actor import DeviceActor
 import asyncio
 from fastapi.websockets import WebSocketDisconnect
-from app.core.shared_state import pause_lockin_reading, value_lock, latest_lockin_values
+from app.services.telemetry import TelemetryHub
+from app.services.streaming import stream_topic
+from app.models.streaming import StreamOptions
+from app.services.scan_jobs import ScanScheduler
+from app.services.scan_map import MAP_QUANTITIES
+from app.services.archive import MeasurementArchive
+
+
+async def read_lockin():
+    # While the lock-in streams over UDP, telemetry averages the streamed samples
+    stream = global_state.lockin_stream
+    if stream is None:
+        return await global_state.lockin.run("read_values")
+    snapshot = stream.recent()
+    if snapshot is None:
+        return None
+    return global_state.lockin.format_values(*snapshot)
+
+
+async def read_multimeter():
+    value = await global_state.multimeter.run("read_value")
+    return {"value": value}
+
+
+async def read_stage():
+    await global_state.stage.ready()
+    return global_state.stage.read_position_values()
+
+
+def format_stage(values):
+    return {name: f"{value}" for name, value in values.items()}
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global_state.stage = ThorlabsBBD302()
-    global_state.lockin = SR865A()
-    global_state.multimeter = BKPrecision5493C()
-    pause_lockin_reading.clear()
+    # SIMULATE=all (or a device list) swaps instruments for simulators
+    factories = device_factories(
+        simulation_settings_from_env(), lambda: global_state.stage.target
+    )
+    # Every device connects on its own I/O thread, in the background or on first use
+    lazy = lazy_devices_from_env()
+    # Positions and velocity params are cached by Kinesis, read them without queueing behind a scan
+    global_state.stage = DeviceActor(
+        None,
+        "stage",
+        connect=factories["stage"],
+        lazy="stage" in lazy,
+        direct=(
+            "read_values",
+            "read_position_values",
+            "get_movement_params",
+            "get_kinematics",
+            "plan_rectangle",
+            "plan_scan",
+        ),
+    )
+    global_state.lockin = DeviceActor(
+        None,
+        "lockin",
+        connect=factories["lockin"],
+        lazy="lockin" in lazy,
+        direct=("scale_values", "format_values"),
+    )
+    global_state.multimeter = DeviceActor(
+        None, "multimeter", connect=factories["multimeter"], lazy="multimeter" in lazy
+    )
+    global_state.telemetry = TelemetryHub()
+    # Readings are published unscaled, /ws clients that ask for the legacy format get them scaled
+    interval = float(os.environ.get("TELEMETRY_INTERVAL", 0.1))
+    global_state.telemetry.start("lockin", read_lockin, interval)
+    global_state.telemetry.start("multimeter", read_multimeter, interval)
+    global_state.telemetry.start("stage", read_stage, interval)
+    # Finished scans are catalogued in MEASUREMENT_ARCHIVE (measurements.db)
+    global_state.archive = MeasurementArchive()
+    global_state.scheduler = ScanScheduler(global_state.telemetry)
+    global_state.scheduler.start()
     yield
-    for ws in [
-        global_state.ws_lockin,
-        global_state.ws_multimeter,
-        global_state.ws_stage,
-    ]:
-        if ws is not None:
-            try:
-                await ws.close()
-            except:
-                pass
-    global_state.stage.device.Disconnect()
+    await global_state.scheduler.stop()
+    await global_state.telemetry.stop()
+    if global_state.lockin_stream is not None:
+        await global_state.lockin.run("stop_stream")
+        global_state.lockin_stream.close()
+    if global_state.stage.connected:
+        await global_state.stage.run(
+            lambda: global_state.stage.target.device.Disconnect()
+        )
+    for actor in [global_state.stage, global_state.lockin, global_state.multimeter]:
+        actor.stop()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -44,102 +116,90 @@ app.add_middleware(
 app.include_router(endpoints.router)
 
 
-async def send_lockin_data(websocket: WebSocket):
-    global latest_lockin_values
-    while True:
-        if pause_lockin_reading.is_set():
-            await asyncio.sleep(0.02)
-            continue
-        values = global_state.lockin.read_values(True)
-        with value_lock:
-            latest_lockin_values = values
-        await websocket.send_json(values)
-        await asyncio.sleep(0.1)
-
-
-async def send_multimeter_data(websocket: WebSocket):
-    while True:
-        value = global_state.multimeter.read_value()
-        await websocket.send_json({"value": value})
-        await asyncio.sleep(0.1)
-
-
-async def send_stage_data(websocket: WebSocket):
-    while True:
-        values = global_state.stage.read_values()
-        await websocket.send_json(values)
-        await asyncio.sleep(0.1)
+def stream_options(
+    encoding: str = "json",
+    rate: Optional[float] = None,
+    decimation: str = "none",
+    batch: int = 1,
+):
+    return StreamOptions(
+        encoding=encoding, rate=rate, decimation=decimation, batch=batch
+    )
 
 
 @app.websocket("/ws/lockin")
-async def websocket_endpoint(websocket: WebSocket):
-    if global_state.ws_lockin is not None:
-        try:
-            await global_state.ws_lockin.close()
-        except:
-            pass
-    await websocket.accept()
-    global_state.ws_lockin = websocket
-    task = asyncio.create_task(send_lockin_data(websocket))
-    try:
-        await task
-    except WebSocketDisconnect:
-        task.cancel()
-    except Exception as e:
-        print(f"Lockin websocket error: {e}")
-        task.cancel()
-        if global_state.ws_lockin == websocket:
-            global_state.ws_lockin = None
-        try:
-            await websocket.close()
-        except:
-            pass
+async def websocket_endpoint(
+    websocket: WebSocket, options: StreamOptions = Depends(stream_options)
+):
+    await stream_topic(
+        websocket,
+        global_state.telemetry,
+        "lockin",
+        options,
+        # Looked up per reading: readings only exist once the lock-in is connected
+        lambda values: global_state.lockin.scale_values(values),
+    )
 
 
 @app.websocket("/ws/multimeter")
-async def websocket_multimeter_endpoint(websocket: WebSocket):
-    if global_state.ws_multimeter is not None:
-        try:
-            await global_state.ws_multimeter.close()
-        except:
-            pass
-    await websocket.accept()
-    global_state.ws_multimeter = websocket
-    task = asyncio.create_task(send_multimeter_data(websocket))
-    try:
-        await task
-    except WebSocketDisconnect:
-        task.cancel()
-    except Exception as e:
-        print(f"Multimeter websocket error: {e}")
-        task.cancel()
-        if global_state.ws_multimeter == websocket:
-            global_state.ws_multimeter = None
-        try:
-            await websocket.close()
-        except:
-            pass
+async def websocket_multimeter_endpoint(
+    websocket: WebSocket, options: StreamOptions = Depends(stream_options)
+):
+    await stream_topic(websocket, global_state.telemetry, "multimeter", options)
 
 
 @app.websocket("/ws/stage")
-async def websocket_stage_endpoint(websocket: WebSocket):
-    if global_state.ws_stage is not None:
-        try:
-            await global_state.ws_stage.close()
-        except:
-            pass
+async def websocket_stage_endpoint(
+    websocket: WebSocket, options: StreamOptions = Depends(stream_options)
+):
+    await stream_topic(
+        websocket, global_state.telemetry, "stage", options, format_stage
+    )
+
+
+@app.websocket("/ws/jobs")
+async def websocket_jobs_endpoint(websocket: WebSocket):
+    await stream_topic(websocket, global_state.telemetry, "jobs", StreamOptions())
+
+
+@app.websocket("/ws/scan_map")
+async def websocket_scan_map_endpoint(
+    websocket: WebSocket,
+    quantity: str = "R",
+    rate: float = 10.0,
+    max_cells: int = 65536,
+):
+    """
+    Live image of the active scan. On connect, and whenever a new scan
+    starts, a JSON meta message and a downsampled binary full frame are
+    sent, then binary delta frames with only the cells that changed (see
+    app/services/scan_map.py for the layout).
+    """
     await websocket.accept()
-    global_state.ws_stage = websocket
-    task = asyncio.create_task(send_stage_data(websocket))
+    if quantity not in MAP_QUANTITIES:
+        await websocket.close(code=1003, reason=f"Unknown quantity {quantity}")
+        return
+    interval = 1 / min(max(rate, 0.5), 60.0)
+    current = None
+    sequence = 0
     try:
-        await task
+        while True:
+            scan_map = global_state.scan_map
+            if scan_map is not None and scan_map is not current:
+                current = scan_map
+                factor = scan_map.downsample_factor(max_cells)
+                await websocket.send_json(scan_map.meta(quantity, factor))
+                frame, sequence = scan_map.full_frame(quantity, factor)
+                await websocket.send_bytes(frame)
+            elif current is not None:
+                frame, sequence = current.delta_frame(quantity, sequence)
+                if frame is not None:
+                    await websocket.send_bytes(frame)
+            await asyncio.sleep(interval)
     except WebSocketDisconnect:
-        task.cancel()
+        pass
     except Exception as e:
-        print(f"Stage websocket error: {e}")
-        task.cancel()
-        if global_state.ws_stage == websocket:
-            global_state.ws_stage = None
+        print(f"Scan map websocket error: {e}")
         try:
             await websocket.close()
         except:
@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+from app.services.path_planner import compare_plans, plan_grid
+
+
+@pytest.mark.parametrize("nx, ny", [(6, 6), (4, 4), (5, 5), (6, 3), (2, 7), (1, 4)])
+def test_spiral_moves_one_step_at_a_time(nx, ny):
+    xs, ys = np.arange(nx) * 0.5, np.arange(ny) * 0.5
+    points = np.array(plan_grid(xs, ys, "spiral"))
+    assert len(points) == nx * ny
+    assert len({tuple(point) for point in points}) == nx * ny
+    steps = np.abs(np.diff(points, axis=0)).max(axis=1)
+    assert steps.max() <= 0.5 + 1e-12
+
+
+def test_spiral_is_not_slower_than_raster_on_even_grid():
+    xs = ys = np.arange(6) * 1.0
+    kinematics = {1: (2.0, 2.0), 2: (2.0, 2.0)}
+    plans = compare_plans(xs, ys, kinematics, simultaneous=True)
+    assert plans["spiral"]["travel_time"] <= plans["raster"]["travel_time"]